@@ -0,0 +1,103 @@
+import argparse
+import re
+import time
+from pathlib import Path
+
+import cg_index
+from graphics_scanner import GraphicsPathClassifier, iter_graphics_paths
+import script_tokenizer
+import voice_util
+
+# Compare how fast graphics paths are found in the modded scripts by verification_and_fallback_matching.py:
+#   before: each string on a line is matched against one regex per top level CG entry, and the voice is checked once per string
+#   after: graphics_scanner.iter_graphics_paths() over the events of script_tokenizer, either tokenizing each script,
+#     or with the tokens already cached (as when verifying after main.py has scanned the scripts)
+# All must find exactly the same (voice, graphics path) pairs. For example:
+#   python benchmark_verification_scan.py [modded script folder] [modded CG folder] --repeat 5
+
+
+def get_graphics_regexes(top_level_files: list[str], top_level_folders: list[str]) -> list[re.Pattern]:
+    patterns = []
+    for folder in top_level_folders:
+        patterns.append(re.compile(f'^{Path(folder).stem}/'))
+
+    for file in top_level_files:
+        patterns.append(re.compile(f'^{Path(file).stem}$'))
+
+    return patterns
+
+
+def path_is_graphics(path: str, graphics_regexes: list[re.Pattern]):
+    for r in graphics_regexes:
+        if r.match(path):
+            return True
+
+    return False
+
+
+def iter_graphics_paths_before(all_lines: list[str], graphics_regexes: list[re.Pattern]):
+    last_voice = None
+
+    for raw_line in all_lines:
+        line = raw_line.split('//', maxsplit=1)[0]
+
+        for result in script_tokenizer.string_regex.finditer(line):
+            voice_on_line = voice_util.get_voice_on_line(line)
+            if voice_on_line:
+                last_voice = voice_on_line
+
+            stripped_path = result.group('data').strip()
+            if path_is_graphics(stripped_path, graphics_regexes):
+                yield last_voice, stripped_path
+
+
+def time_scan(name: str, scan, all_scripts: list[list[str]], repeat: int) -> list:
+    line_count = sum(len(all_lines) for all_lines in all_scripts) * repeat
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [list(scan(script_index)) for script_index in range(len(all_scripts))]
+    seconds = time.perf_counter() - start
+
+    print(f"{name}: {line_count} lines in {seconds:.3f}s ({line_count / seconds:,.0f} lines/s)")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark finding graphics paths in the modded scripts for verification")
+    parser.add_argument('mod_script_dir', help="Folder containing the modded scripts (*.txt)")
+    parser.add_argument('modded_game_cg_dir', help="Modded game CG folder")
+    parser.add_argument('--repeat', type=int, default=3, help="Number of times to scan all scripts")
+    args = parser.parse_args()
+
+    all_scripts = []
+    for script_path in sorted(Path(args.mod_script_dir).glob('*.txt')):
+        with open(script_path, encoding='utf-8') as f:
+            all_scripts.append(f.readlines())
+
+    files, folders = cg_index.load_cg_index(args.modded_game_cg_dir).list_folder('')
+    classifier = GraphicsPathClassifier(files, folders)
+    graphics_regexes = get_graphics_regexes(files, folders)
+    print(f"{len(all_scripts)} scripts, {len(graphics_regexes)} top level CG entries")
+
+    before = time_scan('before', lambda script_index: iter_graphics_paths_before(all_scripts[script_index], graphics_regexes), all_scripts, args.repeat)
+    after = time_scan('after', lambda script_index: iter_graphics_paths(script_tokenizer.iter_line_events(all_scripts[script_index]), classifier), all_scripts, args.repeat)
+
+    # Same as loading script_tokenizer's cache, without the time to read it from disk
+    cached_tokens_per_script = []
+    for all_lines in all_scripts:
+        new_tokens = []
+        for _ in script_tokenizer.iter_line_events(all_lines, new_tokens=new_tokens):
+            pass
+        cached_tokens_per_script.append({tokens[0]: tokens for tokens in new_tokens})
+
+    after_cached = time_scan('after (cached tokens)', lambda script_index: iter_graphics_paths(script_tokenizer.iter_line_events(all_scripts[script_index], cached_tokens_per_script[script_index]), classifier), all_scripts, args.repeat)
+
+    if before != after or before != after_cached:
+        raise Exception("Single pass scanner found different graphics paths to the regex scanner")
+
+    print(f"Found the same {sum(len(paths) for paths in after)} graphics paths")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,305 @@
+import json
+import mmap
+import os
+import struct
+from pathlib import Path
+
+# Binary version of mapping.json, which can be memory mapped and queried without parsing the whole file.
+# All integers are little endian.
+#
+# Header:
+#   magic (8 bytes), version (u32), string count (u32),
+#   offsets (u64) of: string offsets, string data, global fallback table, script table
+# Strings:
+#   Every distinct string (mod paths, og paths, voices, script names) is stored once as UTF-8.
+#   String i is string_data[string_offsets[i]:string_offsets[i + 1]] (string_offsets has count + 1 u64 entries)
+# Hash tables:
+#   capacity (u32, a power of 2), count (u32), then capacity entries of:
+#   key hash (u64, FNV-1a of the key's UTF-8 bytes), key string id (u32, empty_slot if unused), padding (u32), value (u64)
+#   Lookups use linear probing, starting from (key hash & (capacity - 1))
+# Tables:
+#   global fallback: mod path -> og path string id
+#   script table: script name -> offset of script record
+#   script record: offset of script fallback table (u64), offset of voice table (u64)
+#   script fallback: mod path -> og path string id
+#   voice table: voice -> offset of that voice's mapping table (mod path -> og path string id)
+
+magic = b'OGMAPBIN'
+format_version = 1
+
+header_struct = struct.Struct('<8sII4Q')
+table_header_struct = struct.Struct('<II')
+entry_struct = struct.Struct('<QIIQ')
+script_record_struct = struct.Struct('<QQ')
+offset_struct = struct.Struct('<Q')
+
+empty_slot = 0xFFFFFFFF
+
+
+def fnv1a_64(data: bytes) -> int:
+    h = 0xcbf29ce484222325
+    for b in data:
+        h ^= b
+        h = (h * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+class BinaryMappingWriter:
+    """Writes a binary mapping file from the same data as mapping.json.
+
+    Each script's tables are written to the file as soon as the script is added, so only the strings and the
+    offset of each script need to be kept in memory. Call set_global_fallback() first, then add_script() for each script, then save()"""
+    def __init__(self, output_path: str):
+        self.output_path = Path(output_path)
+        # The pid is included so that separate processes never write to the same temporary file
+        self.temp_path = self.output_path.with_suffix(self.output_path.suffix + f'.{os.getpid()}.tmp')
+        self.file = open(self.temp_path, 'wb')
+        # The header is written by save(), once all the offsets are known
+        self.file.write(bytes(header_struct.size))
+        # Number of bytes written to the file so far
+        self.position = header_struct.size
+
+        self.strings = [] #type: list[bytes]
+        self.string_ids = {} #type: dict[str, int]
+        self.global_fallback_offset = None #type: int
+        # Script name -> offset of script record
+        self.script_record_offsets = {} #type: dict[str, int]
+
+    def set_global_fallback(self, global_fallback: dict[str, str]):
+        output = bytearray()
+        self.global_fallback_offset = self._build_mapping_table(output, global_fallback)
+        self._write(output)
+
+    def add_script(self, script_name: str, script_fallback: dict[str, str], voice_database: dict[str, dict[str, str]]):
+        output = bytearray()
+        script_fallback_offset = self._build_mapping_table(output, script_fallback)
+        voice_offsets = {voice: self._build_mapping_table(output, mapping) for voice, mapping in voice_database.items()}
+        voice_table_offset = self._build_table(output, voice_offsets)
+
+        self.script_record_offsets[script_name] = self.position + len(output)
+        output += script_record_struct.pack(script_fallback_offset, voice_table_offset)
+        self._write(output)
+
+    def _write(self, output: bytearray):
+        self.file.write(output)
+        self.position += len(output)
+
+    def _get_string_id(self, value: str) -> int:
+        if value not in self.string_ids:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(value.encode('utf-8'))
+
+        return self.string_ids[value]
+
+    def _build_table(self, output: bytearray, items: dict[str, int]) -> int:
+        """Append a hash table of string -> value to the output (which will be written at self.position), and return its offset in the file"""
+        capacity = 1
+        while capacity < len(items) * 2:
+            capacity *= 2
+
+        slots = [None] * capacity
+        for key, value in items.items():
+            key_id = self._get_string_id(key)
+            key_hash = fnv1a_64(self.strings[key_id])
+            slot = key_hash & (capacity - 1)
+            while slots[slot] is not None:
+                slot = (slot + 1) & (capacity - 1)
+            slots[slot] = (key_hash, key_id, value)
+
+        offset = self.position + len(output)
+        output += table_header_struct.pack(capacity, len(items))
+        for entry in slots:
+            if entry is None:
+                output += entry_struct.pack(0, empty_slot, 0, 0)
+            else:
+                key_hash, key_id, value = entry
+                output += entry_struct.pack(key_hash, key_id, 0, value)
+
+        return offset
+
+    def _build_mapping_table(self, output: bytearray, mapping: dict[str, str]) -> int:
+        return self._build_table(output, {mod_path: self._get_string_id(og_path) for mod_path, og_path in mapping.items()})
+
+    def save(self):
+        if self.global_fallback_offset is None:
+            raise Exception("set_global_fallback() must be called before saving a binary mapping")
+
+        # The strings are appended last, once all of them are known
+        output = bytearray()
+        script_table_offset = self._build_table(output, self.script_record_offsets)
+        self._write(output)
+
+        string_offsets_offset = self.position
+        string_data_offset = string_offsets_offset + offset_struct.size * (len(self.strings) + 1)
+
+        string_offsets = bytearray()
+        position = 0
+        for string in self.strings:
+            string_offsets += offset_struct.pack(position)
+            position += len(string)
+        string_offsets += offset_struct.pack(position)
+
+        self._write(string_offsets)
+        self._write(b''.join(self.strings))
+
+        self.file.seek(0)
+        self.file.write(header_struct.pack(magic, format_version, len(self.strings), string_offsets_offset, string_data_offset, self.global_fallback_offset, script_table_offset))
+        self.file.close()
+
+        os.replace(self.temp_path, self.output_path)
+
+
+class BinaryMappingReader:
+    """Reads a binary mapping file through mmap, only touching the parts of the file needed for each lookup"""
+    def __init__(self, input_path: str):
+        self.file = open(input_path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        file_magic, version, self.string_count, self.string_offsets_offset, self.string_data_offset, self.global_fallback_offset, self.script_table_offset = header_struct.unpack_from(self.data, 0)
+        if file_magic != magic:
+            raise Exception(f"[{input_path}] is not a binary mapping file")
+        if version != format_version:
+            raise Exception(f"Binary mapping [{input_path}] has format version {version}, but expected {format_version}")
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_string(self, string_id: int) -> str:
+        return self._get_string_bytes(string_id).decode('utf-8')
+
+    def _get_string_bytes(self, string_id: int) -> bytes:
+        start, = offset_struct.unpack_from(self.data, self.string_offsets_offset + offset_struct.size * string_id)
+        end, = offset_struct.unpack_from(self.data, self.string_offsets_offset + offset_struct.size * (string_id + 1))
+        return self.data[self.string_data_offset + start:self.string_data_offset + end]
+
+    def _lookup(self, table_offset: int, key: str) -> int:
+        """Returns the value for the key in the hash table, or None if it isn't in the table"""
+        capacity, _count = table_header_struct.unpack_from(self.data, table_offset)
+        key_bytes = key.encode('utf-8')
+        key_hash = fnv1a_64(key_bytes)
+
+        slot = key_hash & (capacity - 1)
+        while True:
+            entry_hash, key_id, _, value = entry_struct.unpack_from(self.data, table_offset + table_header_struct.size + entry_struct.size * slot)
+            if key_id == empty_slot:
+                return None
+
+            if entry_hash == key_hash and self._get_string_bytes(key_id) == key_bytes:
+                return value
+
+            slot = (slot + 1) & (capacity - 1)
+
+    def _iterate_table(self, table_offset: int):
+        capacity, _count = table_header_struct.unpack_from(self.data, table_offset)
+        for slot in range(capacity):
+            _, key_id, _, value = entry_struct.unpack_from(self.data, table_offset + table_header_struct.size + entry_struct.size * slot)
+            if key_id != empty_slot:
+                yield self.get_string(key_id), value
+
+    def _lookup_mapping(self, table_offset: int, mod_path: str) -> str:
+        og_path_id = self._lookup(table_offset, mod_path)
+        if og_path_id is None:
+            return None
+
+        return self.get_string(og_path_id)
+
+    def _get_script_record(self, script_name: str) -> tuple[int, int]:
+        script_record_offset = self._lookup(self.script_table_offset, script_name)
+        if script_record_offset is None:
+            return None
+
+        return script_record_struct.unpack_from(self.data, script_record_offset)
+
+    def lookup_global_fallback(self, mod_path: str) -> str:
+        return self._lookup_mapping(self.global_fallback_offset, mod_path)
+
+    def lookup_script_fallback(self, script_name: str, mod_path: str) -> str:
+        script_record = self._get_script_record(script_name)
+        if script_record is None:
+            return None
+
+        script_fallback_offset, _ = script_record
+        return self._lookup_mapping(script_fallback_offset, mod_path)
+
+    def lookup_voice(self, script_name: str, voice: str, mod_path: str) -> str:
+        script_record = self._get_script_record(script_name)
+        if script_record is None:
+            return None
+
+        _, voice_table_offset = script_record
+        mapping_offset = self._lookup(voice_table_offset, voice)
+        if mapping_offset is None:
+            return None
+
+        return self._lookup_mapping(mapping_offset, mod_path)
+
+    def resolve(self, script_name: str, voice: str, mod_path: str) -> str:
+        """Same as 'comment_lookup' in mapping.json: check the voice database, then the script fallback, then the global fallback"""
+        for og_path in [
+            self.lookup_voice(script_name, voice, mod_path),
+            self.lookup_script_fallback(script_name, mod_path),
+            self.lookup_global_fallback(mod_path)
+        ]:
+            if og_path is not None:
+                return og_path
+
+        return None
+
+    def to_dict(self) -> dict:
+        """Read the whole file back into the same structure as mapping.json (without the comments)"""
+        voice_database = {}
+        script_fallback = {}
+        for script_name, script_record_offset in self._iterate_table(self.script_table_offset):
+            script_fallback_offset, voice_table_offset = script_record_struct.unpack_from(self.data, script_record_offset)
+            script_fallback[script_name] = {mod_path: self.get_string(og_path_id) for mod_path, og_path_id in self._iterate_table(script_fallback_offset)}
+            voice_database[script_name] = {}
+            for voice, mapping_offset in self._iterate_table(voice_table_offset):
+                voice_database[script_name][voice] = {mod_path: self.get_string(og_path_id) for mod_path, og_path_id in self._iterate_table(mapping_offset)}
+
+        return {
+            'global_fallback': {mod_path: self.get_string(og_path_id) for mod_path, og_path_id in self._iterate_table(self.global_fallback_offset)},
+            'script_fallback': script_fallback,
+            'voice_database': voice_database,
+        }
+
+
+def verify_binary_mapping(json_path: str, binary_path: str):
+    """Check the binary mapping contains exactly the same data as the mapping.json, and every lookup gives the same result"""
+    with open(json_path, encoding='utf-8') as f:
+        mapping = json.load(f)
+
+    with BinaryMappingReader(binary_path) as reader:
+        expected = {key: mapping[key] for key in ['global_fallback', 'script_fallback', 'voice_database']}
+        # Scripts which only have a voice database have an empty script fallback in the binary file
+        for script_name in mapping['voice_database']:
+            expected['script_fallback'].setdefault(script_name, {})
+
+        if reader.to_dict() != expected:
+            raise Exception(f"Binary mapping [{binary_path}] does not contain the same data as [{json_path}]")
+
+        for mod_path, og_path in mapping['global_fallback'].items():
+            if reader.lookup_global_fallback(mod_path) != og_path:
+                raise Exception(f"Binary mapping [{binary_path}] global fallback lookup failed for [{mod_path}]")
+
+        for script_name, voice_database in mapping['voice_database'].items():
+            script_fallback = mapping['script_fallback'].get(script_name, {})
+            for mod_path, og_path in script_fallback.items():
+                if reader.lookup_script_fallback(script_name, mod_path) != og_path:
+                    raise Exception(f"Binary mapping [{binary_path}] script fallback lookup failed for [{script_name}] [{mod_path}]")
+
+            for voice, voice_mapping in voice_database.items():
+                for mod_path, og_path in voice_mapping.items():
+                    if reader.resolve(script_name, voice, mod_path) != og_path:
+                        raise Exception(f"Binary mapping [{binary_path}] lookup failed for [{script_name}] [{voice}] [{mod_path}]")
+
+        if reader.resolve('<not a script>', '<not a voice>', '<not a mod path>') is not None:
+            raise Exception(f"Binary mapping [{binary_path}] found a mapping for a path which doesn't exist")
+
+    print(f"Verified binary mapping [{binary_path}] ({Path(binary_path).stat().st_size} bytes) against [{json_path}]")
@@ -0,0 +1,183 @@
+import bisect
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+from common import write_file_atomic
+import path_util
+
+# Index of every file under a CG folder, saved in cg_index_folder so the whole tree doesn't need to be listed on every run.
+# Each directory's listing is saved with its modified time, and is only listed again if the modified time changed
+# (adding, removing or renaming a file changes the modified time of the folder containing it).
+# Every directory is still checked with stat() on each run, as a change deep in the tree doesn't change the parent folders.
+
+cg_index_folder = 'cg_index'
+
+format_version = 1
+
+# A directory modified this soon before it was listed may have been modified again within the same timestamp, so is always listed again
+racy_mtime_window_ns = 2 * 1000 * 1000 * 1000
+
+
+def get_cg_index_path(root: str) -> str:
+    os.makedirs(cg_index_folder, exist_ok=True)
+    # Different CG folders usually have the same name, so include a hash of the full path
+    root_hash = hashlib.sha1(str(Path(root).resolve()).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cg_index_folder, f'{Path(root).name}_{root_hash}.json')
+
+
+class CGIndex:
+    def __init__(self, root: str):
+        self.root = root
+        # Directory path relative to root ('' for the root itself) -> [modified time (ns), file names, subdirectory names]
+        self.dirs = {} #type: dict[str, list]
+        # When the directories were last listed
+        self.refreshed_at_ns = 0
+        # Number of directories listed by the last refresh()
+        self.dirs_listed = 0
+
+        # Lookups, built from self.dirs by _build_lookups()
+        self.all_files = [] #type: list[str]
+        self.lc_stem_to_files = {} #type: dict[str, list[str]]
+
+    def refresh(self):
+        """Update the index to match the file system, only listing directories which changed"""
+        refresh_started_at_ns = time.time_ns()
+        new_dirs = {}
+        self.dirs_listed = 0
+
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            full_dir = os.path.join(self.root, relative_dir)
+            try:
+                mtime_ns = os.stat(full_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+
+            previous = self.dirs.get(relative_dir, None)
+            if previous is not None and previous[0] == mtime_ns and mtime_ns < self.refreshed_at_ns - racy_mtime_window_ns:
+                _, files, subdirs = previous
+            else:
+                files, subdirs = [], []
+                with os.scandir(full_dir) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.name)
+                        else:
+                            files.append(entry.name)
+                files.sort()
+                subdirs.sort()
+                self.dirs_listed += 1
+
+            new_dirs[relative_dir] = [mtime_ns, files, subdirs]
+            for subdir in subdirs:
+                pending.append(f'{relative_dir}/{subdir}' if relative_dir else subdir)
+
+        self.dirs = new_dirs
+        self.refreshed_at_ns = refresh_started_at_ns
+        self._build_lookups()
+
+    def _build_lookups(self):
+        self.all_files = []
+        for relative_dir, (_, files, _) in self.dirs.items():
+            for file_name in files:
+                self.all_files.append(f'{relative_dir}/{file_name}' if relative_dir else file_name)
+        self.all_files.sort()
+
+        self.lc_stem_to_files = {}
+        for relative_path in self.all_files:
+            self.lc_stem_to_files.setdefault(Path(relative_path).stem.lower(), []).append(relative_path)
+
+    def get_full_path(self, relative_path: str) -> Path:
+        return Path(self.root) / relative_path
+
+    def find_stem(self, stem: str) -> list[str]:
+        """All files with this name (without the extension, case insensitive), as paths relative to the root"""
+        return self.lc_stem_to_files.get(stem.lower(), [])
+
+    def find_prefix(self, prefix: str) -> list[str]:
+        """All files whose path relative to the root starts with prefix (eg. 'bg/mura/hi')"""
+        start = bisect.bisect_left(self.all_files, prefix)
+        end = start
+        while end < len(self.all_files) and self.all_files[end].startswith(prefix):
+            end += 1
+
+        return self.all_files[start:end]
+
+    def list_folder(self, relative_dir: str) -> tuple[list[str], list[str]]:
+        """The (file names, subdirectory names) directly inside a folder, or empty lists if it doesn't exist"""
+        relative_dir = relative_dir.strip('/')
+        if relative_dir not in self.dirs:
+            return [], []
+
+        _, files, subdirs = self.dirs[relative_dir]
+        return files, subdirs
+
+    def lc_name_to_path(self, exclude: list[str] = None) -> tuple[dict[str, Path], dict[str, list[Path]]]:
+        """Same as path_util.lc_name_to_path() (only files with an extension). Also returns the names which
+        more than one file has (lower case name -> all of those files). The last of those files in path order is used"""
+        exclude = [ex.replace('\\', '/') for ex in exclude] if exclude is not None else None
+
+        lc_name_to_path = {}
+        collisions = {}
+        for relative_path in self.all_files:
+            if '.' not in Path(relative_path).name:
+                continue
+
+            full_path = self.get_full_path(relative_path)
+            if path_util.should_exclude(str(full_path), exclude):
+                continue
+
+            lc_name = full_path.stem.lower()
+            if lc_name in lc_name_to_path:
+                collisions.setdefault(lc_name, [lc_name_to_path[lc_name]]).append(full_path)
+            lc_name_to_path[lc_name] = full_path
+
+        return lc_name_to_path, collisions
+
+    def to_json(self):
+        return {
+            'format_version': format_version,
+            'root': self.root,
+            'refreshed_at_ns': self.refreshed_at_ns,
+            'dirs': self.dirs,
+        }
+
+    @staticmethod
+    def from_json(data) -> 'CGIndex':
+        index = CGIndex(data['root'])
+        index.refreshed_at_ns = data['refreshed_at_ns']
+        index.dirs = data['dirs']
+        return index
+
+
+def load_cg_index(root: str) -> CGIndex:
+    """Load the saved index of a CG folder, refresh it, and save it again if anything changed"""
+    if not os.path.exists(root):
+        raise Exception(f"CG folder [{root}] does not exist")
+
+    index_path = get_cg_index_path(root)
+    index = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data['format_version'] == format_version and data['root'] == root:
+                index = CGIndex.from_json(data)
+        except json.JSONDecodeError:
+            # Rebuilt from scratch below
+            pass
+
+    if index is None:
+        index = CGIndex(root)
+
+    previous_dirs = index.dirs
+    index.refresh()
+
+    if index.dirs_listed > 0 or index.dirs != previous_dirs:
+        write_file_atomic(index_path, json.dumps(index.to_json()))
+
+    return index
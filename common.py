@@ -1,3 +1,6 @@
+import hashlib
+import json
+import logging
 import os
 from pathlib import Path
 import pickle
@@ -5,9 +8,26 @@ import re
 import graphics_identifier
 import character_database
 
+logger = logging.getLogger(__name__)
+
 missing_character_key = "ERROR_MISSING_CHARACTER"
 
 
+def write_file_atomic(output_path: str, contents):
+    """Write str or bytes to a file, so that the file is either fully written or left unchanged (eg. if the script is interrupted)"""
+    output_path = Path(output_path)
+    # The pid is included so that separate processes never write to the same temporary file
+    temp_path = output_path.with_suffix(output_path.suffix + f'.{os.getpid()}.tmp')
+    if isinstance(contents, bytes):
+        with open(temp_path, 'wb') as f:
+            f.write(contents)
+    else:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(contents)
+
+    os.replace(temp_path, output_path)
+
+
 modSpritePathCharacterNameRegex = re.compile(
     r'((?:sprite)|(?:portrait))/([a-zA-Z]*)')
 
@@ -89,6 +109,19 @@ class ModToOGMatch:
     def __init__(self, og_calldata, og_path) -> None:
         self.og_calldata = og_calldata #type: CallData
         self.og_path = og_path #type: str
+        # Name of the matching strategy which found this match (set by parse_graphics() in main.py)
+        self.strategy = None #type: str
+
+    def __setstate__(self, state):
+        # Matches saved by older versions don't record the strategy
+        self.strategy = None
+        self.__dict__.update(state)
+
+    def __str__(self) -> str:
+        if self.og_calldata is not None:
+            return f"og_path: {self.og_calldata.path} line: {self.og_calldata.line.strip()}"
+        else:
+            return f"og_path: {self.og_path}"
 
 class VoiceBasedMatch:
     def __init__(self, voice: str, mod_calldata: CallData, og_match: ModToOGMatch):
@@ -105,6 +138,17 @@ class VoiceBasedMatch:
         self.debug_mod_calldata = mod_calldata
         self.debug_og_match = og_match
 
+    @staticmethod
+    def from_paths(voice: str, mod_path: str, og_path: str) -> 'VoiceBasedMatch':
+        """Create a match without debug data, as loaded from a saved database"""
+        match = VoiceBasedMatch.__new__(VoiceBasedMatch)
+        match.voice = voice
+        match.mod_path = mod_path
+        match.og_path = og_path
+        match.debug_mod_calldata = None
+        match.debug_og_match = None
+        return match
+
 class VoiceMatchDatabase:
     def __init__(self, script_name: str):
         # Name of the script this voice based match database was extracted from
@@ -113,55 +157,232 @@ class VoiceMatchDatabase:
         # self.all_voices = [] #type: list[VoiceBasedMatch]
         # Mapping of voice -> list of associated matches for that voice
         self.db = {} #type: dict[str, list[VoiceBasedMatch]]
+        # Hash of the script, and of the lines in each voice section, the last time the whole script was scanned.
+        # These are used to skip unchanged scripts/voice sections when scanning incrementally
+        self.script_hash = None #type: str
+        self.voice_section_hashes = {} #type: dict[str, str]
+        # (voice, mod path) -> position of the match in self.db[voice], so lookups don't need to scan the whole voice section
+        self.index = {} #type: dict[tuple[str, str], int]
+        # (voice, stripped mod path) -> position of the first match with that stripped mod path
+        self.stripped_index = {} #type: dict[tuple[str, str], int]
+        # The debug data (debug_mod_calldata and debug_og_match of each match) is saved in a separate file, and only loaded when needed
+        self.debug_data_path = None #type: str
+        self.debug_data_loaded = True
+        # Written to both the database and the debug file when saving, so debug data from a different save is never attached
+        self.debug_data_id = None #type: str
+
+    def __setstate__(self, state):
+        # Databases saved by older versions may be missing some attributes, so start with the defaults
+        self.__init__(state['script_name'])
+        self.__dict__.update(state)
+        self.rebuild_index()
+
+    def rebuild_index(self):
+        self.index = {}
+        self.stripped_index = {}
+        for voice, match_array in self.db.items():
+            for i, match in enumerate(match_array):
+                self._add_to_index(voice, match.mod_path, i)
+
+    def _add_to_index(self, voice: str, mod_path: str, position: int):
+        self.index[(voice, mod_path)] = position
+        self.stripped_index.setdefault((voice, mod_path.strip()), position)
+
+    def _remove_voice_from_index(self, voice: str):
+        for match in self.db.get(voice, []):
+            self.index.pop((voice, match.mod_path), None)
+            self.stripped_index.pop((voice, match.mod_path.strip()), None)
 
     def set(self, match: VoiceBasedMatch):
         # if self.try_get(match.voice, match.mod_path):
         #     print(f"ERROR: [{match.voice}-{match.mod_path}] already exists in DB. Not adding")
         #     return
 
+        # Debug data is matched to each match by position, so it must be loaded before anything changes
+        self.load_debug_data()
+
         if match.voice not in self.db:
             self.db[match.voice] = []
 
         match_array = self.db[match.voice]
 
         # Check if entry already exists - if so, overwrite it and return
-        for i in range(len(match_array)):
-            previous_match = match_array[i]
-            if previous_match.mod_path == match.mod_path:
-                match_array[i] = match
-                return
+        position = self.index.get((match.voice, match.mod_path), None)
+        if position is not None:
+            match_array[position] = match
+            return
 
         # Otherwise add a new entry
         match_array.append(match)
+        self._add_to_index(match.voice, match.mod_path, len(match_array) - 1)
 
     def try_get(self, voice: str, mod_path: str) -> VoiceBasedMatch:
-        if voice not in self.db:
+        position = self.index.get((voice, mod_path), None)
+        if position is None:
+            return None
+
+        return self.db[voice][position]
+
+    def try_get_stripped(self, voice: str, stripped_mod_path: str) -> VoiceBasedMatch:
+        """Like try_get(), but ignores leading/trailing whitespace in the database's mod paths. Returns the first such match"""
+        position = self.stripped_index.get((voice, stripped_mod_path), None)
+        if position is None:
             return None
 
-        matches_for_voice = self.db[voice]
-        for match in matches_for_voice:
-            if match.mod_path == mod_path:
-                return match
+        return self.db[voice][position]
+
+    def clear_voice(self, voice: str):
+        """Remove all matches for a voice, but keep the voice itself"""
+        self.load_debug_data()
+        self._remove_voice_from_index(voice)
+        self.db[voice] = []
+
+    def reorder_voices(self, voice_order: list[str]):
+        """Put the voice sections in the given order. Voices which are not in voice_order are removed"""
+        self.load_debug_data()
+        for voice in set(self.db) - set(voice_order):
+            self._remove_voice_from_index(voice)
+
+        self.db = {voice: self.db.get(voice, []) for voice in voice_order}
 
     # This is used to make sure all voices are covered
     # The final output can be trimmed of 'blank' voice sections later
     def acknowledge_voice(self, voice: str):
+        self.load_debug_data()
         if voice not in self.db:
             self.db[voice] = []
 
+    def load_debug_data(self):
+        """Attach the debug data from the debug file to each match, if not already loaded"""
+        if self.debug_data_loaded:
+            return
+
+        self.debug_data_loaded = True
+        if not Path(self.debug_data_path).exists():
+            logger.warning("Voice database debug file [%s] is missing, debug data will be empty", self.debug_data_path)
+            return
+
+        with open(self.debug_data_path, 'rb') as f:
+            debug_file_data = pickle.load(f)
+
+        # The debug data is attached by position, so it must come from the same save as the database
+        # (a save may have been interrupted between writing the two files)
+        if not isinstance(debug_file_data, dict) or debug_file_data['debug_data_id'] != self.debug_data_id:
+            logger.warning("Voice database debug file [%s] does not belong to the database, debug data will be empty", self.debug_data_path)
+            return
+
+        debug_data_per_voice = debug_file_data['debug_data'] #type: list[list[tuple[CallData, ModToOGMatch]]]
+        for match_array, debug_data in zip(self.db.values(), debug_data_per_voice):
+            for match, (debug_mod_calldata, debug_og_match) in zip(match_array, debug_data):
+                match.debug_mod_calldata = debug_mod_calldata
+                match.debug_og_match = debug_og_match
+
     def serialize(self, output_file: str):
-        # TODO: This should really be done atomically, but since
-        # this script will rarely be executed don't worry about it for now
-        with open(output_file, 'wb') as f:
-            pickle.dump(self, f)
+        """Save the database as compact json (only the voice, mod path and og path of each match), and the debug data to a separate file"""
+        # Otherwise the debug data of the existing matches would be lost
+        self.load_debug_data()
+
+        # Each distinct string is only stored once, and referred to by its index
+        strings = []
+        string_ids = {}
+        def get_string_id(value):
+            if value is None:
+                return None
+
+            value = str(value)
+            if value not in string_ids:
+                string_ids[value] = len(strings)
+                strings.append(value)
+
+            return string_ids[value]
+
+        voices = []
+        for voice, match_array in self.db.items():
+            # Stored as [mod path id, og path id, mod path id, og path id...]
+            match_ids = []
+            for match in match_array:
+                match_ids.append(get_string_id(match.mod_path))
+                match_ids.append(get_string_id(match.og_path))
+            voices.append([get_string_id(voice), match_ids])
+
+        data = {
+            'format_version': voice_db_format_version,
+            'script_name': str(self.script_name),
+            'script_hash': self.script_hash,
+            # Voices are stored in lists rather than as dict keys, as the None voice is not a valid json key
+            'voice_section_hashes': list(self.voice_section_hashes.items()),
+            'strings': strings,
+            'voices': voices,
+        }
+
+        # Identifies this save in both files (see load_debug_data())
+        self.debug_data_id = hashlib.sha256(json.dumps(data, separators=(',', ':')).encode('utf-8')).hexdigest()
+        data['debug_data_id'] = self.debug_data_id
+
+        debug_file_data = {
+            'debug_data_id': self.debug_data_id,
+            'debug_data': [[(match.debug_mod_calldata, match.debug_og_match) for match in match_array] for match_array in self.db.values()],
+        }
+
+        write_file_atomic(get_voice_db_debug_path(output_file), pickle.dumps(debug_file_data))
+        write_file_atomic(output_file, json.dumps(data, separators=(',', ':')))
+
+    @staticmethod
+    def deserialize(input_file: str, load_debug_data: bool = False) -> 'VoiceMatchDatabase':
+        # Fall back to a database saved by an older version (see deserialize_legacy())
+        legacy_input_file = Path(input_file).with_suffix('.pickle')
+        if not Path(input_file).exists() and legacy_input_file.exists():
+            logger.warning("Loading legacy voice database [%s] (it will be converted the next time it is saved)", legacy_input_file)
+            return VoiceMatchDatabase.deserialize_legacy(str(legacy_input_file))
+
+        with open(input_file, encoding='utf-8') as f:
+            data = json.load(f)
+
+        if data['format_version'] != voice_db_format_version:
+            raise Exception(f"Voice database [{input_file}] has format version {data['format_version']}, but expected {voice_db_format_version}")
+
+        strings = data['strings']
+        database = VoiceMatchDatabase(data['script_name'])
+        database.script_hash = data['script_hash']
+        database.debug_data_id = data.get('debug_data_id', None)
+        database.voice_section_hashes = {voice: h for voice, h in data['voice_section_hashes']}
+        for voice_id, match_ids in data['voices']:
+            voice = None if voice_id is None else strings[voice_id]
+            match_array = []
+            for i in range(0, len(match_ids), 2):
+                og_path_id = match_ids[i + 1]
+                og_path = None if og_path_id is None else strings[og_path_id]
+                match_array.append(VoiceBasedMatch.from_paths(voice, strings[match_ids[i]], og_path))
+            database.db[voice] = match_array
+
+        database.rebuild_index()
+        database.debug_data_path = get_voice_db_debug_path(input_file)
+        database.debug_data_loaded = False
+
+        if load_debug_data:
+            database.load_debug_data()
+
+        return database
 
     @staticmethod
-    def deserialize(input_file: str) -> 'VoiceMatchDatabase':
-        with open(input_file, 'rb') as f:
+    def deserialize_legacy(legacy_input_file: str) -> 'VoiceMatchDatabase':
+        """Load a database saved by an older version, as a pickle of the whole database (including the debug data)"""
+        with open(legacy_input_file, 'rb') as f:
             return pickle.load(f)
 
+    @staticmethod
+    def exists(input_file: str) -> bool:
+        """True if a database (or a legacy database which can still be loaded) exists at this path"""
+        return Path(input_file).exists() or Path(input_file).with_suffix('.pickle').exists()
+
 voice_db_folder = 'voice_db'
 
+# Increase this if the format written by VoiceMatchDatabase.serialize() changes
+voice_db_format_version = 1
+
 def get_voice_db_path(mod_script_path: str) -> str:
     os.makedirs(voice_db_folder, exist_ok=True)
-    return os.path.join(voice_db_folder, f'{Path(mod_script_path).stem}_voice_db.pickle')
+    return os.path.join(voice_db_folder, f'{Path(mod_script_path).stem}_voice_db.json')
+
+def get_voice_db_debug_path(voice_db_path: str) -> str:
+    return str(Path(voice_db_path).with_suffix('.debug.pickle'))
@@ -8,6 +8,10 @@ def load_and_combine_stats(stats_folder: str) -> dict[str, dict[str, int]]:
     combined_stats = {}
 
     for stats_path in Path(stats_folder).glob(glob_pattern):
+        # Matching strategy statistics are saved next to the stats, but aren't needed here
+        if stats_path.name.endswith('.strategies.json'):
+            continue
+
         with open(stats_path, encoding='utf-8') as f:
             stats = json.load(f) #type: dict[str, dict[str, int]]
 
@@ -0,0 +1,222 @@
+import atexit
+import contextlib
+import os
+import subprocess
+import threading
+from pathlib import Path
+
+
+# Number of 'git cat-file --batch' processes kept open per repository
+default_pool_size = 2
+
+
+class StderrReader:
+    """Reads all of a process's stderr on a separate thread, then closes it. Otherwise git could block writing
+    warnings to a full stderr pipe, while we wait for its stdout"""
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
+        self.output = ''
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def _read(self):
+        output = self.process.stderr.read()
+        self.process.stderr.close()
+        self.output = output.decode('utf-8', errors='replace') if isinstance(output, bytes) else output
+
+    def get_output(self) -> str:
+        """Wait for the process to close stderr (usually when it exits), and return everything it wrote"""
+        self.thread.join()
+        return self.output
+
+
+class CatFileWorker:
+    """A long running 'git cat-file --batch' process. Object names are written to its stdin, and their contents read back from stdout"""
+    def __init__(self, repository_dir: str):
+        self.process = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=repository_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.stderr_reader = StderrReader(self.process)
+
+    def read_objects(self, object_names: list[str]) -> list[bytes]:
+        """Returns the contents of each object, or None if the object does not exist"""
+        # Write all requests from a separate thread while reading the responses, so that neither pipe can fill up and block
+        def write_requests():
+            for object_name in object_names:
+                self.process.stdin.write(object_name.encode('utf-8') + b'\n')
+            self.process.stdin.flush()
+
+        writer = threading.Thread(target=write_requests)
+        writer.start()
+
+        all_contents = []
+        for object_name in object_names:
+            header = self.process.stdout.readline()
+            if not header:
+                raise Exception(f"git cat-file exited unexpectedly while reading [{object_name}]: {self.stderr_reader.get_output()}")
+
+            # Header is either '<oid> <type> <size>' or '<object name> missing'
+            header_parts = header.decode('utf-8').rstrip('\n').rsplit(' ', maxsplit=2)
+            if len(header_parts) != 3 or not header_parts[2].isdigit():
+                all_contents.append(None)
+                continue
+
+            size = int(header_parts[2])
+            contents = self.process.stdout.read(size)
+            # Each object's contents are followed by a newline
+            self.process.stdout.read(1)
+            all_contents.append(contents)
+
+        writer.join()
+
+        return all_contents
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+        self.stderr_reader.get_output()
+        self.process.stdout.close()
+
+
+class GitOutputStream:
+    """The output of a git command, line by line (without the newline) as git produces it"""
+    def __init__(self, process: subprocess.Popen):
+        self.process = process
+        self.finished = False
+
+    def __iter__(self):
+        for line in self.process.stdout:
+            yield line.rstrip('\n')
+
+        self.finished = True
+
+
+class GitRepository:
+    """Access to the history of one git repository.
+
+    Object reads go through a small pool of persistent 'git cat-file --batch' processes, so they avoid
+    the cost of starting git, opening the repository and loading pack indexes for every query.
+    Other commands (like 'git log') can't be kept running between queries, so are run as one-off processes,
+    but without going through the shell. The line alignment only runs these once per script (and once per parent
+    of each merge commit), but 'git log -L' queries (used when line alignment is off, or to verify it) still start
+    one process per query.
+    """
+    def __init__(self, repository_dir: str, pool_size: int = default_pool_size):
+        self.repository_dir = repository_dir
+        self.pool_size = pool_size
+        self.idle_workers = [] #type: list[CatFileWorker]
+        self.all_workers = [] #type: list[CatFileWorker]
+        self.pool_lock = threading.Lock()
+        self.worker_available = threading.Condition(self.pool_lock)
+
+    def _acquire_worker(self) -> CatFileWorker:
+        with self.pool_lock:
+            while not self.idle_workers:
+                # Workers are only started when needed
+                if len(self.all_workers) < self.pool_size:
+                    worker = CatFileWorker(self.repository_dir)
+                    self.all_workers.append(worker)
+                    return worker
+
+                self.worker_available.wait()
+
+            return self.idle_workers.pop()
+
+    def _release_worker(self, worker: CatFileWorker):
+        with self.pool_lock:
+            self.idle_workers.append(worker)
+            self.worker_available.notify()
+
+    def read_objects(self, object_names: list[str]) -> list[bytes]:
+        """Read many objects (like 'HEAD:path/to/file.txt') at once. Returns None for objects which don't exist"""
+        worker = self._acquire_worker()
+        try:
+            return worker.read_objects(object_names)
+        finally:
+            self._release_worker(worker)
+
+    def read_object(self, object_name: str) -> bytes:
+        return self.read_objects([object_name])[0]
+
+    def read_file(self, revision: str, file_path: str) -> str:
+        """Read the text of a file as it was at the given revision"""
+        object_name = f'{revision}:{self.get_repository_path(file_path)}'
+        contents = self.read_object(object_name)
+        if contents is None:
+            raise Exception(f"Object [{object_name}] does not exist in git repository [{self.repository_dir}]")
+
+        return contents.decode('utf-8')
+
+    def get_repository_path(self, file_path: str) -> str:
+        """Convert a file path to a path relative to the root of the repository, as used in git object names"""
+        return Path(os.path.relpath(os.path.abspath(file_path), self.repository_dir)).as_posix()
+
+    def run(self, args: list[str], cwd: str = None) -> str:
+        p = subprocess.run(['git'] + args, capture_output=True, encoding='utf-8', cwd=cwd or self.repository_dir, check=True)
+        return p.stdout
+
+    @contextlib.contextmanager
+    def stream(self, args: list[str], cwd: str = None):
+        """Run a git command, and read its output while it is running (see GitOutputStream).
+        If the caller stops reading early, git is killed rather than left to produce the rest of its output"""
+        process = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', cwd=cwd or self.repository_dir)
+        stderr_reader = StderrReader(process)
+        output = GitOutputStream(process)
+        try:
+            yield output
+        finally:
+            if output.finished:
+                process.wait()
+                stderr = stderr_reader.get_output()
+            else:
+                # stderr is only needed if git failed. Don't wait for it here, as it stays open if git started any
+                # child processes. The reader thread closes it once they have all exited
+                process.kill()
+                process.wait()
+
+            process.stdout.close()
+
+        if output.finished and process.returncode != 0:
+            raise Exception(f"git {' '.join(args)} failed with exit code {process.returncode}: {stderr}")
+
+    def close(self):
+        with self.pool_lock:
+            for worker in self.all_workers:
+                worker.close()
+
+            self.all_workers = []
+            self.idle_workers = []
+
+
+# Repositories (and their worker processes) belong to the process which opened them,
+# so a process created by fork must not use its parent's repositories
+_repositories = {} #type: dict[str, GitRepository]
+_repositories_pid = None
+_repositories_lock = threading.Lock()
+_toplevel_per_dir = {} #type: dict[str, str]
+
+def get_repository(path: str) -> GitRepository:
+    """Get the repository containing the given folder. Only one GitRepository is opened per repository per process"""
+    global _repositories, _repositories_pid, _toplevel_per_dir
+
+    with _repositories_lock:
+        if _repositories_pid != os.getpid():
+            _repositories = {}
+            _toplevel_per_dir = {}
+            _repositories_pid = os.getpid()
+
+        path = os.path.abspath(path)
+        if path not in _toplevel_per_dir:
+            p = subprocess.run(['git', 'rev-parse', '--show-toplevel'], capture_output=True, encoding='utf-8', cwd=path, check=True)
+            _toplevel_per_dir[path] = os.path.abspath(p.stdout.strip())
+
+        toplevel = _toplevel_per_dir[path]
+        if toplevel not in _repositories:
+            _repositories[toplevel] = GitRepository(toplevel)
+
+        return _repositories[toplevel]
+
+def close_all_repositories():
+    if _repositories_pid == os.getpid():
+        for repository in _repositories.values():
+            repository.close()
+
+atexit.register(close_all_repositories)
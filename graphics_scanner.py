@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import cg_index
+from script_tokenizer import VoiceEvent, StringEvent
+
+# Finds the graphics paths in a modded script for verification_and_fallback_matching.py, from the events of script_tokenizer.
+# A quoted string is a graphics path if it is the name of a file in the top level of the modded CG folder (eg. 'black'),
+# or starts with the name of a folder in the top level followed by '/' (eg. 'sprite/kei7_warai_').
+# This is the same as matching each string against a regex per top level entry (^name$ or ^name/), using set lookups instead.
+
+
+class GraphicsPathClassifier:
+    def __init__(self, top_level_files: list[str], top_level_folders: list[str]):
+        self.file_names = set(Path(file).stem for file in top_level_files)
+        self.folder_names = set(Path(folder).stem for folder in top_level_folders)
+
+    def is_graphics(self, path: str) -> bool:
+        if path in self.file_names:
+            return True
+
+        folder, separator, _ = path.partition('/')
+        return separator != '' and folder in self.folder_names
+
+    @staticmethod
+    def from_cg_folder(modded_game_cg_dir: str) -> 'GraphicsPathClassifier':
+        if not Path(modded_game_cg_dir).exists():
+            raise Exception("Modded game CG folder does not exist!")
+
+        files, folders = cg_index.load_cg_index(modded_game_cg_dir).list_folder('')
+        return GraphicsPathClassifier(files, folders)
+
+
+def iter_graphics_paths(events, classifier: GraphicsPathClassifier):
+    """Yields (last voice, graphics path) for each graphics path in the events of a script, with leading/trailing whitespace removed"""
+    last_voice = None
+
+    for event in events:
+        if isinstance(event, VoiceEvent):
+            last_voice = event.voice
+        elif isinstance(event, StringEvent):
+            stripped_path = event.data.strip()
+            if classifier.is_graphics(stripped_path):
+                yield last_voice, stripped_path
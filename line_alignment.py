@@ -0,0 +1,276 @@
+import bisect
+import re
+
+import git_access
+
+
+# Matches a unified diff hunk header like '@@ -12,3 +14,0 @@'. Counts are omitted by git when they are 1
+hunk_header_regex = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class Hunk:
+    def __init__(self, old_start: int, old_count: int, new_start: int, new_count: int) -> None:
+        # Note: if a count is 0, git reports the start as the line *before* the (empty) range
+        self.old_start = old_start
+        self.old_count = old_count
+        self.new_start = new_start
+        self.new_count = new_count
+
+    def old_begin(self) -> int:
+        return self.old_start if self.old_count > 0 else self.old_start + 1
+
+    def new_begin(self) -> int:
+        return self.new_start if self.new_count > 0 else self.new_start + 1
+
+
+def parse_hunks(diff_lines: list[str]) -> list[Hunk]:
+    hunks = []
+    for line in diff_lines:
+        match = hunk_header_regex.match(line)
+        if match:
+            old_count = 1 if match.group(2) is None else int(match.group(2))
+            new_count = 1 if match.group(4) is None else int(match.group(4))
+            hunks.append(Hunk(int(match.group(1)), old_count, int(match.group(3)), new_count))
+
+    return hunks
+
+
+class CommitLineMap:
+    """Maps line numbers after a single commit to the range of line numbers before it, using that commit's hunks"""
+    def __init__(self, hunks: list[Hunk]):
+        self.hunks = hunks
+        self.hunk_new_begins = [hunk.new_begin() for hunk in hunks]
+
+    def map_line(self, line_no: int) -> tuple[int, int]:
+        """Returns a half-open range of line numbers before the commit. Empty if the line was inserted by the commit"""
+        hunk_index = bisect.bisect_right(self.hunk_new_begins, line_no) - 1
+
+        if hunk_index < 0:
+            return (line_no, line_no + 1)
+
+        hunk = self.hunks[hunk_index]
+
+        # A line inside a changed hunk maps to the whole pre-image of that hunk
+        if line_no < hunk.new_begin() + hunk.new_count:
+            return (hunk.old_begin(), hunk.old_begin() + hunk.old_count)
+
+        # Otherwise the line is unchanged, so just offset it by the size of the previous hunks
+        offset = (hunk.old_begin() + hunk.old_count) - (hunk.new_begin() + hunk.new_count)
+        return (line_no + offset, line_no + offset + 1)
+
+    def map_range(self, line_range: tuple[int, int]) -> tuple[int, int]:
+        start, end = line_range
+        mapped_start = None
+        mapped_end = None
+
+        for line_no in range(start, end):
+            line_start, line_end = self.map_line(line_no)
+            if line_start == line_end:
+                continue
+
+            if mapped_start is None:
+                mapped_start = line_start
+
+            mapped_end = line_end
+
+        if mapped_start is None:
+            return (0, 0)
+
+        return (mapped_start, mapped_end)
+
+
+def union_ranges(ranges) -> tuple[tuple[int, int], ...]:
+    """Sort half-open ranges, joining any which overlap or touch"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    return tuple(merged)
+
+
+class ParentDiff:
+    """The hunks of one commit's diff against one of its parents. parent is None if the commit created the file"""
+    def __init__(self, parent: str, hunks: list[Hunk]):
+        self.parent = parent
+        self.hunks = hunks
+        self.line_map = CommitLineMap(hunks)
+
+    def touches(self, ranges: tuple[tuple[int, int], ...]) -> bool:
+        """True if any line in the ranges was changed, or lines were removed between two lines in the same range (like 'git log -L')"""
+        for hunk in self.hunks:
+            for start, end in ranges:
+                if hunk.new_count > 0:
+                    if hunk.new_begin() < end and start < hunk.new_begin() + hunk.new_count:
+                        return True
+                elif start <= hunk.new_start and hunk.new_start + 1 < end:
+                    return True
+
+        return False
+
+    def map_ranges(self, ranges: tuple[tuple[int, int], ...]) -> tuple[tuple[int, int], ...]:
+        mapped = [self.line_map.map_range(line_range) for line_range in ranges]
+        return union_ranges(line_range for line_range in mapped if line_range[0] != line_range[1])
+
+    def is_unchanged(self) -> bool:
+        return not self.hunks
+
+
+def get_parent_ranges(parent_diffs: list[ParentDiff], ranges: tuple[tuple[int, int], ...]) -> list[tuple[str, tuple[tuple[int, int], ...]]]:
+    """Which parents of a commit 'git log -L' follows a set of line ranges into, and the ranges in each of those parents"""
+    if len(parent_diffs) == 1:
+        return [(parent_diffs[0].parent, parent_diffs[0].map_ranges(ranges))]
+
+    # A merge with the same file as one of its parents is simplified to only that parent, like any path-limited 'git log'
+    for parent_diff in parent_diffs:
+        if parent_diff.is_unchanged():
+            return [(parent_diff.parent, ranges)]
+
+    # Otherwise if one parent didn't change the ranges, it takes all the blame, so the other parents aren't followed
+    for parent_diff in parent_diffs:
+        if not parent_diff.touches(ranges):
+            return [(parent_diff.parent, parent_diff.map_ranges(ranges))]
+
+    return [(parent_diff.parent, parent_diff.map_ranges(ranges)) for parent_diff in parent_diffs]
+
+
+class LineAlignment:
+    """Maps each line of the current (modded) revision of a script to the vanilla lines it was derived from.
+
+    This mimics how 'git log -L' tracks a single line back through each commit to the vanilla commit:
+    - an unchanged line maps to the same line in the parent
+    - a line inside a changed hunk maps to the whole pre-image of that hunk
+    - a purely inserted line maps to nothing, so has no vanilla lines
+    - at a merge, the line is followed into the parents chosen by get_parent_ranges(), so it can reach the vanilla
+      commit as several ranges
+    Only vanilla lines which were actually added by the vanilla commit are returned, the same as get_vanilla_only()
+    in main.py (the '+' lines of the vanilla commit in the git log output)
+    """
+    def __init__(self, vanilla_lines: list[str], commits: list[tuple[str, list[ParentDiff]]], vanilla_commit: str, vanilla_commit_hunks: list[Hunk], current_line_count: int):
+        self.vanilla_lines = vanilla_lines
+
+        # Set of (1-based) line numbers in the vanilla revision which the vanilla commit added or modified
+        self.vanilla_added_lines = set() #type: set[int]
+        for hunk in vanilla_commit_hunks:
+            self.vanilla_added_lines.update(range(hunk.new_begin(), hunk.new_begin() + hunk.new_count))
+
+        # Index 0 is current line 1. Each entry is a set of half-open (1-based) ranges of vanilla line numbers
+        self.current_to_vanilla = [()] * current_line_count #type: list[tuple[tuple[int, int], ...]]
+        if not commits:
+            return
+
+        # Start with every current line mapping to itself in the newest commit, then walk back through the commits
+        # (children always come before their parents). Commit -> current line number -> ranges in that commit
+        pending = {commits[0][0]: {line_no: ((line_no, line_no + 1),) for line_no in range(1, current_line_count + 1)}} #type: dict[str, dict[int, tuple]]
+        for commit_hash, parent_diffs in commits:
+            ranges_per_line = pending.pop(commit_hash, None)
+            if not ranges_per_line:
+                continue
+
+            if commit_hash.startswith(vanilla_commit):
+                for line_no, ranges in ranges_per_line.items():
+                    self.current_to_vanilla[line_no - 1] = ranges
+                continue
+
+            parent_ranges_cache = {} #type: dict[tuple, list]
+            for line_no, ranges in ranges_per_line.items():
+                if ranges not in parent_ranges_cache:
+                    parent_ranges_cache[ranges] = get_parent_ranges(parent_diffs, ranges)
+
+                for parent, parent_ranges in parent_ranges_cache[ranges]:
+                    if parent is None or not parent_ranges:
+                        continue
+
+                    parent_ranges_per_line = pending.setdefault(parent, {})
+                    if line_no in parent_ranges_per_line:
+                        # Reached the same commit through both sides of a merge
+                        parent_ranges = union_ranges(parent_ranges_per_line[line_no] + parent_ranges)
+                    parent_ranges_per_line[line_no] = parent_ranges
+
+    def get_vanilla_lines(self, line_no: int) -> list[str]:
+        """Returns the vanilla lines for the given (1-based) current line number, in the same format as get_vanilla_only()"""
+        if line_no < 1 or line_no > len(self.current_to_vanilla):
+            return []
+
+        diff_lines = []
+        for start, end in self.current_to_vanilla[line_no - 1]:
+            for vanilla_line in range(start, end):
+                if vanilla_line in self.vanilla_added_lines:
+                    diff_lines.append('+' + self.vanilla_lines[vanilla_line - 1])
+
+        return diff_lines
+
+
+def split_commits(log_output: str) -> list[tuple[str, list[str], list[str]]]:
+    """Splits 'git log' output into (commit hash, parent hashes, lines) for each commit"""
+    # Each commit in the log output starts with a NUL character followed by the commit and parent hashes (see the --format used below)
+    all_commits = []
+    for commit_output in log_output.split('\0')[1:]:
+        commit_lines = commit_output.splitlines()
+        commit_hash, *parents = commit_lines[0].split()
+        all_commits.append((commit_hash, parents, commit_lines[1:]))
+
+    return all_commits
+
+
+def split_git_lines(text: str) -> list[str]:
+    """Split the text of a file into lines the same way as git (only '\\n' ends a line, unlike str.splitlines()).
+    A '\\r' before the '\\n' is removed, as the output of 'git log' is read with universal newlines"""
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+
+    return [line.removesuffix('\r') for line in lines]
+
+
+def load_alignment(mod_script_dir: str, mod_script_file: str, vanilla_commit: str, current_revision: str = 'HEAD') -> LineAlignment:
+    repository = git_access.get_repository(mod_script_dir)
+    repository_path = repository.get_repository_path(mod_script_file)
+
+    # A script added after the vanilla commit has no vanilla lines (the same as 'git log -L', which never reaches the vanilla commit)
+    vanilla_contents, current_contents = repository.read_objects([f'{vanilla_commit}:{repository_path}', f'{current_revision}:{repository_path}'])
+    vanilla_lines = split_git_lines(vanilla_contents.decode('utf-8') if vanilla_contents is not None else '')
+    current_line_count = len(split_git_lines(current_contents.decode('utf-8') if current_contents is not None else ''))
+
+    # Get the vanilla commit and every later commit which touched the script (and every merge), children before parents,
+    # with the parents rewritten to skip commits which didn't touch the script.
+    # '<commit>^@' is all parents of the vanilla commit, so this still works if the vanilla commit is the root commit.
+    # Use zero context lines, so that each hunk only contains changed lines. Merges have no diff in this output
+    log_output = repository.run(['log', '--format=%x00%H %P', '-p', '-U0', '--no-color', '--full-history', '--parents', '--topo-order', current_revision, '--not', f'{vanilla_commit}^@', '--', repository_path])
+
+    commits = [] #type: list[tuple[str, list[ParentDiff]]]
+    vanilla_commit_hunks = []
+    for commit_hash, parents, commit_lines in split_commits(log_output):
+        if len(parents) > 1:
+            # Merges are rare, so diff them against each parent separately
+            parent_diffs = []
+            for parent in parents:
+                diff_output = repository.run(['diff', '-U0', '--no-color', parent, commit_hash, '--', repository_path])
+                parent_diffs.append(ParentDiff(parent, parse_hunks(diff_output.splitlines())))
+        else:
+            parent_diffs = [ParentDiff(parents[0] if parents else None, parse_hunks(commit_lines))]
+
+        if commit_hash.startswith(vanilla_commit):
+            # These are the lines which were added by the vanilla commit (the whole file if the commit created it)
+            vanilla_commit_hunks = parent_diffs[0].hunks
+
+        commits.append((commit_hash, parent_diffs))
+
+    return LineAlignment(vanilla_lines, commits, vanilla_commit, vanilla_commit_hunks, current_line_count)
+
+
+# Only the alignment for the script currently being scanned is kept in memory
+_last_alignment_key = None
+_last_alignment = None #type: LineAlignment
+
+def get_alignment(mod_script_dir: str, mod_script_file: str, vanilla_commit: str) -> LineAlignment:
+    global _last_alignment_key, _last_alignment
+
+    key = (str(mod_script_dir), str(mod_script_file), vanilla_commit)
+    if key != _last_alignment_key:
+        _last_alignment = load_alignment(mod_script_dir, mod_script_file, vanilla_commit)
+        _last_alignment_key = key
+
+    return _last_alignment
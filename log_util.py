@@ -0,0 +1,37 @@
+import logging
+import logging.handlers
+import sys
+
+# Output of main.py. Use logger.debug("%s -> %s", a, b) rather than f-strings for messages which are logged often,
+# so the message is only formatted if that level is enabled.
+#   DEBUG: every match, failure and candidate (shown with --verbose)
+#   INFO: a summary of each script
+#   WARNING: problems which need fixing
+
+# Number of messages which are buffered before being written
+buffer_capacity = 1000
+
+_buffered_handler = None #type: logging.handlers.MemoryHandler
+
+def setup_logging(verbose: bool):
+    """Log to stdout, showing only the INFO summaries and warnings unless verbose. When scanning in parallel, call this in each process"""
+    global _buffered_handler
+
+    root_logger = logging.getLogger()
+    if _buffered_handler is not None:
+        root_logger.removeHandler(_buffered_handler)
+        _buffered_handler.close()
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+
+    # Warnings are written immediately, along with everything buffered before them so the order is kept
+    _buffered_handler = logging.handlers.MemoryHandler(buffer_capacity, flushLevel=logging.WARNING, target=stream_handler)
+    root_logger.addHandler(_buffered_handler)
+    root_logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+
+def flush():
+    """Write any buffered messages. Worker processes may exit without flushing, so call this after each script"""
+    if _buffered_handler is not None:
+        _buffered_handler.flush()
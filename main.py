@@ -1,4 +1,6 @@
+import argparse
 import json
+import logging
 import os
 import pathlib
 import hashlib
@@ -8,19 +10,42 @@ import shutil
 import re
 import csv
 import subprocess
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
 
 # User imports
-import path_util
+import cg_index
 import common
 from common import CallData, ModToOGMatch, VoiceBasedMatch, VoiceMatchDatabase
-import voice_util
 import graphics_identifier
+import line_alignment
+import git_access
+from og_lines_cache import OGLinesCache, ScriptOGLinesCache, get_script_hash
+from query_coalescer import QueryCoalescer
+import og_candidates
+from og_candidates import OGCandidateRecord, ScriptOGCandidates, RecordedOGLinesLoader
+import profiling
+import log_util
+import trace_store
+from trace_store import TraceRecord, ScriptTraceWriter
+from scan_journal import ScanJournal
+import script_tokenizer
+from script_tokenizer import ScriptLine
+
+logger = logging.getLogger(__name__)
 
 
 class GlobalResult:
     def __init__(self) -> None:
         self.missing_char_detected = False
+        # Stage timings of the scanned scripts, only if profiling is enabled
+        self.profile = None #type: profiling.Profiler
+
+    def merge(self, other: 'GlobalResult'):
+        self.missing_char_detected = self.missing_char_detected or other.missing_char_detected
+        if other.profile is not None:
+            if self.profile is None:
+                self.profile = profiling.Profiler(enabled=True)
+            self.profile.merge(other.profile)
 
 class Statistics:
     def __init__(self):
@@ -32,17 +57,44 @@ class Statistics:
         self.bg_guesses = {} #type: dict[str, dict[str, list[CallData]]]
         # Keep track of mod sprite path -> list[og path] guesses
         self.sprite_guesses = {} #type: dict[str, dict[str, list[CallData]]]
+        # Number of graphics paths which were matched without needing to load the og lines
+        self.git_calls_avoided = 0
+        # Matching strategy name -> [attempts, hits], for the strategies tried in this run.
+        # The time spent in each strategy is only recorded when profiling (see enable_profiling), so that this output doesn't depend on timing
+        self.strategy_statistics = {strategy.name: [0, 0] for strategy in matching_strategies} #type: dict[str, list]
+        # Matching strategy name -> number of matches it found, including matches kept from a previous run
+        self.matches_by_strategy = {} #type: dict[str, int]
+        # The order the strategies were tried in at the end of the scan (see StrategyOrder)
+        self.strategy_order = [strategy.name for strategy in matching_strategies]
 
     def total(self):
         return self.match_ok + self.match_fail
 
+    def log_summary(self, mod_script_path: str):
+        logger.info("[%s] Matched %d/%d graphics (%d failed, %d missing characters, %d git calls avoided)",
+                    Path(mod_script_path).name, self.match_ok, self.total(), self.match_fail, len(self.missing_character_details), self.git_calls_avoided)
+
+    def add_strategy_attempt(self, strategy_name: str, hit: bool):
+        strategy_statistics = self.strategy_statistics[strategy_name]
+        strategy_statistics[0] += 1
+        if hit:
+            strategy_statistics[1] += 1
+
+    def get_hit_rate(self, strategy_name: str) -> float:
+        attempts, hits = self.strategy_statistics[strategy_name]
+        return hits / attempts if attempts > 0 else 0
+
     def add_match(self, mod_call_data: CallData, og_match: ModToOGMatch):
+        # Matches from older versions don't record which strategy found them
+        strategy_name = og_match.strategy or 'unknown'
+        self.matches_by_strategy[strategy_name] = self.matches_by_strategy.get(strategy_name, 0) + 1
+
         if og_match.og_calldata is None:
             og_name = Path(og_match.og_path).stem
         else:
             og_name = og_match.og_calldata.name
 
-        print(f"{mod_call_data.path} -> {og_name}")
+        logger.debug("%s -> %s", mod_call_data.path, og_name)
 
         if mod_call_data.path not in self.count_statistics:
             self.count_statistics[mod_call_data.path] = {}
@@ -67,7 +119,7 @@ class Statistics:
                 mod_path_dict[og_path] = len(og_list)
 
         json_string = json.dumps(to_dump, sort_keys=True, indent=4)
-        print(json_string)
+        logger.debug("%s", json_string)
 
         with open(output_file_path, 'w', encoding='utf-8') as f:
             f.write(json_string)
@@ -98,10 +150,53 @@ class Statistics:
         Statistics.save_matches(bg_guess_path, self.bg_guesses)
         Statistics.save_matches(sprite_guess_path, self.sprite_guesses)
 
+        self.save_strategy_statistics(Path(output_file_path).with_suffix('.strategies.json'))
+
+    def save_strategy_statistics(self, output_path: str):
+        strategies = {}
+        for strategy_name, (attempts, hits) in self.strategy_statistics.items():
+            strategies[strategy_name] = {
+                'attempts': attempts,
+                'hits': hits,
+                'hit_rate': round(self.get_hit_rate(strategy_name), 4),
+            }
+
+        to_dump = {
+            'strategy_order': self.strategy_order,
+            'strategies': strategies,
+            'matches_by_strategy': dict(sorted(self.matches_by_strategy.items())),
+        }
+
+        with open(output_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(to_dump, indent=4))
+
+    def add_existing_match(self, match: VoiceBasedMatch):
+        """Add a match which was found on a previous run to the statistics"""
+        mod = match.debug_mod_calldata
+        # The debug data is lost if the debug file was missing or from a different save, so only the match result can be counted
+        if mod is None:
+            if match.og_path is None:
+                self.match_fail += 1
+            else:
+                self.match_ok += 1
+            return
+
+        if mod.matching_key is not None and common.missing_character_key in mod.matching_key:
+            self.add_missing_character(mod.matching_key, mod.line, None)
+        elif match.og_path is None:
+            self.match_fail += 1
+            self.record_guesses(mod, mod.debug_og_call_data or [])
+        else:
+            self.match_ok += 1
+            self.add_match(mod, match.debug_og_match)
+
     def add_missing_character(self, mod_matching_key_with_error: str, missing_character_line: str, og_lines: list[str]):
         out_string = f'{mod_matching_key_with_error}: {missing_character_line.strip()}\n'
-        for line in og_lines:
-            out_string += f'\t{line.strip()}\n'
+        if og_lines is None:
+            out_string += '\t(og lines not loaded, set load_og_lines_for_missing_characters to show them)\n'
+        else:
+            for line in og_lines:
+                out_string += f'\t{line.strip()}\n'
 
         self.missing_character_details.append((mod_matching_key_with_error, out_string))
 
@@ -166,12 +261,21 @@ def reverse_dict(d: dict[str, str]) -> dict[str, str]:
     return reversed
 
 
-def get_vanilla_only(log_lines):
+# Hunk header of a diff, with the number of old and new lines in the hunk (1 if not given)
+hunk_header_regex = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
 
+def get_vanilla_only(log_lines, vanilla_commit: str):
+    """Returns the lines added by the vanilla commit ('+' lines of its diff) in 'git log -L' output. log_lines can be a stream,
+    in which case reading stops as soon as the vanilla commit's diff has been read.
+    The context and '-' lines are left out: they were already in the script before the vanilla commit (so only appear if the
+    vanilla commit edited an existing file), and only '+' lines are used as og lines (see MatchContext.get_og_call_data())"""
     diff_lines = []
 
     got_commit = False
     got_file_start = False
+    # Lines of the vanilla commit's hunk still to be read, from its hunk header
+    old_lines_remaining = None
+    new_lines_remaining = None
 
     for line in log_lines:
         if got_commit:
@@ -181,26 +285,70 @@ def get_vanilla_only(log_lines):
 
             if got_file_start:
                 if line.startswith('@@'):
-                    # Ignore for now
+                    hunk_header = hunk_header_regex.match(line)
+                    if hunk_header:
+                        old_lines_remaining = int(hunk_header.group(1) or 1)
+                        new_lines_remaining = int(hunk_header.group(2) or 1)
+                elif line.startswith('\\'):
+                    # '\ No newline at end of file' is not a line of the script
                     pass
                 else:
-                    diff_lines.append(line)
+                    if line.startswith('+'):
+                        diff_lines.append(line)
+
+                    if old_lines_remaining is not None:
+                        if not line.startswith('+'):
+                            old_lines_remaining -= 1
+                        if not line.startswith('-'):
+                            new_lines_remaining -= 1
+
+                        # The whole hunk has been read. Stop here rather than waiting for the next commit,
+                        # which may take a long time (or never come, if the vanilla commit is the last one in the log)
+                        if old_lines_remaining <= 0 and new_lines_remaining <= 0:
+                            break
 
             if line.startswith('+++'):
                 got_file_start = True
 
-        if 'aa718717d64aaba84967048c02cc894ffce62fbc' in line:
+        if line.startswith(f'commit {vanilla_commit}'):
             got_commit = True
 
     return diff_lines
 
 
+def get_original_lines_from_git_log(mod_script_dir, mod_script_file, line_no) -> tuple[list[str], str]:
+    repository = git_access.get_repository(mod_script_dir)
+    # git may not show the root commit if given an absolute path, so use a path relative to the script folder
+    relative_path = Path(os.path.relpath(mod_script_file, mod_script_dir)).as_posix()
+
+    # Starts one git process per line (the worker pool can't run 'git log'), so this is only used when line alignment is off or being verified.
+    # Only the output up to the end of the vanilla commit is read, then git is stopped
+    raw_output_lines = []
+    def read_log(log_output):
+        for line in log_output:
+            raw_output_lines.append(line)
+            yield line
+
+    with repository.stream(['log', '--no-color', f'-L{line_no},+1:{relative_path}'], cwd=mod_script_dir) as log_output:
+        vanilla_lines = get_vanilla_only(read_log(log_output), vanilla_commit)
+
+    return vanilla_lines, '\n'.join(raw_output_lines)
+
+
 def get_original_lines(mod_script_dir, mod_script_file, line_no) -> tuple[list[str], str]:
-    p = subprocess.run(["git", 'log', f'-L{line_no},+1:{mod_script_file}'],
-                       capture_output=True, encoding="utf-8", shell=True, cwd=mod_script_dir, check=True)
-    raw_output = p.stdout
-    vanilla_lines = get_vanilla_only(raw_output.splitlines())
-    return vanilla_lines, raw_output
+    if not use_line_alignment:
+        return get_original_lines_from_git_log(mod_script_dir, mod_script_file, line_no)
+
+    # The alignment is only loaded once per script, so this avoids running git for every line
+    alignment = line_alignment.get_alignment(mod_script_dir, mod_script_file, vanilla_commit)
+    vanilla_lines = alignment.get_vanilla_lines(line_no)
+
+    if verify_line_alignment:
+        git_log_vanilla_lines, _ = get_original_lines_from_git_log(mod_script_dir, mod_script_file, line_no)
+        if vanilla_lines != git_log_vanilla_lines:
+            raise Exception(f"Line alignment for line {line_no} of {mod_script_file} does not match git log:\nAlignment: {vanilla_lines}\nGit Log: {git_log_vanilla_lines}")
+
+    return vanilla_lines, '\n'.join(vanilla_lines)
 
 
 # def get_sprite_info():
@@ -328,6 +476,312 @@ def match_by_keyword(mod: CallData, og_call_data: list[CallData]):
 
     return None
 
+class ScriptOGLinesLoader:
+    """Loads the og lines for any line of one script, for the duration of one scan of that script.
+
+    Uses the on-disk cache or the journal of an interrupted scan if possible. Each line is only queried once, even if several graphics paths on the
+    same line (or several threads) ask for it at the same time.
+    """
+    def __init__(self, mod_script_dir, mod_script_file, script_og_lines_cache: ScriptOGLinesCache, scan_journal: ScanJournal = None):
+        self.mod_script_dir = mod_script_dir
+        self.mod_script_file = mod_script_file
+        self.script_og_lines_cache = script_og_lines_cache
+        self.scan_journal = scan_journal
+        self.coalescer = QueryCoalescer()
+
+    def load(self, line_no: int) -> list[str]:
+        return self.coalescer.get((str(self.mod_script_file), line_no), lambda: self._load_uncoalesced(line_no))
+
+    def _load_uncoalesced(self, line_no: int) -> list[str]:
+        # Use git to extract matching lines from the original game, unless they were cached on a previous run
+        og_lines = None
+        if self.script_og_lines_cache is not None:
+            og_lines = self.script_og_lines_cache.try_get(line_no)
+
+        if og_lines is None and self.scan_journal is not None:
+            og_lines = self.scan_journal.try_get_og_lines(line_no)
+            if og_lines is not None and self.script_og_lines_cache is not None:
+                self.script_og_lines_cache.set(line_no, og_lines)
+
+        if og_lines is None:
+            with profiler.stage('get_original_lines'):
+                og_lines, _raw_git_log_output = get_original_lines(
+                    self.mod_script_dir, self.mod_script_file, line_no)
+
+            if self.script_og_lines_cache is not None:
+                self.script_og_lines_cache.set(line_no, og_lines)
+
+        if self.scan_journal is not None:
+            self.scan_journal.add_og_lines(line_no, og_lines)
+
+        return og_lines
+
+
+class LazyOGLines:
+    """The og lines for one mod line. These are only loaded the first time they are needed"""
+    def __init__(self, og_lines_loader: ScriptOGLinesLoader, line_no: int):
+        self.og_lines_loader = og_lines_loader
+        self.line_no = line_no
+        self.og_lines = None #type: list[str]
+
+    def is_loaded(self) -> bool:
+        return self.og_lines is not None
+
+    def get(self) -> list[str]:
+        if self.og_lines is None:
+            self.og_lines = self.og_lines_loader.load(self.line_no)
+
+        return self.og_lines
+
+
+class MatchContext:
+    """Everything the matching strategies need to match one mod graphics path to an og graphics path"""
+    def __init__(self, mod: CallData, line: str, lazy_og_lines: LazyOGLines, og_bg_lc_name_to_path: dict[str, str], manual_name_matching: dict[str, str], write_debug_output: bool):
+        self.mod = mod
+        self.line = line
+        self.lazy_og_lines = lazy_og_lines
+        self.og_bg_lc_name_to_path = og_bg_lc_name_to_path
+        self.manual_name_matching = manual_name_matching
+        # Text for the script_with_debug file, only collected if it is being written
+        self.write_debug_output = write_debug_output
+        self.debug_output = [] #type: list[str]
+        self._og_call_data = None #type: list[CallData]
+
+    def get_trace_candidates(self) -> list[list[str]]:
+        """The graphics found in the og lines for the trace, or None if they were never needed"""
+        if self._og_call_data is None:
+            return None
+
+        return [[og.type, og.path, og.matching_key] for og in self._og_call_data]
+
+    def add_debug_output(self, text: str, *args):
+        """Add to the debug output. If args are given, the text is %-formatted with them, but only if the debug output is being written"""
+        if self.write_debug_output:
+            self.debug_output.append(text % args if args else text)
+
+    def get_debug_output(self) -> str:
+        return ''.join(self.debug_output)
+
+    def get_og_call_data(self) -> list[CallData]:
+        """Extract all graphics found in the og lines. This loads the og lines if they haven't been loaded yet"""
+        if self._og_call_data is not None:
+            return self._og_call_data
+
+        og_lines = self.lazy_og_lines.get()
+
+        if self.write_debug_output:
+            self.add_debug_output(">> Raw Git Log Output (vanilla -> mod) <<\n")
+            for l in og_lines:
+                self.add_debug_output(l + "\n")
+            self.add_debug_output(">> END Git Log Output <<\n")
+
+        og_call_data = [] #type: list[CallData]
+        for l in og_lines:
+            with profiler.stage('get_graphics_path_on_line'):
+                og_paths = graphics_identifier.get_graphics_path_on_line(l, is_mod=False)
+            for og_path in og_paths:
+                with profiler.stage('CallData'):
+                    og_call_data.append(CallData(l, is_mod=False, path=og_path))
+
+        self.mod.debug_og_call_data = og_call_data
+
+        if len(og_call_data) == 0 and self.write_debug_output:
+            self.add_debug_output('>> No OG graphics for %s\n', self.line)
+
+            if len(og_lines) > 0:
+                self.add_debug_output('OG lines were:\n')
+                for l in og_lines:
+                    self.add_debug_output(l + "\n")
+
+        for og in og_call_data:
+            self.add_debug_output("- Type: %s Matching Key: %s Line: %s\n", og.type, og.matching_key, og.line.strip())
+
+            if not og.line.startswith('+'):
+                raise Exception(f"git output for {
+                                og.line} does not start with a +")
+
+        self.add_debug_output("\n")
+
+        self._og_call_data = og_call_data
+        return og_call_data
+
+
+# scene folder are special CGs, so dont' try to match them
+def match_special_path(ctx: MatchContext) -> ModToOGMatch:
+    if ctx.mod.path.startswith('scene/'):
+        return ModToOGMatch(None, '<SPECIAL_SCENE>')
+    elif textRegex.search(ctx.mod.path):
+        return ModToOGMatch(None, '<SPECIAL_TEXT_EFFECT>')
+
+    return None
+
+# First try to do exact match if the path contains a matching folder
+def match_by_key_in_path(ctx: MatchContext) -> ModToOGMatch:
+    if ctx.mod.matching_key:
+        for og in ctx.get_og_call_data():
+            if og.is_sprite and f'/{ctx.mod.matching_key}/' in og.path:
+                mod_to_og_match = ModToOGMatch(og, None)
+                ctx.add_debug_output("Matched by matching key in path (exact folder): %s\n", mod_to_og_match)
+                return mod_to_og_match
+
+        # This part never seems to be executed, and may generate bad matches, so I've commented it out for now
+        # # Then just match anywhere in the path
+        # for og in ctx.get_og_call_data():
+        #     if og.is_sprite and ctx.mod.matching_key in og.path:
+        #         mod_to_og_match = ModToOGMatch(og, None)
+        #         ctx.print_data += (f"Matched by matching key in path (anywhere in path): {mod_to_og_match}\n")
+        #         return mod_to_og_match
+
+    return None
+
+# Extra matching specifically for the OG sprites in the 'sonota' folder
+# CG\sprites\sonota\oisi[VARIANTS] and
+# CG\sprites\sonota\tetu[VARIANTS]
+sonota_keys = [
+    # Sprites
+    ('sprite/oisi', 'sprites/sonota/oisi', True),
+    ('sprite/tetu', 'sprites/sonota/tetu', True),
+    # Backgrounds
+    ('background/ke_shiryou1_02', 'img/dsc000', False), # In OG game, img folder contains various pictures of Ryukishi's room, but they are all mapped to ke_shiryou1_02 in our mod
+]
+
+def match_by_sonota(ctx: MatchContext) -> ModToOGMatch:
+    mod = ctx.mod
+    for mod_key, og_key, target_sprites in sonota_keys:
+        if mod.is_sprite == target_sprites:
+            if mod_key in mod.path:
+                for og in ctx.get_og_call_data():
+                    if og.is_sprite == target_sprites and og_key in og.path:
+                        mod_to_og_match = ModToOGMatch(og, None)
+                        ctx.add_debug_output("Matched by 'sonota' special case: %s\n", mod_to_og_match)
+                        return mod_to_og_match
+
+    return None
+
+# Try matching by same name match
+def match_by_same_name(ctx: MatchContext) -> ModToOGMatch:
+    mod = ctx.mod
+    for og in ctx.get_og_call_data():
+        if og.name == mod.name:
+            logger.debug("Matched by name in git log '%s': %s -> %s", og.name, mod.path, og.path)
+            return ModToOGMatch(og, None)
+
+    return None
+
+# Try matching by manual matches
+# Eg 'oki_pool2' : 'pool2' which comes from the files:
+#  "background/oki_pool2" -> "bg/2021_add/pool2"
+def match_by_manual_name(ctx: MatchContext) -> ModToOGMatch:
+    mod = ctx.mod
+    if mod.name in ctx.manual_name_matching:
+        expected_og_name = ctx.manual_name_matching[mod.name]
+        for og in ctx.get_og_call_data():
+            if og.name == expected_og_name:
+                mod_to_og_match = ModToOGMatch(og, None)
+                msg = "Matched by manual name match '%s' -> '%s' %s\n"
+                logger.debug(msg, mod.name, expected_og_name, mod_to_og_match)
+                ctx.add_debug_output(msg, mod.name, expected_og_name, mod_to_og_match)
+                return mod_to_og_match
+
+    return None
+
+# Try matching by same name in OG files
+def match_by_og_file_name(ctx: MatchContext) -> ModToOGMatch:
+    mod = ctx.mod
+    if mod.name in ctx.og_bg_lc_name_to_path:
+        og_path = ctx.og_bg_lc_name_to_path[mod.name]
+        logger.debug("Matched by name in og files '%s': %s -> %s", mod.name, mod.path, og_path)
+        return ModToOGMatch(None, og_path)
+
+    return None
+
+# Try matching by match keywords
+def match_by_keyword_pairs(ctx: MatchContext) -> ModToOGMatch:
+    return match_by_keyword(ctx.mod, ctx.get_og_call_data())
+
+# Try to match by guessing for BGs, if there is only one possible option it could be
+def match_by_background_guess(ctx: MatchContext) -> ModToOGMatch:
+    mod = ctx.mod
+    if not mod.is_sprite:
+        last_match = None
+        match_count = 0
+        for og in ctx.get_og_call_data():
+            if not og.is_sprite:
+                if mod.path.startswith('background/') and og.path.startswith('bg/'):
+                    last_match = og
+                    match_count += 1
+
+        if match_count == 1:
+            logger.debug("Matched Background by guess as only one possibility '%s': %s -> %s", mod.name, mod.path, last_match.path)
+            return ModToOGMatch(last_match, None)
+
+    return None
+
+
+class MatchingStrategy:
+    def __init__(self, name: str, match_function, needs_og_lines: bool, reorderable: bool = False):
+        self.name = name
+        # Function taking a MatchContext, returning a ModToOGMatch or None if no match
+        self.match_function = match_function
+        # Whether this strategy uses the og lines (which may need a git call to load)
+        self.needs_og_lines = needs_og_lines
+        # Whether adaptive_strategy_order may move this strategy. Only cheap exact matches on the og lines are reorderable,
+        # as they rarely match the same graphics differently. The guesses are always tried last
+        self.reorderable = reorderable
+        self.profile_stage = f'strategy_{name}'
+
+# Strategies are tried in this order, and the first match is used
+matching_strategies = [
+    MatchingStrategy('special_path', match_special_path, needs_og_lines=False),
+    MatchingStrategy('key_in_path', match_by_key_in_path, needs_og_lines=True, reorderable=True),
+    MatchingStrategy('sonota', match_by_sonota, needs_og_lines=True, reorderable=True),
+    MatchingStrategy('same_name', match_by_same_name, needs_og_lines=True, reorderable=True),
+    MatchingStrategy('manual_name', match_by_manual_name, needs_og_lines=True, reorderable=True),
+    MatchingStrategy('og_file_name', match_by_og_file_name, needs_og_lines=False),
+    MatchingStrategy('keyword', match_by_keyword_pairs, needs_og_lines=True),
+    MatchingStrategy('background_guess', match_by_background_guess, needs_og_lines=True),
+]
+
+class StrategyOrder:
+    """The order the matching strategies are tried in while matching one script.
+
+    If adaptive, every adaptive_reorder_interval graphics the reorderable strategies are sorted by their hit rate in this script so far,
+    so the strategy which usually matches is tried first. Strategies only move within a run of consecutive reorderable strategies.
+    """
+    def __init__(self, adaptive: bool):
+        self.strategies = list(matching_strategies)
+        self.adaptive = adaptive
+        self.graphics_since_reorder = 0
+
+    def after_match(self, statistics: Statistics):
+        """Call after each graphics path has been matched using the strategies"""
+        if not self.adaptive:
+            return
+
+        self.graphics_since_reorder += 1
+        if self.graphics_since_reorder < adaptive_reorder_interval:
+            return
+
+        self.graphics_since_reorder = 0
+
+        # Sorting is stable, so strategies with the same hit rate keep their current order
+        def sort_by_hit_rate(group: list[MatchingStrategy]) -> list[MatchingStrategy]:
+            return sorted(group, key=lambda strategy: statistics.get_hit_rate(strategy.name), reverse=True)
+
+        reordered = []
+        group = []
+        for strategy in self.strategies:
+            if strategy.reorderable:
+                group.append(strategy)
+            else:
+                reordered += sort_by_hit_rate(group)
+                reordered.append(strategy)
+                group = []
+        reordered += sort_by_hit_rate(group)
+
+        self.strategies = reordered
+        statistics.strategy_order = [strategy.name for strategy in reordered]
+
 def parse_graphics(
         mod_path: str,
         mod_script_dir,
@@ -338,181 +792,72 @@ def parse_graphics(
         og_bg_lc_name_to_path: dict[str, str],
         manual_name_matching: dict[str, str],
         last_voice: str,
-        voice_match_database: VoiceMatchDatabase
+        voice_match_database: VoiceMatchDatabase,
+        og_lines_loader: ScriptOGLinesLoader,
+        script_og_candidates: ScriptOGCandidates,
+        strategy_order: StrategyOrder,
+        write_debug_output: bool,
+        script_trace: ScriptTraceWriter
     ):
 
-    print_data = ""
-
     # Convert the line into a CallData object
-    mod = CallData(line, is_mod=True, path=mod_path)
-    print_data += (f"Line No: {line_index + 1} Type: {mod.type} Key: {
-                   mod.matching_key} Character: {mod.debug_character} Line: {line.strip()}\n")
+    with profiler.stage('CallData'):
+        mod = CallData(line, is_mod=True, path=mod_path)
+
+    # The og lines are only loaded if one of the strategies below actually needs them
+    lazy_og_lines = LazyOGLines(og_lines_loader, line_index + 1)
 
     # Skip this line if the image's mod path already exists in database
     # and it has a match
     memozied_match = voice_match_database.try_get(last_voice, mod.path)
     if memozied_match is not None:
         if memozied_match.og_path is not None:
+            # When re-matching with different rules, the earlier line may no longer match, so this line is recorded too.
+            # Its og lines aren't loaded here (they are loaded when re-matching if needed)
+            if script_og_candidates is not None:
+                script_og_candidates.add(OGCandidateRecord(line_index + 1, line, last_voice, mod.path, lazy_og_lines.og_lines))
+            if script_trace is not None:
+                memoized_og_match = memozied_match.debug_og_match
+                strategy = memoized_og_match.strategy if memoized_og_match is not None else None
+                script_trace.add(TraceRecord(line_index + 1, line, last_voice, mod.path, trace_store.status_already_matched, str(memozied_match.og_path), strategy, lazy_og_lines.og_lines))
             return
 
-    # Now use git to extract matching lines from the original game
-    og_lines, raw_git_log_output = get_original_lines(
-        mod_script_dir, mod_script_file, line_index + 1)
+    ctx = MatchContext(mod, line, lazy_og_lines, og_bg_lc_name_to_path, manual_name_matching, write_debug_output)
+    ctx.add_debug_output("Line No: %s Type: %s Key: %s Character: %s Line: %s\n", line_index + 1, mod.type, mod.matching_key, mod.debug_character, line.strip())
 
     # If this is a sprite, but the character is not recognized, just give up as we need to update the character database
     if mod.matching_key is not None and common.missing_character_key in mod.matching_key:
+        # The og lines are only used to help debugging here, so only load them if requested
+        og_lines = lazy_og_lines.get() if load_og_lines_for_missing_characters else None
         statistics.add_missing_character(mod.matching_key, line, og_lines)
         voice_match_database.set(VoiceBasedMatch(last_voice, mod, None))
+        if not lazy_og_lines.is_loaded():
+            statistics.git_calls_avoided += 1
+        if script_og_candidates is not None:
+            script_og_candidates.add(OGCandidateRecord(line_index + 1, line, last_voice, mod.path, lazy_og_lines.og_lines))
+        if script_trace is not None:
+            script_trace.add(TraceRecord(line_index + 1, line, last_voice, mod.path, trace_store.status_missing_character, og_lines=lazy_og_lines.og_lines))
         return
 
-    print_data += ">> Raw Git Log Output (vanilla -> mod) <<\n"
-    for l in og_lines:
-        print_data += l + "\n"
-    # print_data += raw_git_log_output
-    print_data += ">> END Git Log Output <<\n"
-
     # Now try to match lines using various methods
     mod_to_og_match = None
+    for strategy in strategy_order.strategies:
+        with profiler.stage(strategy.profile_stage):
+            mod_to_og_match = strategy.match_function(ctx)
+        statistics.add_strategy_attempt(strategy.name, mod_to_og_match is not None)
+        if mod_to_og_match is not None:
+            mod_to_og_match.strategy = strategy.name
+            break
 
-    # Extract all graphics found in the og lines
-    og_call_data = [] #type: list[CallData]
-    if mod_to_og_match is None:
-        for l in og_lines:
-            for og_path in graphics_identifier.get_graphics_path_on_line(l, is_mod=False):
-                og_call_data.append(CallData(l, is_mod=False, path=og_path))
-
-        mod.debug_og_call_data = og_call_data
-
-        if len(og_call_data) == 0:
-            msg = f'>> No OG graphics for {line}\n'
-
-            if len(og_lines) > 0:
-                msg += 'OG lines were:\n'
-                for l in og_lines:
-                    msg += f"{l}\n"
-
-            # print(msg)
-            print_data += msg
-
-    # og_call_data = [CallData(l, is_mod=False) for l in og_lines]
-
-    for og in og_call_data:
-        print_data += (
-            f"- Type: {og.type} Matching Key: {og.matching_key} Line: {og.line.strip()}\n")
-
-        if not og.line.startswith('+'):
-            raise Exception(f"git output for {
-                            og.line} does not start with a +")
-
-    print_data += ("\n")
-
-    # if len(og_lines) == 1:
-    #     matched_line = og_lines[0]
-    #     print(f"Matched as only one match: {matched_line}")
-
-    # scene folder are special CGs, so dont' try to match them
-    if mod_to_og_match is None:
-        if mod.path.startswith('scene/'):
-            mod_to_og_match = ModToOGMatch(None, '<SPECIAL_SCENE>')
-        elif textRegex.search(mod.path):
-            mod_to_og_match = ModToOGMatch(None, '<SPECIAL_TEXT_EFFECT>')
-
-    if mod_to_og_match is None:
-        if mod.matching_key:
-            # First try to do exact match if the path contains a matching folder
-            if mod_to_og_match is None:
-                for og in og_call_data:
-                    if og.is_sprite and f'/{mod.matching_key}/' in og.path:
-                        mod_to_og_match = ModToOGMatch(og, None)
-                        print_data += (f"Matched by matching key in path (exact folder): {mod_to_og_match}\n")
-                        break
-
-            # This part never seems to be executed, and may generate bad matches, so I've commented it out for now
-            # # Then just match anywhere in the path
-            # if mod_to_og_match is None:
-            #     for og in og_call_data:
-            #         if og.is_sprite and mod.matching_key in og.path:
-            #             mod_to_og_match = ModToOGMatch(og, None)
-            #             print_data += (f"Matched by matching key in path (anywhere in path): {mod_to_og_match}\n")
-            #             break
-
-    # Extra matching specifically for the OG sprites in the 'sonota' folder
-    # CG\sprites\sonota\oisi[VARIANTS] and
-    # CG\sprites\sonota\tetu[VARIANTS]
-    sonota_keys = [
-        # Sprites
-        ('sprite/oisi', 'sprites/sonota/oisi', True),
-        ('sprite/tetu', 'sprites/sonota/tetu', True),
-        # Backgrounds
-        ('background/ke_shiryou1_02', 'img/dsc000', False), # In OG game, img folder contains various pictures of Ryukishi's room, but they are all mapped to ke_shiryou1_02 in our mod
-    ]
-    if mod_to_og_match is None:
-        for mod_key, og_key, target_sprites in sonota_keys:
-            if mod.is_sprite == target_sprites:
-                if mod_key in mod.path:
-                    for og in og_call_data:
-                        if og.is_sprite == target_sprites and og_key in og.path:
-                            mod_to_og_match = ModToOGMatch(og, None)
-                            print_data += (f"Matched by 'sonota' special case: {mod_to_og_match}\n")
-                            break
-
-    # Try matching by same name match
-    if mod_to_og_match is None:
-        for og in og_call_data:
-            if og.name == mod.name:
-                print(f"Matched by name in git log '{
-                      og.name}': {mod.path} -> {og.path}")
-                mod_to_og_match = ModToOGMatch(og, None)
-                break
-
-    # Try matching by manual matches
-    # Eg 'oki_pool2' : 'pool2' which comes from the files:
-    #  "background/oki_pool2" -> "bg/2021_add/pool2"
-    if mod_to_og_match is None:
-        if mod.name in manual_name_matching:
-            expected_og_name = manual_name_matching[mod.name]
-            for og in og_call_data:
-                if og.name == expected_og_name:
-                    mod_to_og_match = ModToOGMatch(og, None)
-                    msg = f"Matched by manual name match '{mod.name}' -> '{expected_og_name}' {mod_to_og_match}\n"
-                    print(msg)
-                    print_data += msg
-                    break
-
-    # Try matching by same name in OG files
-    if mod_to_og_match is None:
-        if mod.name in og_bg_lc_name_to_path:
-            og_path = og_bg_lc_name_to_path[mod.name]
-            print(f"Matched by name in og files '{
-                  mod.name}': {mod.path} -> {og_path}")
-            mod_to_og_match = ModToOGMatch(None, og_path)
-
-    # Try matching by match keywords
-    if mod_to_og_match is None:
-        keyword_match = match_by_keyword(mod, og_call_data)
-        if keyword_match:
-            mod_to_og_match = keyword_match
+    strategy_order.after_match(statistics)
 
-    # Try to match by guessing for BGs, if there is only one possible option it could be
     if mod_to_og_match is None:
-        if not mod.is_sprite:
-            last_match = None
-            match_count = 0
-            for og in og_call_data:
-                if not og.is_sprite:
-                    if mod.path.startswith('background/') and og.path.startswith('bg/'):
-                        last_match = og
-                        match_count += 1
+        og_call_data = ctx.get_og_call_data()
 
-            if match_count == 1:
-                print(f"Matched Background by guess as only one possibility '{mod.name}': {mod.path} -> {last_match.path}")
-                mod_to_og_match = ModToOGMatch(last_match, None)
-
-    if mod_to_og_match is None:
-        print_data += ("Failed to match line\n")
-        print(f"Failed to match '{mod.name}' line: {line.strip()} lastVoice: {last_voice}")
+        ctx.add_debug_output("Failed to match line\n")
+        logger.debug("Failed to match '%s' line: %s lastVoice: %s", mod.name, line.strip(), last_voice)
         for og in og_call_data:
-            print(f"- Type: {og.type} Matching Key: {og.matching_key} Line: {og.line.strip()}")
+            logger.debug("- Type: %s Matching Key: %s Line: %s", og.type, og.matching_key, og.line.strip())
 
         statistics.match_fail += 1
 
@@ -522,9 +867,22 @@ def parse_graphics(
         statistics.match_ok += 1
         statistics.add_match(mod, mod_to_og_match)
 
-    voice_match_database.set(VoiceBasedMatch(last_voice, mod, mod_to_og_match))
+    if not lazy_og_lines.is_loaded():
+        statistics.git_calls_avoided += 1
 
-    print_data += ('----------------------------------------\n')
+    voice_based_match = VoiceBasedMatch(last_voice, mod, mod_to_og_match)
+    voice_match_database.set(voice_based_match)
+
+    if script_og_candidates is not None:
+        script_og_candidates.add(OGCandidateRecord(line_index + 1, line, last_voice, mod.path, lazy_og_lines.og_lines))
+
+    if script_trace is not None:
+        if mod_to_og_match is None:
+            script_trace.add(TraceRecord(line_index + 1, line, last_voice, mod.path, trace_store.status_failed, None, None, lazy_og_lines.og_lines, ctx.get_trace_candidates()))
+        else:
+            script_trace.add(TraceRecord(line_index + 1, line, last_voice, mod.path, trace_store.status_matched, str(voice_based_match.og_path), mod_to_og_match.strategy, lazy_og_lines.og_lines, ctx.get_trace_candidates()))
+
+    ctx.add_debug_output('----------------------------------------\n')
 
     # if 'ModDrawCharacter' in line or 'DrawBustshot' in line:
     #     match = modSpritePathCharacterNameRegex.search(line)
@@ -556,53 +914,155 @@ def parse_graphics(
     # else:
     #     effect_match = modEffectPathRegex.search(line)
 
-    return print_data
+    return ctx.get_debug_output()
 
-def parse_line(mod_script_dir, mod_script_file, all_lines: List[str], line_index, line: str, statistics: Statistics, og_bg_lc_name_to_path: dict[str, str], manual_name_matching: dict[str, str], last_voice: str, voice_match_database: VoiceMatchDatabase):
+def parse_line(mod_script_dir, mod_script_file, line_index, script_line: ScriptLine, statistics: Statistics, og_bg_lc_name_to_path: dict[str, str], manual_name_matching: dict[str, str], last_voice: str, voice_match_database: VoiceMatchDatabase, og_lines_loader: ScriptOGLinesLoader, script_og_candidates: ScriptOGCandidates, strategy_order: StrategyOrder, write_debug_output: bool, script_trace: ScriptTraceWriter):
     """This function expects a modded script line as input, as well other arguments describing where the line is from"""
 
-    # for now just ignore commented lines
-    line = line.split('//', maxsplit=1)[0]
+    # for now just ignore commented lines (already removed by the tokenizer)
+    line = script_line.text
 
-    all_print_data = ""
+    all_print_data = []
 
-    for mod_graphics_path in graphics_identifier.get_graphics_path_on_line(line, is_mod=True):
-        print_data = parse_graphics(mod_graphics_path, mod_script_dir, mod_script_file, line_index, line, statistics, og_bg_lc_name_to_path, manual_name_matching, last_voice, voice_match_database)
+    for graphics_path_event in script_line.graphics_paths:
+        print_data = parse_graphics(graphics_path_event.path, mod_script_dir, mod_script_file, line_index, line, statistics, og_bg_lc_name_to_path, manual_name_matching, last_voice, voice_match_database, og_lines_loader, script_og_candidates, strategy_order, write_debug_output, script_trace)
         if print_data:
-            all_print_data += print_data
+            all_print_data.append(print_data)
+
+    return ''.join(all_print_data)
+
+
+def get_voice_section_hashes(script_lines: list[ScriptLine]) -> tuple[list[str], dict[str, str]]:
+    """Returns the voices in the order they first appear, and a hash of all the lines following each voice.
+    If the same voice is played more than once, all of its sections are included in the one hash.
+    The start of the script (the None voice) is only included in the voice order if it has any graphics, the same as a full scan,
+    but always has a hash"""
+    voice_order = []
+    hashes = {None: hashlib.sha1()}
+
+    last_voice = None
+    for script_line in script_lines:
+        if script_line.voice:
+            last_voice = script_line.voice
+            if last_voice not in hashes:
+                voice_order.append(last_voice)
+                hashes[last_voice] = hashlib.sha1()
+        elif last_voice is None and script_line.graphics_paths and None not in voice_order:
+            voice_order.insert(0, None)
+
+        hashes[last_voice].update(script_line.raw_line.encode('utf-8'))
 
-    return all_print_data
+    return voice_order, {voice: h.hexdigest() for voice, h in hashes.items()}
+
+
+def is_script_unchanged(mod_script_path: str) -> bool:
+    """True if the script is identical to when its voice database was last updated by a full scan"""
+    voice_db_path = common.get_voice_db_path(mod_script_path)
+    if not VoiceMatchDatabase.exists(voice_db_path):
+        return False
+
+    # Without the recorded og candidates, the script couldn't be re-matched with --rematch-only
+    if record_og_candidates and not Path(og_candidates.get_og_candidates_path(mod_script_path)).exists():
+        return False
+
+    if save_trace and not Path(trace_store.get_trace_path(mod_script_path)).exists():
+        return False
+
+    voice_match_database = VoiceMatchDatabase.deserialize(voice_db_path)
+    return voice_match_database.script_hash == get_script_hash(mod_script_path, vanilla_commit)
 
 
 def scan_one_script(mod_script_dir: str, mod_script_path: str, debug_output_file, global_result: GlobalResult, output_folder: str):
     os.makedirs(output_folder, exist_ok=True)
     voice_db_path = common.get_voice_db_path(mod_script_path)
 
-    if Path(voice_db_path).exists():
-        print(f"Using existing database at [{voice_db_path}]")
-        voice_match_database = VoiceMatchDatabase.deserialize(voice_db_path)
+    if VoiceMatchDatabase.exists(voice_db_path):
+        logger.debug("Using existing database at [%s]", voice_db_path)
+        # The debug data is needed to add statistics for skipped voice sections, and must be kept when the database is saved again
+        voice_match_database = VoiceMatchDatabase.deserialize(voice_db_path, load_debug_data=True)
     else:
-        print(f"Creating new existing database at [{voice_db_path}]")
+        logger.debug("Creating new existing database at [%s]", voice_db_path)
         voice_match_database = VoiceMatchDatabase(mod_script_path)
 
     stats = Statistics()
 
-    with open(mod_script_path, encoding='utf-8') as f:
-        all_lines = f.readlines()
+    with profiler.stage('tokenize_script'):
+        script_lines = script_tokenizer.read_script_lines(mod_script_path, cache_script_tokens)
+
+    script_og_candidates = None
+    previous_og_candidates = None
+    og_candidates_path = og_candidates.get_og_candidates_path(mod_script_path)
+    if record_og_candidates:
+        script_og_candidates = ScriptOGCandidates(mod_script_path)
+        if Path(og_candidates_path).exists():
+            previous_og_candidates = ScriptOGCandidates.deserialize(og_candidates_path)
+
+    # When scanning incrementally, voice sections which haven't changed since the last full scan are skipped
+    script_hash = get_script_hash(mod_script_path, vanilla_commit)
+    voice_order, voice_section_hashes = get_voice_section_hashes(script_lines)
+    unchanged_voices = set()
+    # Og candidates saved by older versions can't be copied to the current line numbers
+    can_skip_voices = not record_og_candidates or (previous_og_candidates is not None and previous_og_candidates.has_voice_line_indexes)
+    if scan_incrementally and voice_match_database.script_hash is not None and can_skip_voices:
+        for voice in voice_order:
+            if voice_section_hashes[voice] == voice_match_database.voice_section_hashes.get(voice, None):
+                unchanged_voices.add(voice)
+            else:
+                # Re-match everything in a changed section, as some graphics may have been removed
+                voice_match_database.clear_voice(voice)
+
+        logger.info("[%s] Incremental scan: %d/%d voice sections changed", Path(mod_script_path).name, len(voice_order) - len(unchanged_voices), len(voice_order))
+
+    script_og_lines_cache = None
+    if og_lines_cache is not None:
+        script_og_lines_cache = og_lines_cache.open_script(mod_script_path, vanilla_commit)
+
+    # If a previous scan of this script was interrupted, its og lines are loaded from the journal rather than git
+    scan_journal = None
+    if use_scan_journal:
+        scan_journal = ScanJournal(mod_script_path, script_hash, scan_journal_flush_interval, scan_journal_snapshot_interval)
+        if scan_journal.resume_line > 0:
+            logger.info("[%s] Resuming interrupted scan, the og lines of the first %d lines were journaled", Path(mod_script_path).name, scan_journal.resume_line)
+
+    og_lines_loader = ScriptOGLinesLoader(mod_script_dir, mod_script_path, script_og_lines_cache, scan_journal)
+    strategy_order = StrategyOrder(adaptive_strategy_order)
+
+    script_trace = None
+    if save_trace:
+        trace_path = trace_store.get_trace_path(mod_script_path)
+        # The previous trace is only needed to copy the records of skipped voice sections
+        previous_trace_records = load_previous_trace_records(trace_path) if unchanged_voices else []
+        script_trace = ScriptTraceWriter(mod_script_path, trace_path, previous_trace_records)
 
     # Check every line in the modded input script for corresponding og graphics
     last_voice = None
-    for line_index, line in enumerate(all_lines):
+    for line_index, script_line in enumerate(script_lines):
         if max_lines != None and line_index > max_lines:
             break
 
-        voice_on_line = voice_util.get_voice_on_line(line)
+        line = script_line.raw_line
+        voice_on_line = script_line.voice
         if voice_on_line:
             voice_match_database.acknowledge_voice(voice_on_line)
             last_voice = voice_on_line
 
+        if script_trace is not None:
+            script_trace.begin_line(line_index + 1, last_voice)
+        if script_og_candidates is not None:
+            script_og_candidates.begin_line(line_index + 1, last_voice)
+
+        if last_voice in unchanged_voices:
+            if debug_output_file is not None:
+                debug_output_file.write(line)
+            if script_trace is not None:
+                script_trace.copy_previous_line()
+            # The skipped sections' candidates were recorded by a previous scan
+            if script_og_candidates is not None:
+                script_og_candidates.copy_previous_line(previous_og_candidates)
+            continue
+
         print_data = parse_line(mod_script_dir, mod_script_path,
-                                all_lines, line_index, line, stats, og_bg_lc_name_to_path, manual_name_matching, last_voice, voice_match_database)
+                                line_index, script_line, stats, og_bg_lc_name_to_path, manual_name_matching, last_voice, voice_match_database, og_lines_loader, script_og_candidates, strategy_order, debug_output_file is not None, script_trace)
 
         # Print output for debbuging, only if enabled
         if debug_output_file is not None:
@@ -610,9 +1070,53 @@ def scan_one_script(mod_script_dir: str, mod_script_path: str, debug_output_file
             if print_data is not None:
                 debug_output_file.write(print_data)
 
-    print(f"Saving voice match databse to [{voice_db_path}]")
+        if scan_journal is not None:
+            scan_journal.line_done(line_index + 1)
+
+    if scan_incrementally:
+        # Voices which were removed from the script are no longer needed
+        voice_match_database.reorder_voices(voice_order)
+
+        # Statistics are only collected while matching, so add the matches from the skipped sections
+        for voice in voice_order:
+            if voice in unchanged_voices:
+                for match in voice_match_database.db[voice]:
+                    stats.add_existing_match(match)
+
+    # Only record the hashes if the whole script was scanned
+    if max_lines is None:
+        voice_match_database.script_hash = script_hash
+        voice_match_database.voice_section_hashes = voice_section_hashes
+
+    if script_og_candidates is not None:
+        script_og_candidates.voice_order = voice_order
+        script_og_candidates.script_hash = voice_match_database.script_hash
+        script_og_candidates.voice_section_hashes = voice_match_database.voice_section_hashes
+
+    if scan_incrementally and verify_incremental_scan and max_lines is None:
+        verify_incremental_scan_result(mod_script_dir, mod_script_path, script_lines, script_og_lines_cache, voice_match_database)
+
+    # Check before saving, so a database matched with a bad strategy order is never used
+    if strategy_order.adaptive:
+        verify_strategy_order(script_og_candidates, mod_script_path, voice_match_database, og_lines_loader)
+
+    logger.debug("Saving voice match databse to [%s]", voice_db_path)
     voice_match_database.serialize(voice_db_path)
 
+    if script_og_candidates is not None:
+        logger.debug("Saving og candidates to [%s]", og_candidates_path)
+        script_og_candidates.serialize(og_candidates_path)
+
+    if script_trace is not None:
+        logger.debug("Saving trace to [%s]", trace_path)
+        script_trace.finish()
+
+    logger.debug("Git calls avoided as og lines were not needed: %d", stats.git_calls_avoided)
+    logger.debug("Repeated og line queries: %d hits, %d misses", og_lines_loader.coalescer.hits, og_lines_loader.coalescer.misses)
+    if script_og_lines_cache is not None:
+        logger.debug("OG lines cache: %d hits, %d misses", script_og_lines_cache.hits, script_og_lines_cache.misses)
+        og_lines_cache.save_script(script_og_lines_cache)
+
     # Write the output statistcs .json
     # print(f"{stats.match_ok}/{stats.total()} Failed: {stats.match_fail}")
     # print(stats.count_statistics)
@@ -621,6 +1125,145 @@ def scan_one_script(mod_script_dir: str, mod_script_path: str, debug_output_file
     missing_chars_path = os.path.join(output_folder, f'{out_filename}_missing_chars.txt')
 
     stats.save_as_json(json_out_path, missing_chars_path, global_result)
+    stats.log_summary(mod_script_path)
+
+    # Everything has been saved, so an interrupted scan no longer needs to be resumed
+    if scan_journal is not None:
+        scan_journal.finish()
+
+
+def load_previous_trace_records(trace_path: str) -> list[TraceRecord]:
+    try:
+        return trace_store.load_trace_records(trace_path)
+    except Exception as e:
+        logger.warning("Ignoring unreadable trace [%s]: %s", trace_path, e)
+        return []
+
+
+def match_og_candidates(script_og_candidates: ScriptOGCandidates, mod_script_path: Path, stats: Statistics, strategy_order: StrategyOrder, script_trace: ScriptTraceWriter, fallback_og_lines_loader: ScriptOGLinesLoader) -> VoiceMatchDatabase:
+    """Match every graphics path in the og candidates, as if the script was scanned (but without git or the script)"""
+    # Always start from an empty database, otherwise matches made with the old rules would be kept
+    voice_match_database = VoiceMatchDatabase(mod_script_path)
+    og_lines_loader = RecordedOGLinesLoader(script_og_candidates, fallback_og_lines_loader)
+
+    for voice in script_og_candidates.voice_order:
+        if voice is not None:
+            voice_match_database.acknowledge_voice(voice)
+
+        for record in script_og_candidates.records_per_voice.get(voice, []):
+            if script_trace is not None:
+                script_trace.begin_recorded_line(record.line_no, voice)
+            parse_graphics(record.mod_path, mod_script_dir, mod_script_path, record.line_no - 1, record.line, stats, og_bg_lc_name_to_path, manual_name_matching, voice, voice_match_database, og_lines_loader, None, strategy_order, False, script_trace)
+
+    voice_match_database.script_hash = script_og_candidates.script_hash
+    voice_match_database.voice_section_hashes = script_og_candidates.voice_section_hashes
+
+    return voice_match_database
+
+
+def get_database_contents(database: VoiceMatchDatabase) -> tuple[list[str], list[tuple[str, str, str]]]:
+    """The voices (including those without any graphics) and matches of a database, for comparing two databases"""
+    return list(database.db), [(voice, match.mod_path, str(match.og_path)) for voice, matches in database.db.items() for match in matches]
+
+
+def verify_incremental_scan_result(mod_script_dir: str, mod_script_path: str, script_lines: list[ScriptLine], script_og_lines_cache: ScriptOGLinesCache, voice_match_database: VoiceMatchDatabase):
+    """Raise an exception if scanning incrementally gave a different voice database to a full scan.
+    The whole script is matched again in memory to check this, which may need git for every graphics line"""
+    expected_database = VoiceMatchDatabase(mod_script_path)
+    og_lines_loader = ScriptOGLinesLoader(mod_script_dir, mod_script_path, script_og_lines_cache)
+    stats = Statistics()
+    strategy_order = StrategyOrder(adaptive=False)
+
+    last_voice = None
+    for line_index, script_line in enumerate(script_lines):
+        if script_line.voice:
+            expected_database.acknowledge_voice(script_line.voice)
+            last_voice = script_line.voice
+
+        parse_line(mod_script_dir, mod_script_path, line_index, script_line, stats, og_bg_lc_name_to_path, manual_name_matching, last_voice, expected_database, og_lines_loader, None, strategy_order, False, None)
+
+    expected_voices, expected_matches = get_database_contents(expected_database)
+    actual_voices, actual_matches = get_database_contents(voice_match_database)
+    if actual_voices != expected_voices:
+        raise Exception(f"Incremental scan of [{mod_script_path}] gave different voice sections to a full scan: expected {expected_voices} but got {actual_voices}")
+
+    if actual_matches != expected_matches:
+        for expected, actual in zip(expected_matches, actual_matches):
+            if expected != actual:
+                raise Exception(f"Incremental scan of [{mod_script_path}] gave different matches to a full scan: expected {expected} but got {actual}")
+
+        raise Exception(f"Incremental scan of [{mod_script_path}] gave {len(actual_matches)} matches, but a full scan gave {len(expected_matches)}")
+
+    logger.info("[%s] Verified incremental scan gives the same %d matches as a full scan", Path(mod_script_path).name, len(actual_matches))
+
+
+def verify_strategy_order(script_og_candidates: ScriptOGCandidates, mod_script_path: Path, voice_match_database: VoiceMatchDatabase, fallback_og_lines_loader: ScriptOGLinesLoader):
+    """Raise an exception if matching with adaptive_strategy_order gave different matches to the default strategy order.
+    The og candidates are matched again in the default order to check this, which is fast as git isn't needed"""
+    expected_database = match_og_candidates(script_og_candidates, mod_script_path, Statistics(), StrategyOrder(adaptive=False), None, fallback_og_lines_loader)
+
+    _, expected_matches = get_database_contents(expected_database)
+    _, actual_matches = get_database_contents(voice_match_database)
+    if actual_matches != expected_matches:
+        for expected, actual in zip(expected_matches, actual_matches):
+            if expected != actual:
+                raise Exception(f"Adaptive strategy order changed the matches of [{mod_script_path}]: expected {expected} but got {actual}. Set adaptive_strategy_order = False")
+
+        raise Exception(f"Adaptive strategy order changed the number of matches of [{mod_script_path}] from {len(expected_matches)} to {len(actual_matches)}. Set adaptive_strategy_order = False")
+
+    logger.info("[%s] Verified adaptive strategy order gives the same %d matches as the default order", Path(mod_script_path).name, len(actual_matches))
+
+
+def rematch_one_script(og_candidates_path: Path) -> GlobalResult:
+    """Match one script again using the og candidates recorded when it was last scanned, so git is only needed for lines whose
+    og lines weren't needed by the scan (eg. missing characters). This is much faster than a full scan when only the matching rules have changed"""
+    global_result = GlobalResult()
+    script_og_candidates = ScriptOGCandidates.deserialize(og_candidates_path)
+    mod_script_path = Path(script_og_candidates.script_path)
+    voice_db_path = common.get_voice_db_path(mod_script_path)
+
+    logger.debug("Re-matching [%s] using og candidates from [%s]", mod_script_path, og_candidates_path)
+    stats = Statistics()
+    strategy_order = StrategyOrder(adaptive_strategy_order)
+
+    script_trace = None
+    if save_trace:
+        trace_path = trace_store.get_trace_path(mod_script_path)
+        script_trace = ScriptTraceWriter(mod_script_path, trace_path, load_previous_trace_records(trace_path))
+
+    # Lines whose og lines weren't needed when the script was scanned (eg. missing characters) may be needed now.
+    # These are loaded from git, but only if the script hasn't changed since, so the line numbers are still correct
+    fallback_og_lines_loader = None
+    script_og_lines_cache = None
+    if mod_script_path.exists() and get_script_hash(mod_script_path, vanilla_commit) == script_og_candidates.script_hash:
+        if og_lines_cache is not None:
+            script_og_lines_cache = og_lines_cache.open_script(mod_script_path, vanilla_commit)
+        fallback_og_lines_loader = ScriptOGLinesLoader(mod_script_dir, mod_script_path, script_og_lines_cache)
+
+    voice_match_database = match_og_candidates(script_og_candidates, mod_script_path, stats, strategy_order, script_trace, fallback_og_lines_loader)
+
+    if strategy_order.adaptive:
+        verify_strategy_order(script_og_candidates, mod_script_path, voice_match_database, fallback_og_lines_loader)
+
+    if script_og_lines_cache is not None:
+        og_lines_cache.save_script(script_og_lines_cache)
+
+    logger.debug("Saving voice match databse to [%s]", voice_db_path)
+    voice_match_database.serialize(voice_db_path)
+
+    if script_trace is not None:
+        logger.debug("Saving trace to [%s]", trace_path)
+        script_trace.finish()
+
+    os.makedirs(output_folder, exist_ok=True)
+    out_filename = mod_script_path.stem
+    json_out_path = os.path.join(output_folder, f'{out_filename}.json')
+    missing_chars_path = os.path.join(output_folder, f'{out_filename}_missing_chars.txt')
+
+    stats.save_as_json(json_out_path, missing_chars_path, global_result)
+    stats.log_summary(mod_script_path)
+
+    return global_result
 
 
 # with open('debug_output.txt', 'w', encoding='utf-8') as debug_output:
@@ -640,32 +1283,196 @@ manual_name_matching = {
 max_lines = None
 pattern = '*.txt'
 
-# Build a mapping from filename -> path for unmodded CGs, except sprites
-unmodded_cg = 'D:/games/steam/steamapps/common/Higurashi When They Cry Hou+ Unmodded/HigurashiEp10_Data/StreamingAssets/CG'
+# The commit containing the unmodified (vanilla) scripts
+vanilla_commit = 'aa718717d64aaba84967048c02cc894ffce62fbc'
+
+# If True, load each script's history once and track lines back to the vanilla commit in memory.
+# Otherwise start a 'git log -L' process for every graphics line (very slow)
+use_line_alignment = True
+
+# If True, also run 'git log -L' for every line and raise an exception if the result differs from the line alignment
+verify_line_alignment = False
+
+# If True, each script scanned with --incremental is also matched in full (in memory), and an exception is raised if the
+# voice database is different in any way. Slow, as git may be needed for every graphics line
+verify_incremental_scan = False
+
+# If True, og lines are cached on disk per script content hash, so unchanged scripts don't need git on the next run
+use_og_lines_cache = True
+og_lines_cache_max_size_bytes = 256 * 1024 * 1024
+
+# If True, the og lines of every graphics path are saved in the 'og_candidates' folder, so that --rematch-only can be used later.
+# Og lines which weren't needed by the scan (eg. for paths which are already matched) aren't recorded, and are loaded from git when re-matching
+record_og_candidates = True
+
+# If True, the cheap exact matching strategies are tried in order of how often they have matched so far in each script (see StrategyOrder).
+# Every script is then matched again with the default order using its og candidates, and an exception is raised if any match is different
+adaptive_strategy_order = False
+adaptive_reorder_interval = 100
 
-if not os.path.exists(unmodded_cg):
-    raise Exception(f"Unmodded CG path doesn't exist: {unmodded_cg}")
+# If True, the og lines loaded while scanning a script are journaled to the 'scan_journal' folder every scan_journal_flush_interval lines.
+# If the scan is interrupted, the next scan of that script loads them from the journal instead of git
+use_scan_journal = True
+scan_journal_flush_interval = 200
+scan_journal_snapshot_interval = 20
 
-og_bg_lc_name_to_path = path_util.lc_name_to_path(
-    unmodded_cg, exclude=['sprites/'])
+# If True, the tokens of each script (voices, graphics paths and strings on each line) are cached in the 'token_cache' folder,
+# so unchanged scripts aren't tokenized again by the next scan or by verification_and_fallback_matching.py
+cache_script_tokens = True
+
+# If True, record the time spent in each stage of matching, and save it in the 'profile' folder (also enabled by --profile)
+enable_profiling = False
+
+# If True, og lines are loaded for graphics with a missing character, so they are shown in the '_missing_chars.txt' file
+load_og_lines_for_missing_characters = False
+
+unmodded_cg = 'D:/games/steam/steamapps/common/Higurashi When They Cry Hou+ Unmodded/HigurashiEp10_Data/StreamingAssets/CG'
 
 mod_script_dir = 'D:/drojf/large_projects/umineko/HIGURASHI_REPOS/10 hou-plus/Update/'
 
 output_folder = 'stats_temp'
 
+# If True, write how every graphics path was matched to the 'trace' folder, which can be searched with query_trace.py
+save_trace = True
+
+# If True, also write a copy of each script with the og lines and candidates after each line to debug_folder (large and slow)
+save_script_with_debug = False
 debug_folder = 'script_with_debug'
-os.makedirs(debug_folder, exist_ok=True)
 
-# TODO: add global stats across all items? only write out once all items processed
-global_result = GlobalResult()
+# These are set by init_globals(). When scanning in parallel, this is called once in each worker process
+og_bg_lc_name_to_path = None #type: dict[str, str]
+og_lines_cache = None #type: OGLinesCache
+# If True, unchanged scripts are skipped, and only changed voice sections of other scripts are matched again
+scan_incrementally = False
+# Records the stage timings of the script currently being scanned (see process_script())
+profiler = profiling.Profiler(enabled=False)
+
+def init_globals(unmodded_lc_name_to_path: dict[str, str], incremental: bool, profile: bool, verbose: bool):
+    global og_bg_lc_name_to_path, og_lines_cache, scan_incrementally, enable_profiling
+
+    log_util.setup_logging(verbose)
+    og_bg_lc_name_to_path = unmodded_lc_name_to_path
+    scan_incrementally = incremental
+    enable_profiling = profile
+
+    og_lines_cache = None
+    if use_og_lines_cache:
+        og_lines_cache = OGLinesCache(max_size_bytes=og_lines_cache_max_size_bytes)
+
+
+def scan_one_script_with_debug(modded_script_path: Path) -> GlobalResult:
+    """Scans one script with its own Statistics and VoiceMatchDatabase, so it can be run in a separate process"""
+    global_result = GlobalResult()
+
+    if scan_incrementally and is_script_unchanged(modded_script_path):
+        logger.info("[%s] Skipping unchanged script", modded_script_path.name)
+        # The missing characters file is only written if there were missing characters
+        missing_chars_path = os.path.join(output_folder, f'{modded_script_path.stem}_missing_chars.txt')
+        global_result.missing_char_detected = os.path.exists(missing_chars_path)
+        return global_result
+
+    if not save_script_with_debug:
+        scan_one_script(mod_script_dir, modded_script_path, None, global_result=global_result, output_folder=output_folder)
+        return global_result
 
-for modded_script_path in Path(mod_script_dir).glob(pattern):
     debug_output_path = os.path.join(debug_folder, modded_script_path.name)
     with open(debug_output_path, 'w', encoding='utf-8') as debug_output_file:
         scan_one_script(mod_script_dir, modded_script_path, debug_output_file, global_result=global_result, output_folder=output_folder)
 
-if global_result.missing_char_detected:
-    print("<<<<<<<<<<< WARNING: one or more missing from the mod_to_name or og_to_name table, please update or matching will be incomplete! >>>>>>>>>>>>>>")
+    return global_result
+
+
+def process_script(process_one_script, script_path: Path) -> GlobalResult:
+    """Runs process_one_script(script_path), and saves the time spent in each stage if profiling is enabled"""
+    global profiler
+    profiler = profiling.Profiler(enable_profiling)
+
+    try:
+        with profiler.stage('total'):
+            global_result = process_one_script(script_path)
+
+        if profiler.enabled:
+            profile_path = profiling.get_script_profile_path(script_path)
+            logger.debug("Saving profile to [%s]", profile_path)
+            profiler.save(profile_path)
+            global_result.profile = profiler
+    finally:
+        # Write this script's output now, in case this is a worker process (which doesn't flush on exit)
+        log_util.flush()
+
+    return global_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Match modded graphics to OG graphics using the git history of each script")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of scripts to scan in parallel (each in a separate process)")
+    parser.add_argument('--incremental', action='store_true', help="Skip unchanged scripts, and only re-match the voice sections of a script which have changed")
+    parser.add_argument('--rematch-only', action='store_true', help="Don't scan the scripts, just match again using the og candidates recorded by the last scan (use after changing the matching rules)")
+    parser.add_argument('--verbose', action='store_true', help="Show every match, failure and candidate, rather than just a summary of each script")
+    parser.add_argument('--profile', action='store_true', help="Save the time spent in each stage of matching to the 'profile' folder (same as enable_profiling = True)")
+    args = parser.parse_args()
+
+    log_util.setup_logging(args.verbose)
+
+    if args.rematch_only and args.incremental:
+        raise Exception("--rematch-only and --incremental can't be used together")
+
+    profile = args.profile or enable_profiling
+
+    if adaptive_strategy_order and not record_og_candidates:
+        raise Exception("adaptive_strategy_order needs record_og_candidates = True, to check the matches are the same as the default order")
+
+    if not os.path.exists(unmodded_cg):
+        raise Exception(f"Unmodded CG path doesn't exist: {unmodded_cg}")
+
+    # Build a mapping from filename -> path for unmodded CGs, except sprites
+    unmodded_cg_index = cg_index.load_cg_index(unmodded_cg)
+    logger.info("Indexed unmodded CG folder (%d folders changed since the last run)", unmodded_cg_index.dirs_listed)
+    unmodded_lc_name_to_path, collisions = unmodded_cg_index.lc_name_to_path(exclude=['sprites/'])
+    for lc_name, paths in collisions.items():
+        logger.warning("Unmodded CG name [%s] is used by more than one file, will match to [%s]: %s", lc_name, paths[-1], [str(path) for path in paths])
+
+    if save_script_with_debug:
+        os.makedirs(debug_folder, exist_ok=True)
+
+    # TODO: add global stats across all items? only write out once all items processed
+    global_result = GlobalResult()
+
+    # Sort so that results are always merged in the same order
+    if args.rematch_only:
+        process_one_script = rematch_one_script
+        all_script_paths = sorted(Path(og_candidates.og_candidates_folder).glob('*_og_candidates.json'))
+    else:
+        process_one_script = scan_one_script_with_debug
+        all_script_paths = sorted(Path(mod_script_dir).glob(pattern))
+
+    if args.jobs > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_globals, initargs=(unmodded_lc_name_to_path, args.incremental, profile, args.verbose)) as executor:
+            # Start the largest scripts first so that one large script isn't left running on its own at the end
+            futures = {}
+            for script_path in sorted(all_script_paths, key=lambda p: p.stat().st_size, reverse=True):
+                futures[script_path] = executor.submit(process_script, process_one_script, script_path)
+
+            for script_path in all_script_paths:
+                global_result.merge(futures[script_path].result())
+    else:
+        init_globals(unmodded_lc_name_to_path, args.incremental, profile, args.verbose)
+        for script_path in all_script_paths:
+            global_result.merge(process_script(process_one_script, script_path))
+
+    if global_result.profile is not None:
+        aggregate_profile_path = profiling.get_aggregate_profile_path()
+        logger.info("Saving profile of all scripts to [%s]", aggregate_profile_path)
+        global_result.profile.save(aggregate_profile_path)
+
+    if global_result.missing_char_detected:
+        logger.warning("<<<<<<<<<<< WARNING: one or more missing from the mod_to_name or og_to_name table, please update or matching will be incomplete! >>>>>>>>>>>>>>")
+
+    log_util.flush()
+
+
+if __name__ == '__main__':
+    main()
 
 #################################################################
 #### Now run 'generate_mapping_from_stats' script after this ####
@@ -0,0 +1,26 @@
+from pathlib import Path
+
+import common
+from common import VoiceMatchDatabase
+
+# Convert voice databases saved as a pickle by older versions to the current format.
+# This isn't required (old databases are still loaded, and are converted the next time main.py saves them),
+# but the new format is much faster to load in verification_and_fallback_matching.py
+
+converted_count = 0
+
+for legacy_path in sorted(Path(common.voice_db_folder).glob('*_voice_db.pickle')):
+    new_path = legacy_path.with_suffix('.json')
+    if new_path.exists():
+        print(f"Skipping [{legacy_path}] as it has already been converted to [{new_path}]")
+        continue
+
+    voice_match_database = VoiceMatchDatabase.deserialize_legacy(str(legacy_path))
+    voice_match_database.serialize(str(new_path))
+    print(f"Converted [{legacy_path}] -> [{new_path}]")
+    converted_count += 1
+
+    # Only remove the old database once the new one has been written
+    legacy_path.unlink()
+
+print(f"Converted {converted_count} voice databases")
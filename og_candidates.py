@@ -0,0 +1,148 @@
+import json
+import os
+from pathlib import Path
+
+from common import write_file_atomic
+
+
+og_candidates_folder = 'og_candidates'
+
+# Version 2 records the position of each line within its voice (voice_line_index)
+format_version = 2
+
+def get_og_candidates_path(mod_script_path: str) -> str:
+    os.makedirs(og_candidates_folder, exist_ok=True)
+    return os.path.join(og_candidates_folder, f'{Path(mod_script_path).stem}_og_candidates.json')
+
+
+class OGCandidateRecord:
+    """One graphics path on one line of a modded script, and the og lines its og candidates are extracted from"""
+    def __init__(self, line_no: int, line: str, voice: str, mod_path: str, og_lines: list[str]):
+        self.line_no = line_no
+        self.line = line
+        self.voice = voice
+        self.mod_path = mod_path
+        # None if the og lines were never needed to match this path (eg. for special paths)
+        self.og_lines = og_lines
+        # Position of this line among all lines of the same voice. Used to copy records of unchanged voice sections when scanning incrementally
+        self.voice_line_index = None #type: int
+
+    def to_json(self):
+        return [self.line_no, self.line, self.mod_path, self.og_lines, self.voice_line_index]
+
+    @staticmethod
+    def from_json(voice: str, data) -> 'OGCandidateRecord':
+        line_no, line, mod_path, og_lines = data[:4]
+        record = OGCandidateRecord(line_no, line, voice, mod_path, og_lines)
+        # Not recorded by older versions
+        record.voice_line_index = data[4] if len(data) > 4 else None
+        return record
+
+
+class ScriptOGCandidates:
+    """All og candidates found while scanning one script, so that matching can be re-run later without git"""
+    def __init__(self, script_path: str):
+        self.script_path = str(script_path)
+        # Same as the VoiceMatchDatabase attributes, so they can be restored when re-matching
+        self.script_hash = None #type: str
+        self.voice_section_hashes = {} #type: dict[str, str]
+        # Every voice in the order they first appear in the script (None is the start of the script)
+        self.voice_order = [None] #type: list[str]
+        self.records_per_voice = {} #type: dict[str, list[OGCandidateRecord]]
+        # False if loaded from a file saved by an older version, so the records of skipped voice sections can't be copied
+        self.has_voice_line_indexes = True
+        # (voice, voice line index) -> records, built when first needed by get_records_for_line()
+        self.records_per_voice_line = None #type: dict[tuple[str, int], list[OGCandidateRecord]]
+
+        # The line currently being scanned (see begin_line())
+        self.voice_line_counts = {} #type: dict[str, int]
+        self.line_no = None #type: int
+        self.voice = None #type: str
+        self.voice_line_index = None #type: int
+
+    def begin_line(self, line_no: int, voice: str):
+        """Call for each line of the script while scanning, before add() or copy_previous_line()"""
+        self.line_no = line_no
+        self.voice = voice
+        self.voice_line_index = self.voice_line_counts.get(voice, 0)
+        self.voice_line_counts[voice] = self.voice_line_index + 1
+
+    def add(self, record: OGCandidateRecord):
+        if record.voice not in self.records_per_voice:
+            self.records_per_voice[record.voice] = []
+
+        record.voice_line_index = self.voice_line_index
+        self.records_per_voice[record.voice].append(record)
+
+    def copy_previous_line(self, previous: 'ScriptOGCandidates'):
+        """Copy the records of the current line from a previous scan, for a voice section which was skipped as it hasn't changed.
+        Lines before the section may have been added or removed, so the records are given the current line number"""
+        for previous_record in previous.get_records_for_line(self.voice, self.voice_line_index):
+            record = OGCandidateRecord(self.line_no, previous_record.line, previous_record.voice, previous_record.mod_path, previous_record.og_lines)
+            self.add(record)
+
+    def get_records_for_line(self, voice: str, voice_line_index: int) -> list[OGCandidateRecord]:
+        if self.records_per_voice_line is None:
+            self.records_per_voice_line = {}
+            for record in self.iter_records():
+                self.records_per_voice_line.setdefault((record.voice, record.voice_line_index), []).append(record)
+
+        return self.records_per_voice_line.get((voice, voice_line_index), [])
+
+    def iter_records(self):
+        """Iterate over all records in voice order"""
+        for voice in self.voice_order:
+            for record in self.records_per_voice.get(voice, []):
+                yield record
+
+    def serialize(self, output_file: str):
+        data = {
+            'format_version': format_version,
+            'script_path': self.script_path,
+            'script_hash': self.script_hash,
+            # Voices are stored in lists rather than as dict keys, as the None voice is not a valid json key
+            'voice_section_hashes': list(self.voice_section_hashes.items()),
+            'voice_order': self.voice_order,
+            'records': [[voice, [record.to_json() for record in self.records_per_voice.get(voice, [])]] for voice in self.voice_order],
+        }
+
+        write_file_atomic(output_file, json.dumps(data))
+
+    @staticmethod
+    def deserialize(input_file: str) -> 'ScriptOGCandidates':
+        with open(input_file, encoding='utf-8') as f:
+            data = json.load(f)
+
+        candidates = ScriptOGCandidates(data['script_path'])
+        candidates.script_hash = data['script_hash']
+        candidates.voice_section_hashes = {voice: h for voice, h in data['voice_section_hashes']}
+        candidates.voice_order = data['voice_order']
+        candidates.has_voice_line_indexes = data.get('format_version', 1) >= 2
+        for voice, records in data['records']:
+            candidates.records_per_voice[voice] = [OGCandidateRecord.from_json(voice, record) for record in records]
+
+        return candidates
+
+
+class RecordedOGLinesLoader:
+    """Provides og lines from recorded candidates instead of git. Has the same load() as main.ScriptOGLinesLoader.
+    The og lines of lines which weren't recorded (as they weren't needed when the script was scanned, eg. missing characters)
+    are loaded with fallback_loader, if given"""
+    def __init__(self, candidates: ScriptOGCandidates, fallback_loader=None):
+        self.candidates = candidates
+        self.fallback_loader = fallback_loader
+        self.og_lines_per_line = {} #type: dict[int, list[str]]
+        for record in candidates.iter_records():
+            if record.og_lines is not None:
+                self.og_lines_per_line[record.line_no] = record.og_lines
+
+    def load(self, line_no: int) -> list[str]:
+        og_lines = self.og_lines_per_line.get(line_no, None)
+        if og_lines is None:
+            if self.fallback_loader is None:
+                raise Exception(f"The og lines for line {line_no} of [{self.candidates.script_path}] were not recorded, as they weren't needed when the script was scanned, and the script has changed since. Please run a full scan without --rematch-only")
+
+            og_lines = self.fallback_loader.load(line_no)
+            self.og_lines_per_line[line_no] = og_lines
+
+        return og_lines
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from common import write_file_atomic
+import git_access
+
+logger = logging.getLogger(__name__)
+
+og_lines_cache_folder = 'og_lines_cache'
+
+# Default limit on the total size of all cached scripts, least recently used scripts are evicted first
+default_max_size_bytes = 256 * 1024 * 1024
+
+
+def get_script_hash(mod_script_path: str, vanilla_commit: str) -> str:
+    """Hash of everything the og lines of a script depend on: its contents, its path in the repository and its history
+    (the last commit which changed it). The vanilla commit is included so that changing it invalidates the cache.
+    Scripts with the same contents (eg. a copy added after the vanilla commit) have different og lines, so must not share a hash"""
+    repository = git_access.get_repository(os.path.dirname(os.path.abspath(mod_script_path)))
+    repository_path = repository.get_repository_path(mod_script_path)
+    last_commit = repository.run(['log', '-1', '--format=%H', 'HEAD', '--', repository_path]).strip()
+
+    h = hashlib.sha1()
+    h.update(vanilla_commit.encode('utf-8'))
+    h.update(b'\0' + repository_path.encode('utf-8'))
+    h.update(b'\0' + last_commit.encode('utf-8') + b'\0')
+    with open(mod_script_path, 'rb') as f:
+        h.update(f.read())
+
+    return h.hexdigest()
+
+
+class ScriptOGLinesCache:
+    """Cached og_lines (the output of get_original_lines) for each line of one version of a script"""
+    def __init__(self, script_name: str, script_hash: str, og_lines_per_line: dict[str, list[str]]):
+        self.script_name = script_name
+        self.script_hash = script_hash
+        # Line number (as a string, as it is stored in json) -> og lines
+        self.og_lines_per_line = og_lines_per_line
+        self.modified = False
+        self.hits = 0
+        self.misses = 0
+
+    def try_get(self, line_no: int) -> list[str]:
+        og_lines = self.og_lines_per_line.get(str(line_no), None)
+
+        if og_lines is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return og_lines
+
+    def set(self, line_no: int, og_lines: list[str]):
+        self.og_lines_per_line[str(line_no)] = og_lines
+        self.modified = True
+
+
+class OGLinesCache:
+    """On-disk cache of og_lines, keyed by script content hash and line number.
+
+    Each version of a script is stored in its own '[hash].json' file, and '[script name].hash' records which
+    version was last cached for each script. When a script's hash changes, the file for the old version is deleted.
+    Files are only ever written for the script being scanned, so separate processes can scan different scripts at once.
+    """
+    def __init__(self, folder: str = og_lines_cache_folder, max_size_bytes: int = default_max_size_bytes):
+        self.folder = Path(folder)
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(self.folder, exist_ok=True)
+
+    def get_cache_path(self, script_hash: str) -> Path:
+        return self.folder.joinpath(f'{script_hash}.json')
+
+    def get_hash_path(self, script_name: str) -> Path:
+        return self.folder.joinpath(f'{script_name}.hash')
+
+    def open_script(self, mod_script_path: str, vanilla_commit: str) -> ScriptOGLinesCache:
+        script_name = Path(mod_script_path).name
+        script_hash = get_script_hash(mod_script_path, vanilla_commit)
+
+        # If the script has changed since it was last cached, the old cached lines are no longer valid
+        hash_path = self.get_hash_path(script_name)
+        if hash_path.exists():
+            previous_hash = hash_path.read_text(encoding='utf-8').strip()
+            if previous_hash != script_hash:
+                logger.debug("Script [%s] has changed, invalidating cached og lines", script_name)
+                self.get_cache_path(previous_hash).unlink(missing_ok=True)
+
+        og_lines_per_line = {}
+        cache_path = self.get_cache_path(script_hash)
+        if cache_path.exists():
+            try:
+                with open(cache_path, encoding='utf-8') as f:
+                    og_lines_per_line = json.load(f)
+            except json.JSONDecodeError as e:
+                logger.warning("Ignoring corrupt og lines cache [%s]: %s", cache_path, e)
+
+        return ScriptOGLinesCache(script_name, script_hash, og_lines_per_line)
+
+    def save_script(self, script_cache: ScriptOGLinesCache):
+        cache_path = self.get_cache_path(script_cache.script_hash)
+
+        if script_cache.modified:
+            write_file_atomic(cache_path, json.dumps(script_cache.og_lines_per_line))
+            script_cache.modified = False
+        elif cache_path.exists():
+            # The modified time is used to find the least recently used files
+            os.utime(cache_path)
+
+        write_file_atomic(self.get_hash_path(script_cache.script_name), script_cache.script_hash)
+
+        self.evict(keep_path=cache_path)
+
+    def evict(self, keep_path: Path):
+        cache_files = []
+        for cache_path in self.folder.glob('*.json'):
+            try:
+                stat = cache_path.stat()
+            except FileNotFoundError:
+                # Another process may have just evicted this file
+                continue
+            cache_files.append((stat.st_mtime, stat.st_size, cache_path))
+
+        total_size = sum(size for _, size, _ in cache_files)
+
+        # Remove least recently used scripts until under the size limit
+        for _, size, cache_path in sorted(cache_files):
+            if total_size <= self.max_size_bytes:
+                break
+
+            if cache_path == keep_path:
+                continue
+
+            logger.debug("Evicting og lines cache [%s] to stay under %s bytes", cache_path, self.max_size_bytes)
+            total_size -= size
+            cache_path.unlink(missing_ok=True)
@@ -0,0 +1,89 @@
+import json
+import os
+import time
+from pathlib import Path
+
+import common
+
+# Records how much time main.py spends in each stage of matching (see enable_profiling in main.py).
+# Stages can be nested (eg a matching strategy may load the og lines), and each stage's time includes its nested stages.
+
+profile_folder = 'profile'
+
+
+class NullStage:
+    """Used instead of StageTimer when profiling is disabled, so that timing a stage costs almost nothing"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+null_stage = NullStage()
+
+
+class StageTimer:
+    def __init__(self, profiler: 'Profiler', name: str):
+        self.profiler = profiler
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    """Total wall time and number of calls for each stage"""
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        # Stage name -> [call count, total seconds]
+        self.stages = {} #type: dict[str, list]
+
+    def stage(self, name: str):
+        """Use as 'with profiler.stage(name):' around the code to be timed"""
+        if not self.enabled:
+            return null_stage
+
+        return StageTimer(self, name)
+
+    def add(self, name: str, seconds: float, calls: int = 1):
+        if name not in self.stages:
+            self.stages[name] = [0, 0.0]
+
+        stage = self.stages[name]
+        stage[0] += calls
+        stage[1] += seconds
+
+    def merge(self, other: 'Profiler'):
+        for name, (calls, seconds) in other.stages.items():
+            self.add(name, seconds, calls)
+
+    def to_json(self):
+        # Slowest stages first
+        report = {}
+        for name, (calls, seconds) in sorted(self.stages.items(), key=lambda item: item[1][1], reverse=True):
+            report[name] = {
+                'calls': calls,
+                'total_seconds': round(seconds, 6),
+                'mean_microseconds': round(seconds / calls * 1e6, 3),
+            }
+
+        return report
+
+    def save(self, output_path: str):
+        common.write_file_atomic(output_path, json.dumps(self.to_json(), indent=4))
+
+
+def get_script_profile_path(script_path) -> str:
+    os.makedirs(os.path.join(profile_folder, 'script'), exist_ok=True)
+    return os.path.join(profile_folder, 'script', f'{Path(script_path).stem}.json')
+
+
+def get_aggregate_profile_path() -> str:
+    os.makedirs(profile_folder, exist_ok=True)
+    return os.path.join(profile_folder, 'aggregate.json')
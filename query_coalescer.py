@@ -0,0 +1,45 @@
+import threading
+from concurrent.futures import Future
+
+
+class QueryCoalescer:
+    """Runs each distinct query at most once.
+
+    Callers asking for a query which is already running wait for and share its result, instead of running it again.
+    Results are kept until the coalescer is discarded, so create one per scope (eg. per script run).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = {} #type: dict[object, Future]
+        # Number of queries answered by an earlier or in-flight query
+        self.hits = 0
+        # Number of queries which actually had to be run
+        self.misses = 0
+
+    def get(self, key, run_query):
+        """Returns the result of run_query() for this key, only calling run_query() if no other caller has done so"""
+        with self.lock:
+            future = self.results.get(key, None)
+            if future is None:
+                future = Future()
+                self.results[key] = future
+                self.misses += 1
+                is_owner = True
+            else:
+                self.hits += 1
+                is_owner = False
+
+        if not is_owner:
+            return future.result()
+
+        try:
+            result = run_query()
+        except BaseException as e:
+            # Don't keep failures, so that the query can be retried. Waiting callers still get the exception
+            with self.lock:
+                del self.results[key]
+            future.set_exception(e)
+            raise
+
+        future.set_result(result)
+        return result
@@ -0,0 +1,86 @@
+import argparse
+import os
+from pathlib import Path
+
+import trace_store
+from trace_store import ScriptTraceReader, TraceRecord
+
+# Print how graphics paths were matched, from the traces saved by main.py in the 'trace' folder. For example:
+#   python query_trace.py onik_001 --line 120
+#   python query_trace.py onik_001 --line 100-150
+#   python query_trace.py onik_001 --voice ps3/s19/01/440100001
+#   python query_trace.py onik_001 --mod-path sprite/kei7_warai_
+
+
+def format_record(record: TraceRecord) -> str:
+    out = f"Line No: {record.line_no} Voice: {record.voice} Line: {record.line.strip()}\n"
+    out += f"Mod path: {record.mod_path}\n"
+
+    if record.status == trace_store.status_matched:
+        out += f"Matched by {record.strategy}: {record.og_path}\n"
+    elif record.status == trace_store.status_already_matched:
+        out += f"Already matched earlier in this voice section (by {record.strategy}): {record.og_path}\n"
+    elif record.status == trace_store.status_missing_character:
+        out += "Not matched as the character is missing from the character database\n"
+    else:
+        out += "Failed to match\n"
+
+    if record.og_lines is None:
+        out += ">> OG lines were not needed <<\n"
+    else:
+        out += ">> Raw Git Log Output (vanilla -> mod) <<\n"
+        for og_line in record.og_lines:
+            out += f"{og_line}\n"
+        out += ">> END Git Log Output <<\n"
+
+    if record.candidates is not None:
+        for og_type, og_path, og_matching_key in record.candidates:
+            out += f"- Type: {og_type} Matching Key: {og_matching_key} Path: {og_path}\n"
+
+    return out
+
+
+def parse_line_range(line_range: str) -> tuple[int, int]:
+    if '-' in line_range:
+        first_line, last_line = line_range.split('-', maxsplit=1)
+        return int(first_line), int(last_line)
+
+    return int(line_range), int(line_range)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show how the graphics paths of a script were matched by the last scan")
+    parser.add_argument('script', help="Script name, eg. 'onik_001' or 'onik_001.txt'")
+    parser.add_argument('--line', help="Line number, or range of line numbers like '100-150'")
+    parser.add_argument('--voice', help="Only show lines played after this voice (before the next voice)")
+    parser.add_argument('--mod-path', help="Only show this mod graphics path")
+    args = parser.parse_args()
+
+    trace_path = trace_store.get_trace_path(Path(args.script).stem)
+    if not os.path.exists(trace_path):
+        raise Exception(f"No trace found at [{trace_path}], please run main.py with save_trace = True")
+
+    with ScriptTraceReader(trace_path) as reader:
+        if args.line is not None:
+            first_line, last_line = parse_line_range(args.line)
+            records = reader.find_lines(first_line, last_line)
+        elif args.voice is not None:
+            records = reader.find_voice(args.voice)
+        else:
+            records = sorted(reader.iter_records(), key=lambda record: record.line_no)
+
+        if args.voice is not None:
+            records = [record for record in records if record.voice == args.voice]
+
+        if args.mod_path is not None:
+            records = [record for record in records if record.mod_path == args.mod_path]
+
+        for record in records:
+            print(format_record(record))
+            print('----------------------------------------')
+
+        print(f"{len(records)}/{reader.record_count} records of [{reader.script_path}]")
+
+
+if __name__ == '__main__':
+    main()
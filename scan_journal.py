@@ -0,0 +1,125 @@
+import json
+import os
+from pathlib import Path
+
+from common import write_file_atomic
+
+# Journal of the og lines loaded while scanning a script, so that an interrupted scan (crash, Ctrl-C) can be resumed
+# without loading them from git again. The matches themselves are rebuilt by matching again from the start of the script,
+# which is fast once the og lines are known, and keeps the statistics, og candidates and trace complete.
+#
+# Each script has:
+#   [stem].journal: json lines, appended every flush_interval scanned lines. The first line is the script hash, then
+#     ["og_lines", line_no, og_lines] for each line whose og lines were loaded, and ["processed", line_no] after each flush
+#   [stem].snapshot.json: everything in the journal, compacted every snapshot_interval flushes (written atomically).
+#     The journal is then started again
+# Both are removed once the scan has finished and its results are saved.
+
+journal_folder = 'scan_journal'
+
+default_flush_interval = 200
+default_snapshot_interval = 20
+
+
+class ScanJournal:
+    def __init__(self, script_path: str, script_hash: str, flush_interval: int = default_flush_interval, snapshot_interval: int = default_snapshot_interval):
+        os.makedirs(journal_folder, exist_ok=True)
+        stem = Path(script_path).stem
+        self.journal_path = os.path.join(journal_folder, f'{stem}.journal')
+        self.snapshot_path = os.path.join(journal_folder, f'{stem}.snapshot.json')
+        self.script_hash = script_hash
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+
+        # Line number -> og lines, for everything journaled so far (including by an interrupted scan)
+        self.og_lines_per_line = {} #type: dict[int, list[str]]
+        # Entries not yet written to the journal
+        self.pending_entries = [] #type: list[list]
+        # Lines up to this were scanned by an interrupted scan
+        self.resume_line = 0
+        self.processed_line = 0
+        self.lines_since_flush = 0
+        self.flushes_since_snapshot = 0
+
+        self._load()
+
+    def _load(self):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+
+            if snapshot['script_hash'] == self.script_hash:
+                self.og_lines_per_line = {line_no: og_lines for line_no, og_lines in snapshot['og_lines']}
+                self.resume_line = snapshot['processed_line']
+
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, encoding='utf-8') as f:
+                for i, line in enumerate(f):
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # The last entry may be incomplete if the scan was interrupted while writing it
+                        break
+
+                    if i == 0:
+                        # Journal of a different version of the script
+                        if entry != ['script_hash', self.script_hash]:
+                            break
+                    elif entry[0] == 'og_lines':
+                        _, line_no, og_lines = entry
+                        self.og_lines_per_line[line_no] = og_lines
+                    elif entry[0] == 'processed':
+                        self.resume_line = max(self.resume_line, entry[1])
+
+        self.processed_line = self.resume_line
+
+        # Start a new journal containing only what is still valid
+        self.compact()
+
+    def try_get_og_lines(self, line_no: int) -> list[str]:
+        return self.og_lines_per_line.get(line_no, None)
+
+    def add_og_lines(self, line_no: int, og_lines: list[str]):
+        if line_no not in self.og_lines_per_line:
+            self.og_lines_per_line[line_no] = og_lines
+            self.pending_entries.append(['og_lines', line_no, og_lines])
+
+    def line_done(self, line_no: int):
+        """Call after each line has been scanned"""
+        self.lines_since_flush += 1
+        if self.lines_since_flush >= self.flush_interval:
+            self.flush(line_no)
+
+    def flush(self, processed_line: int):
+        self.pending_entries.append(['processed', processed_line])
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            for entry in self.pending_entries:
+                f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.pending_entries = []
+        self.processed_line = processed_line
+        self.lines_since_flush = 0
+
+        self.flushes_since_snapshot += 1
+        if self.flushes_since_snapshot >= self.snapshot_interval:
+            self.compact()
+
+    def compact(self):
+        """Save everything journaled so far as a snapshot, then start a new journal"""
+        snapshot = {
+            'script_hash': self.script_hash,
+            'processed_line': self.processed_line,
+            'og_lines': list(self.og_lines_per_line.items()),
+        }
+        write_file_atomic(self.snapshot_path, json.dumps(snapshot))
+
+        # If interrupted before this, the old journal entries are loaded again on top of the snapshot, which gives the same result
+        write_file_atomic(self.journal_path, json.dumps(['script_hash', self.script_hash]) + '\n')
+        self.flushes_since_snapshot = 0
+
+    def finish(self):
+        """Remove the journal once the results of the scan have been saved"""
+        Path(self.journal_path).unlink(missing_ok=True)
+        Path(self.snapshot_path).unlink(missing_ok=True)
@@ -0,0 +1,201 @@
+import hashlib
+import io
+import json
+import os
+import re
+import zlib
+from pathlib import Path
+
+from common import write_file_atomic
+import graphics_identifier
+import voice_util
+
+# Reads a modded script once, and yields the tokens on each line as typed events, shared by main.py and verification_and_fallback_matching.py:
+#   LineEvent: every line, with the comments removed
+#   VoiceEvent: a voice played on the line
+#   GraphicsPathEvent: a mod graphics path (graphics_identifier.MOD_CG_REGEX)
+#   StringEvent: every double quoted string
+# The events of each line are in that order. The tokens are cached per script (keyed by a hash of the script and of the
+# tokenizer, see get_tokenizer_hash()) in token_cache_folder,
+# so that re-running either script, or verifying after a scan, doesn't need to tokenize unchanged scripts again.
+#
+# Cache file: zlib compressed json, with [line number, voice, graphics paths, strings] for each line which has any tokens
+
+token_cache_folder = 'token_cache'
+
+format_version = 1
+
+# Increase this whenever tokenize_line() changes how a line is tokenized, so that tokens cached by the old code aren't used
+tokenizer_version = 1
+
+# Find double quoted strings, including ones with escaped double quotes
+string_regex = re.compile(r'"(?P<data>((\\")|([^"]))*?)"')
+
+
+class LineEvent:
+    def __init__(self, line_no: int, raw_line: str, text: str):
+        self.line_no = line_no
+        self.raw_line = raw_line
+        # The line with any comment removed
+        self.text = text
+
+
+class VoiceEvent:
+    def __init__(self, line_no: int, voice: str):
+        self.line_no = line_no
+        self.voice = voice
+
+
+class GraphicsPathEvent:
+    def __init__(self, line_no: int, column: int, path: str):
+        self.line_no = line_no
+        # Position of the path in the line (0 based)
+        self.column = column
+        self.path = path
+
+
+class StringEvent:
+    def __init__(self, line_no: int, column: int, data: str):
+        self.line_no = line_no
+        # Position of the string's contents in the line (0 based)
+        self.column = column
+        # Contents of the string, without the quotes
+        self.data = data
+
+
+class ScriptLine:
+    """All the events of one line, for when a script needs to be looked at more than once (see read_script_lines())"""
+    def __init__(self, line_event: LineEvent):
+        self.line_no = line_event.line_no
+        self.raw_line = line_event.raw_line
+        self.text = line_event.text
+        self.voice = None #type: str
+        self.graphics_paths = [] #type: list[GraphicsPathEvent]
+        self.strings = [] #type: list[StringEvent]
+
+
+def get_token_cache_path(script_path: str) -> str:
+    os.makedirs(token_cache_folder, exist_ok=True)
+    return os.path.join(token_cache_folder, f'{Path(script_path).stem}.tokens')
+
+
+def strip_comment(line: str) -> str:
+    return line.split('//', maxsplit=1)[0]
+
+
+def tokenize_line(line_no: int, raw_line: str) -> list:
+    """[line number, voice, [[column, graphics path], ...], [[column, string], ...]] (the format saved in the cache)"""
+    if '"' not in raw_line:
+        return [line_no, None, [], []]
+
+    # The voice is found on the whole line, the same as before comments were removed when scanning
+    voice = voice_util.get_voice_on_line(raw_line)
+    text = strip_comment(raw_line)
+    graphics_paths = [[match.start(1), match.group(1)] for match in graphics_identifier.MOD_CG_REGEX.finditer(text)]
+    strings = [[match.start('data'), match.group('data')] for match in string_regex.finditer(text)]
+    return [line_no, voice, graphics_paths, strings]
+
+
+def get_tokenizer_hash() -> str:
+    """Hash of everything other than the script which the tokens depend on (the tokenizer and the regexes it uses)"""
+    tokenizer_hash = hashlib.sha1()
+    for part in [str(tokenizer_version), *graphics_identifier.MOD_CG_LIST, graphics_identifier.MOD_CG_REGEX.pattern, voice_util.voicePathRegex.pattern, string_regex.pattern]:
+        tokenizer_hash.update(part.encode('utf-8'))
+        tokenizer_hash.update(b'\0')
+
+    return tokenizer_hash.hexdigest()
+
+
+def load_cached_tokens(cache_path: str, script_hash: str, tokenizer_hash: str) -> dict[int, list]:
+    """Line number -> tokens, or None if the script or the tokenizer has changed since it was cached"""
+    if not os.path.exists(cache_path):
+        return None
+
+    with open(cache_path, 'rb') as f:
+        try:
+            data = json.loads(zlib.decompress(f.read()))
+        except (zlib.error, json.JSONDecodeError):
+            return None
+
+    if data['format_version'] != format_version or data['script_hash'] != script_hash or data.get('tokenizer_hash', None) != tokenizer_hash:
+        return None
+
+    return {tokens[0]: tokens for tokens in data['lines']}
+
+
+def save_cached_tokens(cache_path: str, script_hash: str, tokenizer_hash: str, all_tokens: list[list]):
+    data = {
+        'format_version': format_version,
+        'script_hash': script_hash,
+        'tokenizer_hash': tokenizer_hash,
+        'lines': all_tokens,
+    }
+    write_file_atomic(cache_path, zlib.compress(json.dumps(data).encode('utf-8')))
+
+
+def iter_line_events(all_lines: list[str], cached_tokens: dict[int, list] = None, new_tokens: list[list] = None):
+    """Yields the events of each line in order. If cached_tokens is given the lines aren't tokenized again,
+    otherwise the tokens of each line which has any are added to new_tokens (if given)"""
+    for line_index, raw_line in enumerate(all_lines):
+        line_no = line_index + 1
+        if cached_tokens is not None:
+            tokens = cached_tokens.get(line_no, None)
+        else:
+            tokens = tokenize_line(line_no, raw_line)
+            if new_tokens is not None and (tokens[1] is not None or tokens[2] or tokens[3]):
+                new_tokens.append(tokens)
+
+        yield LineEvent(line_no, raw_line, strip_comment(raw_line))
+
+        if tokens is None:
+            continue
+
+        _, voice, graphics_paths, strings = tokens
+        if voice is not None:
+            yield VoiceEvent(line_no, voice)
+
+        for column, path in graphics_paths:
+            yield GraphicsPathEvent(line_no, column, path)
+
+        for column, data in strings:
+            yield StringEvent(line_no, column, data)
+
+
+def iter_script_events(script_path: str, use_cache: bool = True):
+    """Yields the events of each line of the script in order. The cache is only saved once every line has been read"""
+    with open(script_path, 'rb') as f:
+        script_data = f.read()
+
+    # Split the lines in exactly the same way as reading the file as text
+    all_lines = io.TextIOWrapper(io.BytesIO(script_data), encoding='utf-8').readlines()
+
+    if not use_cache:
+        yield from iter_line_events(all_lines)
+        return
+
+    script_hash = hashlib.sha1(script_data).hexdigest()
+    cache_path = get_token_cache_path(script_path)
+    tokenizer_hash = get_tokenizer_hash()
+    cached_tokens = load_cached_tokens(cache_path, script_hash, tokenizer_hash)
+    if cached_tokens is not None:
+        yield from iter_line_events(all_lines, cached_tokens)
+    else:
+        new_tokens = []
+        yield from iter_line_events(all_lines, new_tokens=new_tokens)
+        save_cached_tokens(cache_path, script_hash, tokenizer_hash, new_tokens)
+
+
+def read_script_lines(script_path: str, use_cache: bool = True) -> list[ScriptLine]:
+    """All events of the script, grouped by line"""
+    script_lines = []
+    for event in iter_script_events(script_path, use_cache):
+        if isinstance(event, LineEvent):
+            script_lines.append(ScriptLine(event))
+        elif isinstance(event, VoiceEvent):
+            script_lines[-1].voice = event.voice
+        elif isinstance(event, GraphicsPathEvent):
+            script_lines[-1].graphics_paths.append(event)
+        else:
+            script_lines[-1].strings.append(event)
+
+    return script_lines
@@ -0,0 +1,224 @@
+import json
+import os
+import struct
+import zlib
+from pathlib import Path
+
+# A record of how every graphics path in a script was matched, to find out why a path matched the way it did (see query_trace.py).
+#
+# File format (one file per script):
+#   magic (8 bytes)
+#   chunks: each is a zlib compressed json list of up to records_per_chunk records, appended while the script is scanned
+#   index: zlib compressed json, with the offset, size, line range and voices of each chunk, so a query only decompresses the chunks it needs
+#   footer: index offset (u64), index size (u64), magic (8 bytes)
+# The file is written to a temporary file and moved into place once complete.
+
+trace_folder = 'trace'
+
+magic = b'OGTRACE\x00'
+format_version = 1
+
+footer_struct = struct.Struct('<QQ8s')
+
+records_per_chunk = 256
+
+# How the graphics path was handled
+status_matched = 'matched'
+status_failed = 'failed'
+status_missing_character = 'missing_character'
+# Another line in the same voice section already matched this path
+status_already_matched = 'already_matched'
+
+
+def get_trace_path(mod_script_path: str) -> str:
+    os.makedirs(trace_folder, exist_ok=True)
+    return os.path.join(trace_folder, f'{Path(mod_script_path).stem}.trace')
+
+
+class TraceRecord:
+    """How one graphics path on one line of a modded script was matched"""
+    def __init__(self, line_no: int, line: str, voice: str, mod_path: str, status: str, og_path: str = None, strategy: str = None, og_lines: list[str] = None, candidates: list[list[str]] = None):
+        self.line_no = line_no
+        self.line = line
+        self.voice = voice
+        self.mod_path = mod_path
+        self.status = status
+        # None if there was no match
+        self.og_path = og_path
+        # Name of the matching strategy which found the match
+        self.strategy = strategy
+        # None if the og lines were never loaded
+        self.og_lines = og_lines
+        # [type, path, matching key] of each graphics path found in the og lines, or None if they weren't needed
+        self.candidates = candidates
+        # Position of this line among all lines of the same voice. Used to copy records of unchanged voice sections when scanning incrementally
+        self.voice_line_index = None #type: int
+
+    def to_json(self):
+        return {
+            'line_no': self.line_no,
+            'line': self.line,
+            'voice': self.voice,
+            'mod_path': self.mod_path,
+            'status': self.status,
+            'og_path': self.og_path,
+            'strategy': self.strategy,
+            'og_lines': self.og_lines,
+            'candidates': self.candidates,
+            'voice_line_index': self.voice_line_index,
+        }
+
+    @staticmethod
+    def from_json(data) -> 'TraceRecord':
+        record = TraceRecord(data['line_no'], data['line'], data['voice'], data['mod_path'], data['status'], data['og_path'], data['strategy'], data['og_lines'], data['candidates'])
+        record.voice_line_index = data['voice_line_index']
+        return record
+
+
+class ScriptTraceWriter:
+    """Writes the trace of one script while it is being scanned. Call begin_line() for each line of the script, then add() for each graphics path on it"""
+    def __init__(self, script_path: str, output_path: str, previous_records: list[TraceRecord]):
+        self.script_path = str(script_path)
+        self.output_path = output_path
+        self.temp_path = f'{output_path}.{os.getpid()}.tmp'
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(magic)
+
+        self.pending_records = [] #type: list[TraceRecord]
+        # [offset, size, first line, last line, voices] of each chunk written so far
+        self.chunks = [] #type: list[list]
+        self.record_count = 0
+
+        self.voice_line_counts = {} #type: dict[str, int]
+        self.line_no = None #type: int
+        self.voice = None #type: str
+        self.voice_line_index = None #type: int
+
+        # Records from the last time the script was traced, so that skipped voice sections can be copied
+        self.previous_records = {} #type: dict[tuple[str, int], list[TraceRecord]]
+        self.previous_voice_line_index = {} #type: dict[tuple[str, int], int]
+        for record in previous_records:
+            if record.voice_line_index is not None:
+                self.previous_records.setdefault((record.voice, record.voice_line_index), []).append(record)
+                self.previous_voice_line_index[(record.voice, record.line_no)] = record.voice_line_index
+
+    def begin_line(self, line_no: int, voice: str):
+        self.line_no = line_no
+        self.voice = voice
+        self.voice_line_index = self.voice_line_counts.get(voice, 0)
+        self.voice_line_counts[voice] = self.voice_line_index + 1
+
+    def begin_recorded_line(self, line_no: int, voice: str):
+        """Same as begin_line(), for when re-matching without the script (only lines with graphics are known)"""
+        self.line_no = line_no
+        self.voice = voice
+        self.voice_line_index = self.previous_voice_line_index.get((voice, line_no), None)
+
+    def add(self, record: TraceRecord):
+        record.voice_line_index = self.voice_line_index
+        self.pending_records.append(record)
+        if len(self.pending_records) >= records_per_chunk:
+            self._write_chunk()
+
+    def copy_previous_line(self):
+        """Copy the records of the current line from the previous trace, for a voice section which was skipped as it hasn't changed"""
+        for previous_record in self.previous_records.get((self.voice, self.voice_line_index), []):
+            record = TraceRecord.from_json(previous_record.to_json())
+            # Lines before this voice section may have been added or removed
+            record.line_no = self.line_no
+            self.add(record)
+
+    def _write_chunk(self):
+        if not self.pending_records:
+            return
+
+        data = zlib.compress(json.dumps([record.to_json() for record in self.pending_records]).encode('utf-8'))
+        line_numbers = [record.line_no for record in self.pending_records]
+        voices = sorted(set(record.voice for record in self.pending_records), key=lambda voice: (voice is not None, voice))
+        self.chunks.append([self.file.tell(), len(data), min(line_numbers), max(line_numbers), voices])
+        self.file.write(data)
+
+        self.record_count += len(self.pending_records)
+        self.pending_records = []
+
+    def finish(self):
+        self._write_chunk()
+
+        index = {
+            'format_version': format_version,
+            'script_path': self.script_path,
+            'record_count': self.record_count,
+            'chunks': self.chunks,
+        }
+        index_data = zlib.compress(json.dumps(index).encode('utf-8'))
+        index_offset = self.file.tell()
+        self.file.write(index_data)
+        self.file.write(footer_struct.pack(index_offset, len(index_data), magic))
+        self.file.close()
+
+        os.replace(self.temp_path, self.output_path)
+
+
+class ScriptTraceReader:
+    def __init__(self, input_path: str):
+        self.input_path = input_path
+        self.file = open(input_path, 'rb')
+
+        self.file.seek(-footer_struct.size, os.SEEK_END)
+        index_offset, index_size, footer_magic = footer_struct.unpack(self.file.read(footer_struct.size))
+        if footer_magic != magic:
+            raise Exception(f"[{input_path}] is not a trace file, or was not completely written")
+
+        self.file.seek(index_offset)
+        index = json.loads(zlib.decompress(self.file.read(index_size)))
+        if index['format_version'] != format_version:
+            raise Exception(f"Trace [{input_path}] has format version {index['format_version']}, but expected {format_version}")
+
+        self.script_path = index['script_path']
+        self.record_count = index['record_count']
+        self.chunks = index['chunks']
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_chunk(self, chunk) -> list[TraceRecord]:
+        offset, size, _first_line, _last_line, _voices = chunk
+        self.file.seek(offset)
+        return [TraceRecord.from_json(data) for data in json.loads(zlib.decompress(self.file.read(size)))]
+
+    def iter_records(self):
+        for chunk in self.chunks:
+            for record in self._read_chunk(chunk):
+                yield record
+
+    def find_lines(self, first_line: int, last_line: int) -> list[TraceRecord]:
+        records = []
+        for chunk in self.chunks:
+            _offset, _size, chunk_first_line, chunk_last_line, _voices = chunk
+            if chunk_first_line <= last_line and first_line <= chunk_last_line:
+                records += [record for record in self._read_chunk(chunk) if first_line <= record.line_no <= last_line]
+
+        return sorted(records, key=lambda record: record.line_no)
+
+    def find_voice(self, voice: str) -> list[TraceRecord]:
+        records = []
+        for chunk in self.chunks:
+            if voice in chunk[4]:
+                records += [record for record in self._read_chunk(chunk) if record.voice == voice]
+
+        return sorted(records, key=lambda record: record.line_no)
+
+
+def load_trace_records(input_path: str) -> list[TraceRecord]:
+    """All records of a trace, or an empty list if the script hasn't been traced"""
+    if not os.path.exists(input_path):
+        return []
+
+    with ScriptTraceReader(input_path) as reader:
+        return list(reader.iter_records())
@@ -1,12 +1,16 @@
 
+import hashlib
 import json
 import operator
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import re
+import binary_mapping
 import common
 from common import VoiceMatchDatabase
-import voice_util
+from graphics_scanner import GraphicsPathClassifier, iter_graphics_paths
+import script_tokenizer
+import voice_snapshots
 
 PRINT_FAILED_MATCHES = False
 
@@ -21,30 +25,6 @@ def should_output_mapping(ps3_path: str, sprite_mode: bool):
     else:
         return not is_sprite
 
-# Outputs a dictionary, mapping 'last played voice' to another dict.
-# The inner dict maps from mod path -> og path
-def convert_database_to_dict(voice_database: VoiceMatchDatabase, sprite_mode: bool) -> dict[str, dict[str, str]]:
-    ret = {}
-    for voice, matches_after_voice in voice_database.db.items():
-        # Convert None to the empty string as [null] is an invalid JSON key
-        if voice is None:
-            voice = ""
-        else:
-            voice = str(voice)
-
-        matches_per_voice = {}
-
-        for match in matches_after_voice:
-            mod_path = normalize_path(match.mod_path)
-            og_path = normalize_path(match.og_path)
-            if should_output_mapping(mod_path, sprite_mode):
-                matches_per_voice[mod_path] = og_path
-
-        ret[voice] = matches_per_voice
-
-    return ret
-
-
 class FallbackMatch:
     def __init__(self, fallback_match_path: str, source_description: str) -> None:
         self.fallback_match_path = fallback_match_path
@@ -76,6 +56,39 @@ class AllMatchData:
         self.per_script_voice_database[script_name] = voice_database
 
 
+class VoiceDatabaseRepository:
+    """Loads each script's voice database at most once, so the statistics, verification and json output all use the same objects"""
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max_workers
+        # Script name (stem) -> database
+        self.databases = {} #type: dict[str, VoiceMatchDatabase]
+        self.load_count = 0
+
+    @staticmethod
+    def _load(modded_script_path: str) -> VoiceMatchDatabase:
+        return VoiceMatchDatabase.deserialize(common.get_voice_db_path(modded_script_path))
+
+    def preload(self, modded_script_paths: list[str]):
+        """Load the databases of many scripts at once, reading the files in parallel"""
+        to_load = [path for path in modded_script_paths if Path(path).stem not in self.databases]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for path, voice_database in zip(to_load, executor.map(VoiceDatabaseRepository._load, to_load)):
+                self.databases[Path(path).stem] = voice_database
+                self.load_count += 1
+
+    def get(self, modded_script_path: str) -> VoiceMatchDatabase:
+        script_name = Path(modded_script_path).stem
+        if script_name not in self.databases:
+            self.databases[script_name] = VoiceDatabaseRepository._load(modded_script_path)
+            self.load_count += 1
+
+        return self.databases[script_name]
+
+    def unload(self, modded_script_path: str):
+        """Release a database which is no longer needed. It will be loaded again if requested later"""
+        self.databases.pop(Path(modded_script_path).stem, None)
+
+
 def get_fallback_dict_for_json(fallback: dict[str, FallbackMatch], save_source_info: bool, sprite_mode: bool):
     # Convert fallback matching to dict
     fallback_for_json = {}
@@ -88,71 +101,350 @@ def get_fallback_dict_for_json(fallback: dict[str, FallbackMatch], save_source_i
 
     return fallback_for_json
 
-def save_to_json(object, output_path: str):
-    json_string = json.dumps(object, sort_keys=True, indent='\t')
+mapping_comment_paths = "Note: when looking up paths, paths starting with '<' like <SPECIAL_TEXT_EFFECT>  are special cases. And if a match is 'null' then it means this sprite was never matched."
+mapping_comment_lookup = "To lookup, first check the voice database. Then check the script fallback. Then check the global fallback."
+
+def to_indented_json(object, depth: int) -> str:
+    """Same as json.dumps(sort_keys=True, indent='\\t'), but for an object nested 'depth' levels deep in the output.
+    This is safe because json strings never contain a raw newline"""
+    return json.dumps(object, sort_keys=True, indent='\t').replace('\n', '\n' + '\t' * depth)
+
+####################  Delta Output ####################
+# In delta mode, entries are left out of the mapping.json if the game would find the same mapping without them.
+# An entry is only dropped if this is true both when the game looks up each voice separately ('comment_lookup' in the output),
+# and when the game keeps a dictionary which is updated at each voice and cleared at the start of each script (see README.md),
+# in whatever order the voices are played.
+# If a mod path isn't found in the voice database, it is looked up in the script fallback, then the global fallback.
+
+def resolve_fallback(script_fallback: dict[str, str], global_fallback: dict[str, str], mod_path: str) -> str:
+    if mod_path in script_fallback:
+        return script_fallback[mod_path]
+
+    return global_fallback.get(mod_path, None)
+
+def get_delta_script_fallback(script_fallback: dict[str, str], global_fallback: dict[str, str]) -> dict[str, str]:
+    return {mod_path: og_path for mod_path, og_path in script_fallback.items() if global_fallback.get(mod_path, None) != og_path}
+
+def get_delta_voice_database(voice_database: dict[str, dict[str, str]], script_fallback: dict[str, str], global_fallback: dict[str, str]) -> dict[str, dict[str, str]]:
+    # If any entry for a mod path is different from the fallback, all entries for that mod path are kept.
+    # Otherwise with a cumulative dictionary, an earlier voice's entry could be used instead of the fallback
+    differs_from_fallback = set()
+    for mapping in voice_database.values():
+        for mod_path, og_path in mapping.items():
+            if og_path != resolve_fallback(script_fallback, global_fallback, mod_path):
+                differs_from_fallback.add(mod_path)
+
+    delta_voice_database = {}
+    for voice, mapping in voice_database.items():
+        delta_mapping = {mod_path: og_path for mod_path, og_path in mapping.items() if mod_path in differs_from_fallback}
+
+        # Voices without any entries are the same as voices which don't exist
+        if delta_mapping:
+            delta_voice_database[voice] = delta_mapping
+
+    return delta_voice_database
+
+def resolve_all(voice_database: dict[str, dict[str, str]], voice_order: list[str], script_fallback: dict[str, str], global_fallback: dict[str, str], mod_paths: set[str], cumulative: bool) -> dict[tuple[str, str], str]:
+    """Returns what the game would display for each mod path after each voice of one script, as (voice, mod path) -> og path"""
+    resolved = {}
+    current_mapping = {}
+    for voice in voice_order:
+        if cumulative:
+            current_mapping.update(voice_database[voice])
+        else:
+            current_mapping = voice_database[voice]
+
+        for mod_path in mod_paths:
+            if mod_path in current_mapping:
+                resolved[(voice, mod_path)] = current_mapping[mod_path]
+            else:
+                resolved[(voice, mod_path)] = resolve_fallback(script_fallback, global_fallback, mod_path)
+
+    return resolved
+
+def verify_delta_mapping(script_name: str, voice_database: dict[str, dict[str, str]], delta_voice_database: dict[str, dict[str, str]], script_fallback: dict[str, str], delta_script_fallback: dict[str, str], global_fallback: dict[str, str]):
+    """Raise an exception if any mod path after any voice of the script would display differently with the delta mapping"""
+    mod_paths = set(script_fallback)
+    for mapping in voice_database.values():
+        mod_paths.update(mapping)
+
+    # Voices which were dropped still need to be looked up
+    delta_voice_database_all_voices = {voice: delta_voice_database.get(voice, {}) for voice in voice_database}
+
+    # The order voices are played in isn't known here, so check the cumulative dictionary with voices played forwards and backwards
+    forwards = list(voice_database)
+    backwards = list(reversed(forwards))
+    for cumulative, voice_order in [(False, forwards), (True, forwards), (True, backwards)]:
+        expected = resolve_all(voice_database, voice_order, script_fallback, global_fallback, mod_paths, cumulative)
+        actual = resolve_all(delta_voice_database_all_voices, voice_order, delta_script_fallback, global_fallback, mod_paths, cumulative)
+        for key, expected_og_path in expected.items():
+            if actual[key] != expected_og_path:
+                voice, mod_path = key
+                raise Exception(f"Delta mapping for script [{script_name}] voice [{voice}] mod path [{mod_path}] resolves to [{actual[key]}] instead of [{expected_og_path}] (cumulative: {cumulative})")
+
+
+class SplitMappingWriter:
+    """Writes the mapping in the layout described in README.md: 'mapping/default.json' with the global fallback,
+    and 'mapping/script/[script name].json' with the script fallback and voice database of each script,
+    so the game only needs to load the script which is playing. 'mapping/manifest.json' lists the size and sha256 of each file"""
+    def __init__(self, folder: Path, minified: bool):
+        self.folder = Path(folder)
+        self.minified = minified
+        self.manifest = {
+            'default': None,
+            'scripts': {},
+        }
+        os.makedirs(self.folder.joinpath('script'), exist_ok=True)
+
+    def _write(self, relative_path: str, object) -> dict:
+        if self.minified:
+            json_string = json.dumps(object, sort_keys=True, separators=(',', ':'))
+        else:
+            json_string = json.dumps(object, sort_keys=True, indent='\t')
+
+        json_bytes = json_string.encode('utf-8')
+        common.write_file_atomic(self.folder.joinpath(relative_path), json_bytes)
+
+        return {
+            'path': relative_path,
+            'size': len(json_bytes),
+            'sha256': hashlib.sha256(json_bytes).hexdigest(),
+        }
+
+    def save_default(self, global_fallback: dict[str, str]):
+        self.manifest['default'] = self._write('default.json', global_fallback)
+
+    def save_script(self, script_name: str, script_fallback: dict[str, str], voice_database: dict[str, dict[str, str]]):
+        self.manifest['scripts'][script_name] = self._write(f'script/{script_name}.json', {
+            'script_fallback': script_fallback,
+            'voice_database': voice_database,
+        })
+
+    def finish(self):
+        # Remove files for scripts which no longer exist, so they aren't loaded by mistake
+        for script_path in self.folder.joinpath('script').glob('*.json'):
+            if script_path.stem not in self.manifest['scripts']:
+                print(f"Removing mapping for old script [{script_path}]")
+                script_path.unlink()
+
+        self._write('manifest.json', self.manifest)
+
+
+class MappingFileWriter:
+    """Writes one mapping.json file, in the same format as json.dumps(sort_keys=True, indent='\\t').
+
+    The fallbacks are written first by begin(), so they must all be added before then (see save_mapping_files()).
+    The voice database of each script is then written as soon as it is added, so only one script's voice database
+    needs to be kept in memory. Scripts must be added in sorted order, as the keys are written in sorted order.
+
+    If delta is True, entries which the game would resolve to the same mapping anyway are left out (see get_delta_voice_database()),
+    and the file is written as minified json.
+
+    If split is True, the same data is also written split into one file per script (see SplitMappingWriter).
+
+    If snapshot_interval is not None, 'mapping/snapshot/[script name].json' is written for each script, so a save
+    can be restored without replaying the whole script (see voice_snapshots.py).
+
+    If binary is True, the same data is also written to 'mapping.bin' (see binary_mapping.py)"""
+    def __init__(self, output_path: Path, delta: bool = False, split: bool = False, snapshot_interval: int = None, binary: bool = False):
+        self.output_path = Path(output_path)
+        self.delta = delta
+        self.binary = binary
+        self.binary_writer = None #type: binary_mapping.BinaryMappingWriter
+        self.split_writer = None #type: SplitMappingWriter
+        if split:
+            self.split_writer = SplitMappingWriter(self.output_path.parent.joinpath('mapping'), minified=delta)
+
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_folder = self.output_path.parent.joinpath('mapping', 'snapshot')
+        if snapshot_interval is not None:
+            os.makedirs(self.snapshot_folder, exist_ok=True)
+        # While doing this includes redundant data, this allows us to change the sprite mapping later if we find one of the global fallbacks is wrong
+        self.global_fallback = {} #type: dict[str, str]
+        self.script_fallback = {} #type: dict[str, dict[str, str]]
+        # Only used in delta mode
+        self.delta_script_fallback = {} #type: dict[str, dict[str, str]]
+        self.total_entries = 0
+        self.kept_entries = 0
+
+        # Names of the scripts whose voice database has been written
+        self.script_names = [] #type: list[str]
+        self.temp_path = self.output_path.with_suffix(self.output_path.suffix + f'.{os.getpid()}.tmp')
+        self.file = None
+
+    def add_voice_database_fallback(self, voice_database: dict[str, dict[str, str]]):
+        # Lowest priority for the global fallback is per-script mapping
+        for mapping in voice_database.values():
+            self.global_fallback.update(mapping)
+
+    def add_script_fallback(self, script_name: str, fallback: dict[str, str]):
+        # Next priority is per-script fallback
+        self.global_fallback.update(fallback)
+        self.script_fallback[script_name] = fallback
+
+    def add_global_fallback(self, fallback: dict[str, str]):
+        # Highest priority is global fallback, which overwrites all other entries
+        self.global_fallback.update(fallback)
+
+    def begin(self):
+        """Write everything before the voice databases. Call once all the fallbacks have been added"""
+        if self.split_writer is not None:
+            self.split_writer.save_default(self.global_fallback)
+
+        if self.binary:
+            self.binary_writer = binary_mapping.BinaryMappingWriter(self.output_path.with_suffix('.bin'))
+            self.binary_writer.set_global_fallback(self.global_fallback)
+
+        self.file = open(self.temp_path, 'w', encoding='utf-8')
+        if self.delta:
+            for script_name, fallback in self.script_fallback.items():
+                self.delta_script_fallback[script_name] = get_delta_script_fallback(fallback, self.global_fallback)
+
+            self.file.write('{')
+            self.file.write(f'"comment_lookup":{json.dumps(mapping_comment_lookup)},')
+            self.file.write(f'"comment_paths":{json.dumps(mapping_comment_paths)},')
+            self.file.write(f'"global_fallback":{json.dumps(self.global_fallback, sort_keys=True, separators=(",", ":"))},')
+            self.file.write(f'"script_fallback":{json.dumps(self.delta_script_fallback, sort_keys=True, separators=(",", ":"))},')
+            self.file.write('"voice_database":{')
+        else:
+            # Keys are written in sorted order
+            self.file.write('{\n')
+            self.file.write(f'\t"comment_lookup": {json.dumps(mapping_comment_lookup)},\n')
+            self.file.write(f'\t"comment_paths": {json.dumps(mapping_comment_paths)},\n')
+            self.file.write(f'\t"global_fallback": {to_indented_json(self.global_fallback, depth=1)},\n')
+            self.file.write(f'\t"script_fallback": {to_indented_json(self.script_fallback, depth=1)},\n')
+            self.file.write('\t"voice_database": ')
+
+    def add_voice_database(self, script_name: str, voice_database: dict[str, dict[str, str]]):
+        if self.script_names and script_name <= self.script_names[-1]:
+            raise Exception(f"Voice database for script [{script_name}] was added after [{self.script_names[-1]}], but scripts must be added in sorted order")
+
+        if self.delta:
+            self._write_delta_voice_database(script_name, voice_database)
+        else:
+            self._write_full_voice_database(script_name, voice_database)
+
+        self.script_names.append(script_name)
 
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(json_string)
+        # voice_database is in the order voices are played
+        if self.snapshot_interval is not None:
+            snapshots = voice_snapshots.build_snapshots(voice_database, self.snapshot_interval)
+            voice_snapshots.verify_snapshots(script_name, voice_database, snapshots)
+            common.write_file_atomic(self.snapshot_folder.joinpath(f'{script_name}.json'), json.dumps(snapshots.to_json(), separators=(',', ':')))
 
-# While doing this includes redundant data, this allows us to change the sprite mapping later if we find one of the global fallbacks is wrong
-def build_global_fallback(voice_database: dict[str, dict[str, dict[str, str]]], script_fallback: dict[str, dict[str, str]], global_fallback: dict[str, str]):
+    def save(self):
+        if self.delta:
+            self.file.write('}}')
+        elif self.script_names:
+            self.file.write('\n\t}\n}')
+        else:
+            self.file.write('{}\n}')
 
-    final_global_fallback = {} #type: dict[str, str]
+        self.file.close()
+        os.replace(self.temp_path, self.output_path)
 
-    # Lowest priority is per-script mapping
-    for script, voiceDict in voice_database.items():
-        for voice, mapping in voiceDict.items():
-            final_global_fallback.update(mapping)
+        if self.delta:
+            print(f"Delta mapping [{self.output_path}]: kept {self.kept_entries}/{self.total_entries} voice database entries ({os.path.getsize(self.output_path)} bytes)")
 
-    # Next priority is per-script fallback
-    for script, mapping in script_fallback.items():
-        final_global_fallback.update(mapping)
+        if self.split_writer is not None:
+            self.split_writer.finish()
 
-    # Highest priority is global fallback, which overwrites all other entries
-    final_global_fallback.update(global_fallback)
+        if self.binary_writer is not None:
+            self.binary_writer.save()
+            binary_mapping.verify_binary_mapping(self.output_path, self.binary_writer.output_path)
 
-    return final_global_fallback
+        if self.snapshot_interval is not None:
+            for snapshot_path in self.snapshot_folder.glob('*.json'):
+                if snapshot_path.stem not in self.script_names:
+                    print(f"Removing snapshots for old script [{snapshot_path}]")
+                    snapshot_path.unlink()
 
+    def _save_script_to_other_formats(self, script_name: str, script_fallback: dict[str, str], voice_database: dict[str, dict[str, str]]):
+        if self.split_writer is not None:
+            self.split_writer.save_script(script_name, script_fallback, voice_database)
 
-def get_match_data_as_plain_dict(match_data: AllMatchData, save_debug_info: bool, sprite_mode: bool):
-    # Collect all script fallbacks into a dict
-    script_fallback = {}
-    for script_name, per_script_fallback in match_data.per_script_fallbacks.items():
-        script_fallback[script_name] = get_fallback_dict_for_json(per_script_fallback, save_source_info=save_debug_info, sprite_mode=sprite_mode)
+        if self.binary_writer is not None:
+            self.binary_writer.add_script(script_name, script_fallback, voice_database)
 
-    all_voice_database = {}
-    for script_path_object, voice_database in match_data.per_script_voice_database.items():
-        all_voice_database[Path(script_path_object).stem] = convert_database_to_dict(voice_database, sprite_mode)
+    def _write_delta_voice_database(self, script_name: str, voice_database: dict[str, dict[str, str]]):
+        script_fallback = self.script_fallback.get(script_name, {})
+        delta_script_fallback = self.delta_script_fallback.get(script_name, {})
+        delta_voice_database = get_delta_voice_database(voice_database, script_fallback, self.global_fallback)
+        if verify_delta_output:
+            verify_delta_mapping(script_name, voice_database, delta_voice_database, script_fallback, delta_script_fallback, self.global_fallback)
 
-    global_fallback = get_fallback_dict_for_json(match_data.global_fallback, save_source_info=save_debug_info, sprite_mode=sprite_mode)
+        self.total_entries += sum(len(mapping) for mapping in voice_database.values())
+        self.kept_entries += sum(len(mapping) for mapping in delta_voice_database.values())
 
-    final_global_fallback = build_global_fallback(all_voice_database, script_fallback, global_fallback)
+        if self.script_names:
+            self.file.write(',')
+        self.file.write(f'{json.dumps(script_name)}:{json.dumps(delta_voice_database, sort_keys=True, separators=(",", ":"))}')
 
-    return {
-        "comment_paths" : "Note: when looking up paths, paths starting with '<' like <SPECIAL_TEXT_EFFECT>  are special cases. And if a match is 'null' then it means this sprite was never matched.",
-        "comment_lookup" : "To lookup, first check the voice database. Then check the script fallback. Then check the global fallback.",
-        "global_fallback" : final_global_fallback,
-        "script_fallback" : script_fallback,
-        "voice_database" : all_voice_database,
-    }
+        self._save_script_to_other_formats(script_name, delta_script_fallback, delta_voice_database)
+
+    def _write_full_voice_database(self, script_name: str, voice_database: dict[str, dict[str, str]]):
+        self.file.write(',\n' if self.script_names else '{\n')
+        self.file.write(f'\t\t{json.dumps(script_name)}: {to_indented_json(voice_database, depth=2)}')
 
+        self._save_script_to_other_formats(script_name, self.script_fallback.get(script_name, {}), voice_database)
 
-####################  Graphics Regexes ####################
 
-def get_graphics_regexes(modded_game_cg_dir: str) -> list[re.Pattern]:
-    if not Path(modded_game_cg_dir).exists():
-        raise Exception("Modded game CG folder does not exist!")
+def get_voice_database_per_mode(voice_database: VoiceMatchDatabase) -> dict[bool, dict[str, dict[str, str]]]:
+    """Convert a voice database to sprite mode -> voice -> mod path -> og path, with the paths as written to mapping.json"""
+    # Maps 'last played voice' to another dict. The inner dict maps from mod path -> og path
+    voice_database_per_mode = {True: {}, False: {}}
 
-    patterns = []
-    for cg_top_level_path in Path(modded_game_cg_dir).glob('*'):
-        if cg_top_level_path.is_dir():
-            graphics_regex = f'^{cg_top_level_path.stem}/'
+    for voice, matches_after_voice in voice_database.db.items():
+        # Convert None to the empty string as [null] is an invalid JSON key
+        if voice is None:
+            voice = ""
         else:
-            graphics_regex = f'^{cg_top_level_path.stem}$'
+            voice = str(voice)
+
+        matches_per_voice_per_mode = {True: {}, False: {}}
+
+        for match in matches_after_voice:
+            mod_path = normalize_path(match.mod_path)
+            og_path = normalize_path(match.og_path)
+            matches_per_voice_per_mode[should_output_mapping(mod_path, sprite_mode=True)][mod_path] = og_path
+
+        for sprite_mode in voice_database_per_mode:
+            voice_database_per_mode[sprite_mode][voice] = matches_per_voice_per_mode[sprite_mode]
+
+    return voice_database_per_mode
 
-        patterns.append(re.compile(graphics_regex))
 
-    return patterns
+def save_mapping_files(match_data: AllMatchData, save_debug_info: bool, sprites_output_path: Path, backgrounds_output_path: Path, delta: bool, split: bool, snapshot_interval: int, binary: bool):
+    """Write the sprite and background mapping.json files together.
+    The global fallback depends on every voice database, so the voice databases are converted once to find it,
+    then again as each script is written (rather than keeping all of them in memory)"""
+    # sprite mode -> writer
+    writers = {
+        True: MappingFileWriter(sprites_output_path, delta, split, snapshot_interval, binary),
+        False: MappingFileWriter(backgrounds_output_path, delta, split, snapshot_interval, binary),
+    }
+
+    for voice_database in match_data.per_script_voice_database.values():
+        voice_database_per_mode = get_voice_database_per_mode(voice_database)
+        for sprite_mode, writer in writers.items():
+            writer.add_voice_database_fallback(voice_database_per_mode[sprite_mode])
+
+    for script_name, per_script_fallback in match_data.per_script_fallbacks.items():
+        for sprite_mode, writer in writers.items():
+            writer.add_script_fallback(script_name, get_fallback_dict_for_json(per_script_fallback, save_source_info=save_debug_info, sprite_mode=sprite_mode))
+
+    for sprite_mode, writer in writers.items():
+        writer.add_global_fallback(get_fallback_dict_for_json(match_data.global_fallback, save_source_info=save_debug_info, sprite_mode=sprite_mode))
+        writer.begin()
+
+    for script_path_object, voice_database in sorted(match_data.per_script_voice_database.items(), key=lambda item: Path(item[0]).stem):
+        voice_database_per_mode = get_voice_database_per_mode(voice_database)
+        for sprite_mode, writer in writers.items():
+            writer.add_voice_database(Path(script_path_object).stem, voice_database_per_mode[sprite_mode])
+
+    for writer in writers.values():
+        writer.save()
+
 
 ####################  Verification ####################
 
@@ -161,16 +453,6 @@ class ExpectedGraphics:
         self.line = line
         self.path = path
 
-# Find double quoted strings, including ones with escaped double quotes
-string_regex = re.compile(r'"(?P<data>((\\")|([^"]))*?)"')
-
-def path_is_graphics(path: str, graphics_regexes: list[re.Pattern]):
-    for r in graphics_regexes:
-        if r.match(path):
-            return True
-
-    return False
-
 class CheckResult:
     def __init__(self, detected, matched):
         self.detected = detected
@@ -188,21 +470,21 @@ def graphics_is_detected_and_mapped(last_voice: str, stripped_path: str, existin
     graphics_in_voice_section = existing_matches.db[last_voice]
 
     # Now check the graphics was in that voice section
-    for voice_match in graphics_in_voice_section:
-        if voice_match.mod_path.strip() == stripped_path:
-            has_mapping = False
-            if voice_match.og_path and str(voice_match.og_path).strip():
-                has_mapping = True
-            else:
-                if PRINT_FAILED_MATCHES:
-                    print(f'No match for {voice_match.mod_path} | {voice_match.voice}')
+    voice_match = existing_matches.try_get_stripped(last_voice, stripped_path)
+    if voice_match is not None:
+        has_mapping = False
+        if voice_match.og_path and str(voice_match.og_path).strip():
+            has_mapping = True
+        else:
+            if PRINT_FAILED_MATCHES:
+                print(f'No match for {voice_match.mod_path} | {voice_match.voice}')
 
-                # Collect unmatched mod paths to display at the end
-                if voice_match.mod_path not in unique_unmatched:
-                    unique_unmatched[voice_match.mod_path] = []
-                unique_unmatched[voice_match.mod_path].append(voice_match)
+            # Collect unmatched mod paths to display at the end
+            if voice_match.mod_path not in unique_unmatched:
+                unique_unmatched[voice_match.mod_path] = []
+            unique_unmatched[voice_match.mod_path].append(voice_match)
 
-            return CheckResult(True, has_mapping)
+        return CheckResult(True, has_mapping)
 
     # If reached this point, graphics not found in that voice section.
     # Print all the graphics which were found for that voice section for debugging.
@@ -212,44 +494,28 @@ def graphics_is_detected_and_mapped(last_voice: str, stripped_path: str, existin
 
     return CheckResult(False, False)
 
-def verify_one_script(mod_script_path: str, graphics_regexes: list[re.Pattern], existing_matches: VoiceMatchDatabase, statistics: dict[str, list[str, int]]) -> tuple[list[str], dict[str, FallbackMatch]]:
-    with open(mod_script_path, encoding='utf-8') as f:
-        all_lines = f.readlines()
-
+def verify_one_script(mod_script_path: str, graphics_classifier: GraphicsPathClassifier, existing_matches: VoiceMatchDatabase, statistics: dict[str, list[str, int]]) -> tuple[list[str], dict[str, FallbackMatch]]:
     detect_pass_count = 0
     detect_fail_count = 0
 
     mapping_pass_count = 0
     mapping_fail_count = 0
 
-    last_voice = None
-
     unique_unmatched = {} #type: dict[str, list[VoiceMatchDatabase]]
 
-    for raw_line in all_lines:
-        # Delete comments before processing
-        line = raw_line.split('//', maxsplit=1)[0]
-
-        for result in string_regex.finditer(line):
-            # Record the last seen voice
-            voice_on_line = voice_util.get_voice_on_line(line)
-            if voice_on_line:
-                last_voice = voice_on_line
-
-            # We don't care about leading/trailing for our purposess
-            stripped_path = result.group('data').strip()
-            is_graphics = path_is_graphics(stripped_path, graphics_regexes)
-            if is_graphics:
-                check_result = graphics_is_detected_and_mapped(last_voice, stripped_path, existing_matches, unique_unmatched)
-                if check_result.detected:
-                    detect_pass_count += 1
-                else:
-                    detect_fail_count += 1
-
-                if check_result.mapped:
-                    mapping_pass_count += 1
-                else:
-                    mapping_fail_count += 1
+    # We don't care about leading/trailing for our purposess
+    script_events = script_tokenizer.iter_script_events(mod_script_path, cache_script_tokens)
+    for last_voice, stripped_path in iter_graphics_paths(script_events, graphics_classifier):
+        check_result = graphics_is_detected_and_mapped(last_voice, stripped_path, existing_matches, unique_unmatched)
+        if check_result.detected:
+            detect_pass_count += 1
+        else:
+            detect_fail_count += 1
+
+        if check_result.mapped:
+            mapping_pass_count += 1
+        else:
+            mapping_fail_count += 1
 
     total_count = detect_pass_count + detect_fail_count
     print(f"DETECTION: {detect_pass_count}/{total_count} Successful ({detect_fail_count} Failures)")
@@ -408,18 +674,18 @@ def collect_statistics_from_db(existing_matches: VoiceMatchDatabase, statistics:
             count_dict_for_mod_path[og_path] += 1
 
 
-def collect_statistics(mod_script_dir: str, pattern: str) -> dict[str, dict[str, int]]:
+def collect_statistics(modded_script_paths: list[Path], voice_database_repository: VoiceDatabaseRepository) -> dict[str, dict[str, int]]:
     statistics = {} # dict[str, dict[str, int]]
 
-    for modded_script_path in Path(mod_script_dir).glob(pattern):
-        db_path = common.get_voice_db_path(modded_script_path)
-        existing_matches = VoiceMatchDatabase.deserialize(db_path)
+    voice_database_repository.preload(modded_script_paths)
+    for modded_script_path in modded_script_paths:
+        existing_matches = voice_database_repository.get(modded_script_path)
         collect_statistics_from_db(existing_matches, statistics)
 
     return statistics
 
-def collect_sorted_statistics(mod_script_dir: str, pattern: str) -> dict[str, list[str, int]]:
-    unsorted_statistics = collect_statistics(mod_script_dir, pattern)
+def collect_sorted_statistics(modded_script_paths: list[Path], voice_database_repository: VoiceDatabaseRepository) -> dict[str, list[str, int]]:
+    unsorted_statistics = collect_statistics(modded_script_paths, voice_database_repository)
 
     sorted_statistics = {}
 
@@ -438,15 +704,31 @@ statistics_pattern = '*.txt' #'*.txt' # Matching from other scripts will give mo
 # unmodded_input_file = 'C:/Program Files (x86)/Steam/steamapps/common/Higurashi When They Cry Hou+ Installer Test/HigurashiEp10_Data/StreamingAssets/Scripts/mehagashi.txt'
 mod_script_dir = 'D:/drojf/large_projects/umineko/HIGURASHI_REPOS/10 hou-plus/Update/'
 
+# If True, use the script tokens cached by main.py in the 'token_cache' folder (and cache them if not already)
+cache_script_tokens = True
+
 modded_game_cg_dir = 'D:/games/steam/steamapps/common/Higurashi When They Cry Hou+ Modded/HigurashiEp10_Data/StreamingAssets/CG'
 
-# Get a list of regexes which indicate a path is a graphics path
-graphics_regexes = get_graphics_regexes(modded_game_cg_dir)
+# Used to decide whether a string in a script is a graphics path
+graphics_classifier = GraphicsPathClassifier.from_cg_folder(modded_game_cg_dir)
 
 scanned_any_scripts = False
 
+all_script_paths = list(Path(mod_script_dir).glob(pattern))
+statistics_script_paths = list(Path(mod_script_dir).glob(statistics_pattern))
+
+# Each voice database is loaded once here, then shared by the statistics, verification and json output below
+voice_database_repository = VoiceDatabaseRepository()
+voice_database_repository.preload(all_script_paths)
+
 # Firstly, collect statistics from all chapters
-statistics = collect_sorted_statistics(mod_script_dir, statistics_pattern)
+statistics = collect_sorted_statistics(statistics_script_paths, voice_database_repository)
+
+# Databases which were only needed for the statistics can be released
+all_script_names = set(p.stem for p in all_script_paths)
+for modded_script_path in statistics_script_paths:
+    if modded_script_path.stem not in all_script_names:
+        voice_database_repository.unload(modded_script_path)
 
 # TODO: save to file?
 # for mod_path, og_paths in statistics.items():
@@ -456,18 +738,18 @@ output_per_chapter = []
 
 merged_fallback_matches = {} # dict[str, FallbackMatch]
 
-for modded_script_path in Path(mod_script_dir).glob(pattern):
+for modded_script_path in all_script_paths:
     scanned_any_scripts = True
 
-    # Load the matches found by the main matching script
+    # Get the matches found by the main matching script
     db_path = common.get_voice_db_path(modded_script_path)
-    existing_matches = VoiceMatchDatabase.deserialize(db_path)
+    existing_matches = voice_database_repository.get(modded_script_path)
 
     all_match_data.set_voice_database(modded_script_path, existing_matches)
 
     print(f"Loaded {len(existing_matches.db)} voice sections from [{db_path}]")
 
-    debug_output, fallback_match_for_chapter = verify_one_script(modded_script_path, graphics_regexes, existing_matches, statistics)
+    debug_output, fallback_match_for_chapter = verify_one_script(modded_script_path, graphics_classifier, existing_matches, statistics)
 
     # Save the per-chapter fallback to the output path
     all_match_data.set_per_script_fallback(modded_script_path.stem, fallback_match_for_chapter)
@@ -489,11 +771,29 @@ for script_name, debug_output_list in output_per_chapter:
 if not scanned_any_scripts:
     raise Exception("No files were scanned. Are you sure pattern is correct?")
 
+print(f"Loaded {voice_database_repository.load_count} voice databases")
+
 # TODO: add a fallback based purely on statistics over all know matchings.
 # The below only records fallbacks which were actually used, rather than all possible matchings.
 # This is to be used if a new sprite call is added, to avoid having to re-do the matching just for that one sprite call.# Save the merged fallback matching to .json file
 save_debug_info = False
 
+# If True, leave out entries which the game would resolve to the same mapping anyway, and write minified json (much smaller and faster to load)
+save_delta_mapping = False
+
+# If True, check every script resolves the same with the delta mapping as with the full mapping, and raise an exception if not (slow, for debugging)
+verify_delta_output = False
+
+# If True, also write the mapping as 'mapping/default.json' and one 'mapping/script/[script name].json' per script, next to each mapping.json
+save_split_mapping = False
+
+# If not None, also write 'mapping/snapshot/[script name].json' with the game's mapping dictionary at each voice,
+# stored in full every this many voices (see voice_snapshots.py). voice_snapshots.default_checkpoint_interval is a good value
+voice_snapshot_interval = None
+
+# If True, also write 'mapping.bin', which can be memory mapped and queried without parsing the whole file (see binary_mapping.py)
+save_binary_mapping = False
+
 all_match_data.set_global_fallback(merged_fallback_matches)
 
 # Output separate mapping.json files for OGBackgrounds and OGSprites
@@ -503,6 +803,5 @@ backgrounds_output_path = output_folder.joinpath('OGBackgroundsMapping', 'mappin
 os.makedirs(Path(sprites_output_path).parent, exist_ok=True)
 os.makedirs(Path(backgrounds_output_path).parent, exist_ok=True)
 
-save_to_json(get_match_data_as_plain_dict(all_match_data, save_debug_info, sprite_mode=True), sprites_output_path)
-save_to_json(get_match_data_as_plain_dict(all_match_data, save_debug_info, sprite_mode=False), backgrounds_output_path)
+save_mapping_files(all_match_data, save_debug_info, sprites_output_path, backgrounds_output_path, save_delta_mapping, save_split_mapping, voice_snapshot_interval, save_binary_mapping)
 
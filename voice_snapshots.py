@@ -0,0 +1,89 @@
+import json
+
+# Snapshots of the (Mod CG -> OG CG) dictionary the game keeps while playing a script (see README.md).
+# The game updates the dictionary with a script's voice_database entries each time a voice is played,
+# so after loading a save it would need to replay every voice from the start of the script.
+# Instead, the full dictionary is stored every checkpoint_interval voices, and only the entries which changed for the other voices,
+# so the dictionary at any voice can be rebuilt from the nearest checkpoint, applying at most checkpoint_interval - 1 changes.
+# Like the voice database, a voice which is played more than once in a script only has the state from its first appearance.
+
+default_checkpoint_interval = 50
+
+
+class ScriptSnapshots:
+    def __init__(self, voice_order: list[str], checkpoint_interval: int, checkpoints: list[dict[str, str]], deltas: list[dict[str, str]]):
+        # Voices in the order they are played. The dictionary is empty before the first voice
+        self.voice_order = voice_order
+        self.checkpoint_interval = checkpoint_interval
+        # checkpoints[n] is the dictionary after voice_order[n * checkpoint_interval] was played
+        self.checkpoints = checkpoints
+        # deltas[i] contains the entries which changed when voice_order[i] was played
+        self.deltas = deltas
+        self.voice_to_index = {voice: i for i, voice in enumerate(voice_order)}
+
+    def to_json(self):
+        return {
+            'voice_order': self.voice_order,
+            'checkpoint_interval': self.checkpoint_interval,
+            'checkpoints': self.checkpoints,
+            'deltas': self.deltas,
+        }
+
+    @staticmethod
+    def from_json(data) -> 'ScriptSnapshots':
+        return ScriptSnapshots(data['voice_order'], data['checkpoint_interval'], data['checkpoints'], data['deltas'])
+
+    def get_state(self, voice: str) -> dict[str, str]:
+        """The dictionary just after the given voice was played. This is the reference implementation for restoring a save"""
+        voice_index = self.voice_to_index[voice]
+        checkpoint_index = voice_index // self.checkpoint_interval
+
+        state = dict(self.checkpoints[checkpoint_index])
+        for i in range(checkpoint_index * self.checkpoint_interval + 1, voice_index + 1):
+            state.update(self.deltas[i])
+
+        return state
+
+    def resolve(self, voice: str, mod_path: str, default_mapping: dict[str, str]) -> str:
+        """The og path shown for mod_path just after the given voice was played, falling back to default.json if not in the dictionary"""
+        state = self.get_state(voice)
+        if mod_path in state:
+            return state[mod_path]
+
+        return default_mapping.get(mod_path, None)
+
+
+def build_snapshots(mapping_per_voice: dict[str, dict[str, str]], checkpoint_interval: int = default_checkpoint_interval) -> ScriptSnapshots:
+    """mapping_per_voice is the voice_database of one script, in the order the voices are played"""
+    voice_order = []
+    checkpoints = []
+    deltas = []
+
+    state = {}
+    for i, (voice, mapping) in enumerate(mapping_per_voice.items()):
+        delta = {mod_path: og_path for mod_path, og_path in mapping.items() if state.get(mod_path, None) != og_path}
+        state.update(delta)
+
+        voice_order.append(voice)
+        deltas.append(delta)
+        if i % checkpoint_interval == 0:
+            checkpoints.append(dict(state))
+
+    return ScriptSnapshots(voice_order, checkpoint_interval, checkpoints, deltas)
+
+
+def verify_snapshots(script_name: str, mapping_per_voice: dict[str, dict[str, str]], snapshots: ScriptSnapshots):
+    """Replay the whole script voice by voice, and raise an exception if the state restored from the snapshots is ever different"""
+    # Also check the snapshots still work after being saved
+    snapshots = ScriptSnapshots.from_json(json.loads(json.dumps(snapshots.to_json())))
+
+    if snapshots.voice_order != list(mapping_per_voice):
+        raise Exception(f"Snapshots for script [{script_name}] have a different voice order to the voice database")
+
+    replayed_state = {}
+    for voice, mapping in mapping_per_voice.items():
+        replayed_state.update(mapping)
+        restored_state = snapshots.get_state(voice)
+        if restored_state != replayed_state:
+            differences = sorted(set(restored_state.items()) ^ set(replayed_state.items()))
+            raise Exception(f"Snapshot for script [{script_name}] voice [{voice}] is different to replaying the script: {differences}")